@@ -8,8 +8,12 @@ The particular configuration of keypoints and skeleton is specified in the headm
 
 
 import argparse
+import logging
+import math
+import os
+
+import numpy as np
 import torch
-import pycocotools
 
 from openpifpaf.datasets import DataModule
 from openpifpaf import encoder, headmeta, metric, transforms
@@ -17,8 +21,14 @@ from openpifpaf.datasets import collate_images_anns_meta, collate_images_targets
 
 from .constants import ANIMAL_KEYPOINTS, ANIMAL_SKELETON, HFLIP, \
     ANIMAL_SIGMAS, ANIMAL_POSE, ANIMAL_CATEGORIES, ANIMAL_SCORE_WEIGHTS
+from . import array_transforms, batch_encoder, device_normalize, eval_buckets, eval_cache, eval_shards, \
+    oks_metric, pinned_buffers, sparse_targets, target_cache
+from .annotation_store import CocoIndex
 from .dataloader import Animal
+from .distributed_sampler import DistributedSamplerWrapper
+from .rescale_crop import RescaleRelativeCrop
 
+LOG = logging.getLogger(__name__)
 
 class AnimalKp(DataModule):
     """
@@ -36,6 +46,9 @@ class AnimalKp(DataModule):
     train_image_dir = 'data/animalpose/images/train/'
     val_image_dir = 'data/animalpose/images/val/'
     eval_image_dir = val_image_dir
+    train_image_shards = None
+    val_image_shards = None
+    eval_image_shards = None
 
     n_images = None
     square_edge = 513
@@ -47,15 +60,35 @@ class AnimalKp(DataModule):
     upsample_stride = 1
     min_kp_anns = 1
     b_min = 1  # 1 pixel
+    annotation_cache = True
+    sampler = 'shuffle'
+    epoch_size = None
+    image_cache_mb = 0
+    reduced_decode = False
+    image_pyramid = False
+    array_transforms = False
+    uint8_transport = False
+    target_cache_dir = None
+    batch_encoding = False
+    sparse_targets = False
+    pinned_buffers = 0
+    device = None
 
     eval_annotation_filter = True
     eval_long_edge = 0  # set to zero to deactivate rescaling
     eval_orientation_invariant = 0.0
     eval_extended_scale = False
+    eval_bucketing = False
+    eval_cache_dir = None
+    eval_shard = None
+    vectorized_metric = False
 
     def __init__(self):
         super().__init__()
 
+        # parsed eval annotations shared by eval_loader() and metrics() of this instance
+        self.coco_index = CocoIndex()
+
         cif = headmeta.Cif('cif', 'animal',
                            keypoints=ANIMAL_KEYPOINTS,
                            sigmas=ANIMAL_SIGMAS,
@@ -84,6 +117,12 @@ class AnimalKp(DataModule):
                            default=cls.train_image_dir)
         group.add_argument('--animal-val-image-dir',
                            default=cls.val_image_dir)
+        group.add_argument('--animal-train-image-shards',
+                           default=cls.train_image_shards,
+                           help='read train images from this shard directory')
+        group.add_argument('--animal-val-image-shards',
+                           default=cls.val_image_shards,
+                           help='read val and eval images from this shard directory')
 
         group.add_argument('--animal-square-edge',
                            default=cls.square_edge, type=int,
@@ -115,6 +154,60 @@ class AnimalKp(DataModule):
         group.add_argument('--animal-bmin',
                            default=cls.b_min, type=int,
                            help='b minimum in pixels')
+        assert cls.annotation_cache
+        group.add_argument('--animal-no-annotation-cache',
+                           dest='animal_annotation_cache',
+                           default=True, action='store_false',
+                           help='do not cache parsed annotations next to the json files')
+        group.add_argument('--animal-sampler',
+                           default=cls.sampler, choices=('shuffle', 'class-aware'),
+                           help='order of training images: plain shuffle or sampling '
+                                'weighted by the inverse frequency of the animal species')
+        group.add_argument('--animal-epoch-size',
+                           default=cls.epoch_size, type=int,
+                           help='number of training samples per epoch (default: all images)')
+        group.add_argument('--animal-image-cache-mb',
+                           default=cls.image_cache_mb, type=int,
+                           help='shared-memory budget in MB to cache decoded images '
+                                'of the train and of the val loader (0 to deactivate)')
+        assert not cls.reduced_decode
+        group.add_argument('--animal-reduced-decode',
+                           default=False, action='store_true',
+                           help='decode JPEGs at a reduced resolution when the '
+                                'preprocessing downscales them anyway')
+        assert not cls.image_pyramid
+        group.add_argument('--animal-image-pyramid',
+                           default=False, action='store_true',
+                           help='load the smallest pre-resized image of voc_to_coco --pyramid '
+                                'that the preprocessing needs')
+        assert not cls.array_transforms
+        group.add_argument('--animal-array-transforms',
+                           default=False, action='store_true',
+                           help='run the training augmentation on uint8 NumPy arrays '
+                                'instead of PIL images')
+        assert not cls.uint8_transport
+        group.add_argument('--animal-uint8-transport',
+                           default=False, action='store_true',
+                           help='loaders emit uint8 batches that are normalized '
+                                'on the device of the model')
+        group.add_argument('--animal-target-cache-dir',
+                           default=cls.target_cache_dir,
+                           help='validate without augmentation and cache the preprocessed val samples '
+                                'with their targets in this directory, also the train samples '
+                                'with --animal-no-augmentation')
+        assert not cls.batch_encoding
+        group.add_argument('--animal-batch-encoding',
+                           default=False, action='store_true',
+                           help='encode the CIF and CAF targets of whole batches in the main process '
+                                'instead of every sample in the loader workers')
+        assert not cls.sparse_targets
+        group.add_argument('--animal-sparse-targets',
+                           default=False, action='store_true',
+                           help='send the CIF and CAF targets from the loader workers as sparse '
+                                'fields that are densified in the main process')
+        group.add_argument('--animal-pinned-buffers', default=cls.pinned_buffers, type=int,
+                           help='with --pin-memory, copy batches into a ring of this many reusable '
+                                'pinned buffers instead of pinning a new copy of every batch')
 
         # evaluation  (TO setup directly)
         eval_set_group = group.add_mutually_exclusive_group()
@@ -132,18 +225,38 @@ class AnimalKp(DataModule):
         group.add_argument('--animal-eval-orientation-invariant',
                            default=cls.eval_orientation_invariant, type=float,
                            dest='coco_eval_orientation_invariant')
+        assert not cls.eval_bucketing
+        group.add_argument('--animal-eval-bucketing', default=False, action='store_true',
+                           help='batch eval images of similar aspect ratio and pad every batch '
+                                'only to its largest image')
+        group.add_argument('--animal-eval-cache-dir',
+                           default=cls.eval_cache_dir,
+                           help='preprocess the eval samples once into this directory and read them '
+                                'back in later evaluations with the same configuration')
+        group.add_argument('--animal-eval-shard', default=cls.eval_shard, type=eval_shards.parse_shard,
+                           help='i/N: evaluate every N-th eval image starting at i and write the '
+                                'predictions with --write-predictions to merge them with '
+                                'python -m openpifpaf_animalpose.eval_shards')
+        assert not cls.vectorized_metric
+        group.add_argument('--animal-vectorized-metric', default=False, action='store_true',
+                           help='evaluate the keypoint OKS incrementally with NumPy instead of '
+                                'with the COCOeval of pycocotools, with the same results')
 
     @classmethod
     def configure(cls, args: argparse.Namespace):
         # extract global information
         cls.debug = args.debug
         cls.pin_memory = args.pin_memory
+        cls.device = args.device
 
         # Animal specific
         cls.train_annotations = args.animal_train_annotations
         cls.val_annotations = args.animal_val_annotations
         cls.train_image_dir = args.animal_train_image_dir
         cls.val_image_dir = args.animal_val_image_dir
+        cls.train_image_shards = args.animal_train_image_shards
+        cls.val_image_shards = args.animal_val_image_shards
+        cls.eval_image_shards = args.animal_val_image_shards
 
         cls.square_edge = args.animal_square_edge
         cls.extended_scale = args.animal_extended_scale
@@ -154,99 +267,290 @@ class AnimalKp(DataModule):
         cls.upsample_stride = args.animal_upsample
         cls.min_kp_anns = args.animal_min_kp_anns
         cls.b_min = args.animal_bmin
+        cls.annotation_cache = args.animal_annotation_cache
+        cls.sampler = args.animal_sampler
+        cls.epoch_size = args.animal_epoch_size
+        cls.image_cache_mb = args.animal_image_cache_mb
+        cls.reduced_decode = args.animal_reduced_decode
+        cls.image_pyramid = args.animal_image_pyramid
+        cls.array_transforms = args.animal_array_transforms
+        cls.uint8_transport = args.animal_uint8_transport
+        cls.target_cache_dir = args.animal_target_cache_dir
+        cls.batch_encoding = args.animal_batch_encoding
+        cls.sparse_targets = args.animal_sparse_targets
+        cls.pinned_buffers = args.animal_pinned_buffers
 
         # evaluation
         cls.eval_annotation_filter = args.coco_eval_annotation_filter  # the destination is for coco
         if args.animal_eval_test2017:
             cls.eval_image_dir = cls._test2017_image_dir
             cls.eval_annotations = cls._test2017_annotations
+            cls.eval_image_shards = None
             cls.annotation_filter = False
         if args.animal_eval_testdev2017:
             cls.eval_image_dir = cls._test2017_image_dir
             cls.eval_annotations = cls._testdev2017_annotations
+            cls.eval_image_shards = None
             cls.annotation_filter = False
         cls.eval_long_edge = args.coco_eval_long_edge
         cls.eval_orientation_invariant = args.coco_eval_orientation_invariant
         cls.eval_extended_scale = args.coco_eval_extended_scale
+        cls.eval_bucketing = args.animal_eval_bucketing
+        cls.eval_cache_dir = args.animal_eval_cache_dir
+        cls.eval_shard = args.animal_eval_shard
+        if cls.eval_shard is not None and hasattr(args, 'watch'):
+            # openpifpaf.eval
+            eval_shards.configure_eval_output(args, cls.eval_shard)
+        cls.vectorized_metric = args.animal_vectorized_metric
 
         if (args.cocokp_eval_test2017 or args.cocokp_eval_testdev2017) \
             and not args.write_predictions and not args.debug:
             raise Exception('have to use --write-predictions for this dataset')
 
-    def _preprocess(self):
-        encoders = (encoder.Cif(self.head_metas[0],
-                                bmin=self.b_min),
-                    encoder.Caf(self.head_metas[1]))
+    def _encoders(self):
+        return (encoder.Cif(self.head_metas[0],
+                            bmin=self.b_min),
+                encoder.Caf(self.head_metas[1]))
+
+    def _targets(self, cached):
+        """Target transport: 'dense' or 'sparse' from the workers, None to encode batches."""
+        if cached:
+            return 'dense'
+        if self.batch_encoding:
+            return None
+        return 'sparse' if self.sparse_targets else 'dense'
+
+    def _encoders_t(self, targets):
+        if targets is None:
+            return None
+        encoders_t = transforms.Encoders(self._encoders())
+        if targets == 'sparse':
+            return transforms.Compose([encoders_t, sparse_targets.SparseTargets()])
+        return encoders_t
+
+    def _deterministic_preprocess(self, *, targets='dense'):
+        return transforms.Compose([
+            transforms.NormalizeAnnotations(),
+            transforms.RescaleAbsolute(self.square_edge),
+            transforms.CenterPad(self.square_edge),
+            self._to_tensor(transforms),
+            self._encoders_t(targets),
+        ])
 
+    def _preprocess(self, *, targets='dense'):
         if not self.augmentation:
-            return transforms.Compose([
-                transforms.NormalizeAnnotations(),
-                transforms.RescaleAbsolute(self.square_edge),
-                transforms.CenterPad(self.square_edge),
-                transforms.EVAL_TRANSFORM,
-                transforms.Encoders(encoders),
-            ])
+            return self._deterministic_preprocess(targets=targets)
 
-        if self.extended_scale:
-            rescale_t = transforms.RescaleRelative(
-                scale_range=(0.25 * self.rescale_images,
-                             2.0 * self.rescale_images),
-                power_law=True, stretch_range=(0.75, 1.33))
+        if self.array_transforms:
+            t = array_transforms
+            array_t = array_transforms.ToArray()
         else:
-            rescale_t = transforms.RescaleRelative(
-                scale_range=(0.4 * self.rescale_images,
-                             2.0 * self.rescale_images),
-                power_law=True, stretch_range=(0.75, 1.33))
+            t = transforms
+            array_t = None
+
+        rescale_t = self._train_rescale()
+        crop_t = transforms.Crop(self.square_edge, use_area_of_interest=True)
+        rescale_crop_t = (array_transforms.RescaleRelativeCrop(rescale_t, crop_t) if self.array_transforms
+                          else RescaleRelativeCrop(rescale_t, crop_t))
 
         blur_t = None
         if self.blur:
-            blur_t = transforms.RandomApply(transforms.Blur(), self.blur)
+            blur_t = transforms.RandomApply(t.Blur(), self.blur)
 
         orientation_t = None
         if self.orientation_invariant:
             orientation_t = transforms.RandomApply(
-                transforms.RotateBy90(), self.orientation_invariant)
+                t.RotateBy90(), self.orientation_invariant)
 
         return transforms.Compose([
-            transforms.NormalizeAnnotations(),
+            array_t,
+            t.NormalizeAnnotations(),
             transforms.AnnotationJitter(),
-            transforms.RandomApply(transforms.HFlip(ANIMAL_KEYPOINTS, HFLIP), 0.5),
-            rescale_t,
+            transforms.RandomApply(t.HFlip(ANIMAL_KEYPOINTS, HFLIP), 0.5),
+            rescale_crop_t,
             blur_t,
-            transforms.Crop(self.square_edge, use_area_of_interest=True),
-            transforms.CenterPad(self.square_edge),
+            t.CenterPad(self.square_edge),
             orientation_t,
-            transforms.TRAIN_TRANSFORM,
-            transforms.Encoders(encoders),
+            device_normalize.train_transform(t) if self.uint8_transport else t.TRAIN_TRANSFORM,
+            self._encoders_t(targets),
         ])
 
+    @classmethod
+    def _to_tensor(cls, t):
+        if cls.uint8_transport:
+            return device_normalize.eval_transform(t)
+        return t.EVAL_TRANSFORM
+
+    def _batch_capacities(self, edge, *, with_targets):
+        """Pinned buffer sizes of batches of images with the given edge."""
+        if self.uint8_transport:
+            capacities = {'images': (torch.uint8, self.batch_size * 4 * edge * edge)}
+        else:
+            capacities = {'images': (torch.get_default_dtype(), self.batch_size * 3 * edge * edge)}
+        if with_targets:
+            for head_index, head_meta in enumerate(self.head_metas):
+                field_edge = (edge - 1) // head_meta.stride + 1
+                n_channels = head_meta.n_confidences + 3 * head_meta.n_vectors + head_meta.n_scales
+                capacities[('targets', head_index)] = (
+                    torch.float32, self.batch_size * head_meta.n_fields * n_channels * field_edge * field_edge)
+        return capacities
+
+    def _data_loader(self, data, *, targets='dense', edge=None, **kwargs):
+        pinned = self.pinned_buffers and kwargs.get('pin_memory')
+        if pinned:
+            kwargs['pin_memory'] = False
+        loader = torch.utils.data.DataLoader(data, **kwargs)
+        if targets is None:
+            loader = batch_encoder.BatchEncoding(loader, self._encoders())
+        elif targets == 'sparse':
+            loader = sparse_targets.DenseTargets(loader)
+        if pinned:
+            capacities = self._batch_capacities(edge, with_targets=targets != 'eval') if edge else None
+            loader = pinned_buffers.PinnedBatches(loader, self.pinned_buffers, capacities)
+        if self.uint8_transport:
+            return device_normalize.DeviceNormalize(loader, self.device)
+        return loader
+
+    def distributed_sampler(self, loader):
+        if isinstance(loader, (device_normalize.DeviceNormalize, batch_encoder.BatchEncoding,
+                               sparse_targets.DenseTargets, pinned_buffers.PinnedBatches)):
+            return loader.with_loader(self.distributed_sampler(loader.loader))
+        if not self._custom_sampler(loader.sampler):
+            return super().distributed_sampler(loader)
+
+        # keep class-aware weights and the epoch size of _train_sampler()
+        LOG.info('Wrapping sampler of %s with DistributedSamplerWrapper.', loader)
+        return torch.utils.data.DataLoader(
+            loader.dataset,
+            batch_size=loader.batch_size,
+            drop_last=True,
+            shuffle=False,
+            sampler=DistributedSamplerWrapper(loader.sampler),
+            pin_memory=loader.pin_memory,
+            num_workers=loader.num_workers,
+            collate_fn=loader.collate_fn,
+        )
+
+    @staticmethod
+    def _custom_sampler(sampler):
+        """Whether sampler is the weighted or epoch size sampler of _train_sampler()."""
+        if isinstance(sampler, torch.utils.data.WeightedRandomSampler):
+            return True
+        return (isinstance(sampler, torch.utils.data.RandomSampler)
+                and sampler.num_samples != len(sampler.data_source))
+
+    def _train_rescale(self):
+        if self.extended_scale:
+            return transforms.RescaleRelative(
+                scale_range=(0.25 * self.rescale_images,
+                             2.0 * self.rescale_images),
+                power_law=True, stretch_range=(0.75, 1.33))
+
+        return transforms.RescaleRelative(
+            scale_range=(0.4 * self.rescale_images,
+                         2.0 * self.rescale_images),
+            power_law=True, stretch_range=(0.75, 1.33))
+
+    def _train_decode_hints(self, preprocess, augmentation):
+        """Decode options for Animal and how far the preprocess downscales a sample."""
+        if not self.reduced_decode and not self.image_pyramid:
+            return {}
+        hints = {'reduced_decode': self.reduced_decode, 'image_pyramid': self.image_pyramid}
+        if not augmentation:
+            return dict(hints, decode_long_edge=self.square_edge)
+
+        # the random scale of every sample is drawn before its image is decoded
+        rescale_crop_t, = [t for t in preprocess.preprocess_list if isinstance(t, RescaleRelativeCrop)]
+        return dict(hints, decode_scale_fn=rescale_crop_t.draw_factors)
+
     def train_loader(self):
+        cached = not self.augmentation and self.target_cache_dir is not None
+        targets = self._targets(cached)
+        preprocess = self._preprocess(targets=targets)
         train_data = Animal(
             image_dir=self.train_image_dir,
             ann_file=self.train_annotations,
-            preprocess=self._preprocess(),
+            preprocess=preprocess,
             annotation_filter=True,
             min_kp_anns=self.min_kp_anns,
             category_ids=[1],
+            annotation_cache=self.annotation_cache,
+            image_cache_bytes=self.image_cache_mb * 1000000,
+            image_shards=self.train_image_shards,
+            **self._train_decode_hints(preprocess, self.augmentation),
         )
-        return torch.utils.data.DataLoader(
-            train_data, batch_size=self.batch_size, shuffle=not self.debug,
+        sampler = self._train_sampler(train_data)
+        if cached:
+            train_data = self._target_cache(train_data, self.train_annotations,
+                                            self.train_image_dir, self.train_image_shards)
+        return self._data_loader(
+            train_data, batch_size=self.batch_size,
+            shuffle=not self.debug and self.sampler == 'shuffle' and not self.epoch_size,
+            sampler=sampler,
             pin_memory=self.pin_memory, num_workers=self.loader_workers, drop_last=True,
-            collate_fn=collate_images_targets_meta)
+            collate_fn=collate_images_targets_meta if targets == 'dense' else collate_images_anns_meta,
+            targets=targets, edge=self.square_edge)
+
+    def _train_sampler(self, train_data):
+        if self.sampler == 'class-aware':
+            weights = train_data.class_aware_sample_weights(by_species=True)
+            LOG.info('class aware sampling of %d images per epoch',
+                     self.epoch_size or len(train_data))
+            return torch.utils.data.WeightedRandomSampler(
+                weights, self.epoch_size or len(train_data), replacement=True)
+
+        if self.epoch_size and not self.debug:
+            return torch.utils.data.RandomSampler(train_data, num_samples=self.epoch_size)
+
+        return None
+
+    def _target_cache(self, data, ann_file, image_dir, image_shards):
+        """Wrap data of _deterministic_preprocess() in a TargetCache."""
+        if self.target_cache_dir is None:
+            return data
+        ann_stat = os.stat(ann_file)
+        key = target_cache.cache_key(
+            dataset={
+                'ann_file': os.path.abspath(ann_file),
+                'ann_file_stat': (ann_stat.st_size, ann_stat.st_mtime_ns),
+                'image_dir': os.path.abspath(image_dir),
+                'image_shards': image_shards and os.path.abspath(image_shards),
+                'ids': data.ids,
+            },
+            head_metas=self.head_metas,
+            preprocess={
+                'square_edge': self.square_edge,
+                'b_min': self.b_min,
+                'uint8_transport': self.uint8_transport,
+                'reduced_decode': self.reduced_decode,
+                'image_pyramid': self.image_pyramid,
+            },
+        )
+        return target_cache.TargetCache(data, self.target_cache_dir, key)
 
     def val_loader(self):
+        deterministic = self.target_cache_dir is not None
+        targets = self._targets(deterministic)
+        preprocess = self._deterministic_preprocess() if deterministic else self._preprocess(targets=targets)
         val_data = Animal(
             image_dir=self.val_image_dir,
             ann_file=self.val_annotations,
-            preprocess=self._preprocess(),
+            preprocess=preprocess,
             annotation_filter=True,
             min_kp_anns=self.min_kp_anns,
             category_ids=[1],
+            annotation_cache=self.annotation_cache,
+            image_cache_bytes=self.image_cache_mb * 1000000,
+            image_shards=self.val_image_shards,
+            **self._train_decode_hints(preprocess, self.augmentation and not deterministic),
         )
-        return torch.utils.data.DataLoader(
+        val_data = self._target_cache(val_data, self.val_annotations,
+                                      self.val_image_dir, self.val_image_shards)
+        return self._data_loader(
             val_data, batch_size=self.batch_size, shuffle=False,
             pin_memory=self.pin_memory, num_workers=self.loader_workers, drop_last=True,
-            collate_fn=collate_images_targets_meta)
+            collate_fn=collate_images_targets_meta if targets == 'dense' else collate_images_anns_meta,
+            targets=targets, edge=self.square_edge)
 
     @classmethod
     def common_eval_preprocess(cls):
@@ -262,7 +566,7 @@ class AnimalKp(DataModule):
         elif cls.eval_long_edge:
             rescale_t = transforms.RescaleAbsolute(cls.eval_long_edge)
 
-        if cls.batch_size == 1:
+        if cls.batch_size == 1 or cls.eval_bucketing:
             padding_t = transforms.CenterPadTight(16)
         else:
             assert cls.eval_long_edge
@@ -284,6 +588,32 @@ class AnimalKp(DataModule):
             orientation_t,
         ]
 
+    @classmethod
+    def eval_sizes(cls, store, ids):
+        """Image widths and heights after common_eval_preprocess.
+
+        Rotations of eval_orientation_invariant keep the image size.
+        """
+        rows = store.rows(ids)
+        widths = store.widths[rows].astype(np.float64)
+        heights = store.heights[rows].astype(np.float64)
+        if cls.eval_long_edge:
+            long_edges = np.full(len(ids), float(cls.eval_long_edge))
+            if cls.eval_extended_scale:
+                # choices of DeterministicEqualChoice(..., salt=1)
+                half = np.array([hash(image_id + 1) % 2 == 1 for image_id in ids], dtype=bool)
+                long_edges[half] = (cls.eval_long_edge - 1) // 2 + 1
+            scales = long_edges / np.maximum(np.maximum(widths, heights), 1.0)
+            widths, heights = widths * scales, heights * scales
+        return widths, heights
+
+    @classmethod
+    def _eval_edge(cls):
+        """Largest edge of preprocessed eval images, None without rescaling."""
+        if not cls.eval_long_edge:
+            return None
+        return math.ceil((cls.eval_long_edge - 1) / 16) * 16 + 1
+
     def _eval_preprocess(self):
         return transforms.Compose([
             *self.common_eval_preprocess(),
@@ -295,9 +625,35 @@ class AnimalKp(DataModule):
                 ),
                 transforms.ToCrowdAnnotations(ANIMAL_CATEGORIES),
             ]),
-            transforms.EVAL_TRANSFORM,
+            self._to_tensor(transforms),
         ])
 
+    def _eval_cache(self, data):
+        """Wrap data of _eval_preprocess() in an EvalCache."""
+        if self.eval_cache_dir is None:
+            return data
+        ann_stat = os.stat(self.eval_annotations)
+        key = target_cache.cache_key(
+            dataset={
+                'ann_file': os.path.abspath(self.eval_annotations),
+                'ann_file_stat': (ann_stat.st_size, ann_stat.st_mtime_ns),
+                'image_dir': os.path.abspath(self.eval_image_dir),
+                'image_shards': self.eval_image_shards and os.path.abspath(self.eval_image_shards),
+                'ids': data.ids,
+            },
+            head_metas=self.head_metas,
+            preprocess={
+                'eval_long_edge': self.eval_long_edge,
+                'eval_extended_scale': self.eval_extended_scale,
+                'eval_orientation_invariant': self.eval_orientation_invariant,
+                'tight_padding': self.batch_size == 1 or self.eval_bucketing,
+                'uint8_transport': self.uint8_transport,
+                'reduced_decode': self.reduced_decode,
+                'image_pyramid': self.image_pyramid,
+            },
+        )
+        return eval_cache.EvalCache(data, self.eval_cache_dir, key, num_workers=self.loader_workers)
+
     def eval_loader(self):
         eval_data = Animal(
             image_dir=self.eval_image_dir,
@@ -307,15 +663,56 @@ class AnimalKp(DataModule):
             annotation_filter=self.eval_annotation_filter,
             min_kp_anns=self.min_kp_anns if self.eval_annotation_filter else 0,
             category_ids=[1] if self.eval_annotation_filter else [],
+            annotation_cache=self.annotation_cache,
+            decode_long_edge=self.eval_long_edge if self.reduced_decode or self.image_pyramid else None,
+            reduced_decode=self.reduced_decode,
+            image_pyramid=self.image_pyramid,
+            image_shards=self.eval_image_shards,
+            coco_index=self.coco_index,
         )
-        return torch.utils.data.DataLoader(
+        if self.eval_shard is not None:
+            eval_data.ids = eval_shards.shard_ids(eval_data.ids, self.eval_shard)
+            LOG.info('eval shard %d/%d: %d images', *self.eval_shard, len(eval_data.ids))
+        batch_sampler = None
+        if self.eval_bucketing and self.batch_size > 1:
+            batch_sampler = eval_buckets.AspectRatioBatchSampler(
+                *self.eval_sizes(eval_data.store, eval_data.ids), self.batch_size)
+        eval_data = self._eval_cache(eval_data)
+        if batch_sampler is not None:
+            return self._data_loader(
+                eval_data, batch_sampler=batch_sampler,
+                pin_memory=self.pin_memory, num_workers=self.loader_workers,
+                collate_fn=eval_buckets.collate_padded_images_anns_meta,
+                targets='eval', edge=self._eval_edge())
+        return self._data_loader(
             eval_data, batch_size=self.batch_size, shuffle=False,
             pin_memory=self.pin_memory, num_workers=self.loader_workers, drop_last=False,
-            collate_fn=collate_images_anns_meta)
+            collate_fn=collate_images_anns_meta,
+            targets='eval', edge=self._eval_edge())
+
+    def drop_annotation_index(self):
+        """Release the parsed eval annotations, the metrics keep their own reference."""
+        self.coco_index.clear()
 
     def metrics(self):
+        if self.eval_shard is not None:
+            # the keypoint metric runs once on the merged predictions of all shards
+            return [eval_shards.ShardPredictions(metric.Coco(
+                self.coco_index(self.eval_annotations),
+                max_per_image=20,
+                category_ids=[1],
+                iou_type='keypoints',
+                keypoint_oks_sigmas=ANIMAL_SIGMAS,
+            ), self.eval_shard)]
+        if self.vectorized_metric:
+            return [oks_metric.OksCoco(
+                self.coco_index(self.eval_annotations),
+                max_per_image=20,
+                category_ids=[1],
+                keypoint_oks_sigmas=ANIMAL_SIGMAS,
+            )]
         return [metric.Coco(
-            pycocotools.coco.COCO(self.eval_annotations),
+            self.coco_index(self.eval_annotations),
             max_per_image=20,
             category_ids=[1],
             iou_type='keypoints',
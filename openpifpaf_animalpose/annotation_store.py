@@ -0,0 +1,274 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import resource
+import time
+
+import numpy as np
+
+from .constants import ANIMAL_KEYPOINTS
+
+
+LOG = logging.getLogger(__name__)
+
+#: Increment when the arrays stored in a cache file change.
+CACHE_VERSION = 4
+
+
+class AnnotationStore:
+    """Compact, array-backed copy of the images and annotations of a COCO file.
+
+    Annotations are sorted by image so that every image owns a contiguous
+    slice of rows given by ``offsets``. All arrays are read-only: DataLoader
+    workers share them with the parent process instead of touching
+    reference counts of millions of small Python objects.
+    """
+
+    def __init__(self, *,
+                 image_ids, file_names, flickr_urls, widths, heights, offsets,
+                 pyramid_offsets, pyramid_file_names, pyramid_widths, pyramid_heights,
+                 ann_ids, category_ids, species_ids, iscrowd, bboxes, areas, num_keypoints,
+                 keypoints, has_keypoints):
+        # images
+        self.image_ids = image_ids
+        self.file_names = file_names
+        self.flickr_urls = flickr_urls
+        self.widths = widths
+        self.heights = heights
+        self.offsets = offsets
+
+        # pre-resized images of voc_to_coco --pyramid, image row i owns
+        # pyramid_offsets[i] to pyramid_offsets[i + 1]
+        self.pyramid_offsets = pyramid_offsets
+        self.pyramid_file_names = pyramid_file_names
+        self.pyramid_widths = pyramid_widths
+        self.pyramid_heights = pyramid_heights
+
+        # annotations
+        self.ann_ids = ann_ids
+        self.category_ids = category_ids
+        self.species_ids = species_ids
+        self.iscrowd = iscrowd
+        self.bboxes = bboxes
+        self.areas = areas
+        self.num_keypoints = num_keypoints
+        self.keypoints = keypoints
+        self.has_keypoints = has_keypoints
+
+        for array in self.arrays().values():
+            array.flags.writeable = False
+
+    def arrays(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_coco(cls, coco, category_ids=None):
+        """Build the store from a pycocotools COCO object.
+
+        Only annotations of the given categories are kept (all if empty).
+        Within an image, annotations stay in file order. Annotations without
+        a species_id (written by voc_to_coco) use their category_id instead.
+        Every annotation is resolved by its id like with
+        coco.loadAnns(coco.getAnnIds(...)), so annotations that share an id
+        all become copies of the last annotation with that id.
+        """
+        images = sorted(coco.imgs.values(), key=lambda image: image['id'])
+        image_ids = np.array([image['id'] for image in images], dtype=np.int64)
+        levels = [image.get('pyramid', []) for image in images]
+        flat_levels = [level for image_levels in levels for level in image_levels]
+
+        anns = coco.dataset.get('annotations', [])
+        if category_ids:
+            anns = [ann for ann in anns if ann['category_id'] in category_ids]
+        ann_image_ids = [ann['image_id'] for ann in anns]
+        resolved = [coco.anns[ann['id']] for ann in anns]
+        n_replaced = sum(ann is not resolved_ann for ann, resolved_ann in zip(anns, resolved))
+        if n_replaced:
+            LOG.warning('%d annotations share their id with a later annotation and are replaced by it '
+                        'as in pycocotools, convert the file again with voc_to_coco for unique ids',
+                        n_replaced)
+        anns = resolved
+        n_keypoints = max((len(ann['keypoints']) // 3 for ann in anns if 'keypoints' in ann),
+                          default=len(ANIMAL_KEYPOINTS))
+
+        image_rows = np.searchsorted(image_ids, ann_image_ids)
+        order = np.argsort(image_rows, kind='stable')
+        anns = [anns[i] for i in order]
+        counts = np.bincount(image_rows, minlength=len(image_ids))
+
+        keypoints = np.zeros((len(anns), n_keypoints, 3), dtype=np.float32)
+        bboxes = np.full((len(anns), 4), np.nan, dtype=np.float32)
+        for i, ann in enumerate(anns):
+            if 'keypoints' in ann:
+                keypoints[i] = np.asarray(ann['keypoints'], dtype=np.float32).reshape(-1, 3)
+            if 'bbox' in ann:
+                bboxes[i] = ann['bbox']
+
+        return cls(
+            image_ids=image_ids,
+            file_names=np.array([image['file_name'] for image in images], dtype=np.str_),
+            flickr_urls=np.array([image.get('flickr_url', '') for image in images], dtype=np.str_),
+            widths=np.array([image.get('width', 0) for image in images], dtype=np.int32),
+            heights=np.array([image.get('height', 0) for image in images], dtype=np.int32),
+            offsets=np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+            pyramid_offsets=np.concatenate(([0], np.cumsum([len(l) for l in levels]))).astype(np.int64),
+            pyramid_file_names=np.array([level['file_name'] for level in flat_levels], dtype=np.str_),
+            pyramid_widths=np.array([level['width'] for level in flat_levels], dtype=np.int32),
+            pyramid_heights=np.array([level['height'] for level in flat_levels], dtype=np.int32),
+            ann_ids=np.array([ann['id'] for ann in anns], dtype=np.int64),
+            category_ids=np.array([ann['category_id'] for ann in anns], dtype=np.int64),
+            species_ids=np.array([ann.get('species_id', ann['category_id']) for ann in anns],
+                                 dtype=np.int64),
+            iscrowd=np.array([ann.get('iscrowd', 0) for ann in anns], dtype=np.uint8),
+            bboxes=bboxes,
+            areas=np.array([ann.get('area', np.nan) for ann in anns], dtype=np.float64),
+            num_keypoints=np.array([ann.get('num_keypoints', -1) for ann in anns], dtype=np.int32),
+            keypoints=keypoints,
+            has_keypoints=np.array(['keypoints' in ann for ann in anns], dtype=bool),
+        )
+
+    def save(self, file_name, **extra_arrays):
+        """Write all arrays to an uncompressed npz file.
+
+        The file is written to a temporary name first and then renamed so
+        that concurrent jobs never read a partial cache.
+        """
+        tmp_file_name = '{}.{}.tmp'.format(file_name, os.getpid())
+        with open(tmp_file_name, 'wb') as f:
+            np.savez(f, **self.arrays(), **extra_arrays)
+        os.replace(tmp_file_name, file_name)
+
+    @classmethod
+    def load(cls, file_name, extra_keys=()):
+        with np.load(file_name, allow_pickle=False) as data:
+            store = cls(**{k: data[k] for k in data.files if k not in extra_keys})
+            extra = [data[k] for k in extra_keys]
+        return store, extra
+
+    def __len__(self):
+        return len(self.ann_ids)
+
+    def row(self, image_id):
+        row = int(np.searchsorted(self.image_ids, image_id))
+        if row >= len(self.image_ids) or self.image_ids[row] != image_id:
+            raise KeyError(image_id)
+        return row
+
+    def rows(self, image_ids):
+        """Vectorized row lookup for image ids that are known to exist."""
+        return np.searchsorted(self.image_ids, np.asarray(image_ids, dtype=np.int64))
+
+    def annotation_image_rows(self):
+        """Image row of every annotation."""
+        return np.repeat(np.arange(len(self.image_ids)), np.diff(self.offsets))
+
+    def image_info(self, image_id):
+        row = self.row(image_id)
+        info = {
+            'id': image_id,
+            'file_name': str(self.file_names[row]),
+            'width': int(self.widths[row]),
+            'height': int(self.heights[row]),
+        }
+        if self.flickr_urls[row]:
+            info['flickr_url'] = str(self.flickr_urls[row])
+        levels = range(self.pyramid_offsets[row], self.pyramid_offsets[row + 1])
+        if levels:
+            info['pyramid'] = [{
+                'file_name': str(self.pyramid_file_names[i]),
+                'width': int(self.pyramid_widths[i]),
+                'height': int(self.pyramid_heights[i]),
+            } for i in levels]
+        return info
+
+    def annotations(self, image_id):
+        """Fresh annotation dicts for one image built from array slices."""
+        row = self.row(image_id)
+        return [self._annotation(i, image_id)
+                for i in range(self.offsets[row], self.offsets[row + 1])]
+
+    def _annotation(self, i, image_id):
+        ann = {
+            'id': int(self.ann_ids[i]),
+            'image_id': image_id,
+            'category_id': int(self.category_ids[i]),
+            'iscrowd': int(self.iscrowd[i]),
+        }
+        if self.has_keypoints[i]:
+            ann['keypoints'] = self.keypoints[i].flatten()
+        if not np.isnan(self.bboxes[i, 0]):
+            ann['bbox'] = self.bboxes[i].copy()
+        if not np.isnan(self.areas[i]):
+            ann['area'] = float(self.areas[i])
+        if self.num_keypoints[i] >= 0:
+            ann['num_keypoints'] = int(self.num_keypoints[i])
+        return ann
+
+
+def cache_file_name(ann_file, **config):
+    """Cache file next to ann_file keyed by its content and the given config."""
+    content_hash = hashlib.sha1()
+    with open(ann_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            content_hash.update(chunk)
+
+    key = hashlib.sha1()
+    key.update(content_hash.digest())
+    key.update(json.dumps(dict(config, version=CACHE_VERSION), sort_keys=True).encode())
+    return '{}.cache-{}.npz'.format(ann_file, key.hexdigest()[:16])
+
+
+def load_coco(ann_file):
+    """pycocotools COCO object of a json file that may be gzip compressed."""
+    from pycocotools.coco import COCO  # pylint: disable=import-outside-toplevel
+    if not ann_file.endswith('.gz'):
+        return COCO(ann_file)
+
+    LOG.info('loading gzip compressed annotations %s', ann_file)
+    coco = COCO()
+    with gzip.open(ann_file, 'rt', encoding='utf-8') as f:
+        coco.dataset = json.load(f)
+    coco.createIndex()
+    return coco
+
+
+def resident_bytes():
+    """Current resident memory of this process, the peak where unavailable."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class CocoIndex:
+    """Parse every annotation file at most once and share the COCO object.
+
+    Files are keyed by path, size and modification time, so a rewritten
+    file is parsed again. Parse time and the growth of the resident memory
+    are logged.
+    """
+
+    def __init__(self):
+        self.cocos = {}
+
+    def __call__(self, ann_file):
+        stat = os.stat(ann_file)
+        key = (os.path.abspath(ann_file), stat.st_size, stat.st_mtime_ns)
+        if key not in self.cocos:
+            start = time.perf_counter()
+            memory_before = resident_bytes()
+            coco = load_coco(ann_file)
+            LOG.info('annotation index %s: %d images, %d annotations, %.0f MB file, '
+                     'parsed in %.1fs, resident memory +%.0f MB',
+                     ann_file, len(coco.imgs), len(coco.anns), stat.st_size / 1e6,
+                     time.perf_counter() - start, (resident_bytes() - memory_before) / 1e6)
+            self.cocos[key] = coco
+        else:
+            LOG.info('reusing annotation index of %s', ann_file)
+        return self.cocos[key]
+
+    def clear(self):
+        self.cocos.clear()
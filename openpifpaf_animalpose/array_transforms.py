@@ -0,0 +1,182 @@
+"""
+Training augmentation on a single HxWx3 uint8 NumPy array.
+
+Counterparts of the PIL based transforms of AnimalKp._preprocess. They draw
+the same random numbers in the same order and update annotations and meta
+with the same code or arithmetic, so annotation outputs are identical.
+The color augmentation goes through the PIL path of torchvision. Flips are array views, the rescale and the crop are one
+interpolation of the crop window and the image only becomes a float tensor
+in the final normalization.
+"""
+
+import io
+
+import numpy as np
+import PIL
+import scipy.ndimage
+import torch
+import torchvision
+
+from openpifpaf import transforms
+
+from . import rescale_crop
+
+
+class ImageSize:
+    """Stand-in for a PIL image in the annotation code of openpifpaf transforms."""
+
+    def __init__(self, width, height, pixels=None):
+        self.size = (width, height)
+        self.pixels = pixels
+
+    @classmethod
+    def of(cls, image, *, with_pixels=False):
+        return cls(image.shape[1], image.shape[0], image if with_pixels else None)
+
+    def transpose(self, _):
+        return self
+
+    def __array__(self, dtype=None, copy=None):
+        return self.pixels
+
+
+class ToArray(transforms.Preprocess):
+    """Decoded PIL image to a writable uint8 array."""
+
+    def __call__(self, image, anns, meta):
+        return np.array(image.convert('RGB'), dtype=np.uint8), anns, meta
+
+
+class NormalizeAnnotations(transforms.NormalizeAnnotations):
+    def __call__(self, image, anns, meta):
+        _, anns, meta = super().__call__(ImageSize.of(image), anns, meta)
+        return image, anns, meta
+
+
+class HFlip(transforms.HFlip):
+    def __call__(self, image, anns, meta):
+        _, anns, meta = super().__call__(ImageSize.of(image), anns, meta)
+        return image[:, ::-1], anns, meta
+
+
+class ScaledArray(rescale_crop.ScaledImage):
+    def crop(self, ltrb):
+        # the column gather of crop_pixels() leaves the rows strided, the
+        # later steps are faster on a C-contiguous array
+        pixels = np.ascontiguousarray(self.crop_pixels(ltrb))
+        return ImageSize(pixels.shape[1], pixels.shape[0], pixels)
+
+
+class RescaleRelativeCrop(rescale_crop.RescaleRelativeCrop):
+    scaled_image_class = ScaledArray
+
+    def __call__(self, image, anns, meta):
+        cropped, anns, meta = super().__call__(image, anns, meta)
+        return cropped.pixels, anns, meta
+
+
+class Blur(transforms.Blur):
+    def __call__(self, image, anns, meta):
+        sigma = self.max_sigma * float(torch.rand(1).item())
+        image = scipy.ndimage.gaussian_filter(image, sigma=(sigma, sigma, 0))
+        return image, anns, meta
+
+
+class CenterPad(transforms.CenterPad):
+    def center_pad(self, image, anns):
+        h, w = image.shape[:2]
+
+        left = int((self.target_size[0] - w) / 2.0)
+        top = int((self.target_size[1] - h) / 2.0)
+        left = max(0, left)
+        top = max(0, top)
+
+        right = self.target_size[0] - w - left
+        bottom = self.target_size[1] - h - top
+        right = max(0, right)
+        bottom = max(0, bottom)
+        ltrb = (left, top, right, bottom)
+
+        # pad image
+        fill_value = int(torch.randint(0, 255, (1,)).item())
+        padded = np.full((top + h + bottom, left + w + right, 3), fill_value, dtype=np.uint8)
+        padded[top:top + h, left:left + w] = image
+
+        # pad annotations
+        for ann in anns:
+            ann['keypoints'][:, 0] += ltrb[0]
+            ann['keypoints'][:, 1] += ltrb[1]
+            ann['bbox'][0] += ltrb[0]
+            ann['bbox'][1] += ltrb[1]
+
+        return padded, anns, ltrb
+
+
+class RotateBy90(transforms.RotateBy90):
+    def __call__(self, image, anns, meta):
+        # openpifpaf.transforms.rotate.rotate() works on the pixels of np.asarray(image)
+        rotated, anns, meta = super().__call__(ImageSize.of(image, with_pixels=True), anns, meta)
+        if isinstance(rotated, ImageSize):
+            return image, anns, meta
+        return np.array(rotated), anns, meta
+
+
+class JpegCompression(transforms.JpegCompression):
+    def __call__(self, image, anns, meta):
+        f = io.BytesIO()
+        PIL.Image.fromarray(np.ascontiguousarray(image)).save(f, 'jpeg', quality=self.quality)
+        return np.array(PIL.Image.open(f)), anns, meta
+
+
+def chw_tensor(image):
+    """uint8 CHW tensor that shares memory with an HWC array."""
+    return torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1)
+
+
+class ColorJitter(torchvision.transforms.ColorJitter):
+    """ColorJitter of torchvision on arrays.
+
+    The uint8 enhancements of PIL round after every adjustment and shift
+    the hue in HSV space. Re-implemented in NumPy they are slower, so the
+    array goes through the PIL path of torchvision and the colors stay
+    identical.
+    """
+
+    def forward(self, img):
+        return np.array(super().forward(PIL.Image.fromarray(np.ascontiguousarray(img))))
+
+
+class RandomGrayscale(torchvision.transforms.RandomGrayscale):
+    def forward(self, img):
+        if torch.rand(1) < self.p:
+            gray = np.asarray(PIL.Image.fromarray(np.ascontiguousarray(img)).convert('L'))
+            return np.repeat(gray[:, :, np.newaxis], 3, axis=2)
+        return img
+
+
+class ToNormalizedTensor(transforms.Preprocess):
+    """Same arithmetic as ToTensor() followed by Normalize()."""
+
+    def __init__(self):
+        self.normalize = torchvision.transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                                          std=[0.229, 0.224, 0.225])
+
+    def __call__(self, image, anns, meta):
+        image = chw_tensor(image).contiguous().to(dtype=torch.get_default_dtype()).div(255)
+        return self.normalize(image), anns, meta
+
+
+EVAL_TRANSFORM = transforms.Compose([
+    NormalizeAnnotations(),
+    ToNormalizedTensor(),
+])
+
+
+TRAIN_TRANSFORM = transforms.Compose([
+    NormalizeAnnotations(),
+    transforms.ImageTransform(ColorJitter(
+        brightness=0.4, contrast=0.1, saturation=0.4, hue=0.1)),
+    transforms.RandomApply(JpegCompression(), 0.1),
+    transforms.ImageTransform(RandomGrayscale(p=0.01)),
+    EVAL_TRANSFORM,
+])
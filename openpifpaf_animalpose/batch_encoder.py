@@ -0,0 +1,304 @@
+"""
+CIF and CAF targets of a whole batch after collation.
+
+With --animal-batch-encoding the loader workers return images with their
+transformed annotations and BatchEncoding encodes every batch in the main
+process. CifBatch and CafBatch produce exactly the targets of the
+per-sample openpifpaf encoders. Crowd masks, scales and the per-connection
+ranges of CAF are computed per annotation like there, all per-pixel work
+is vectorized over the batch. Pixels claimed by several keypoints or
+connections are resolved in fill order with the comparison of the
+sequential fill.
+"""
+
+import functools
+import logging
+
+import numpy as np
+import torch
+
+from openpifpaf import encoder
+from openpifpaf.utils import create_sink, mask_valid_area
+
+LOG = logging.getLogger(__name__)
+
+
+def sequential_fill(keys, values, thresholds, *, ties_replace):
+    """Candidate indices that remain after filling keys in candidate order.
+
+    A candidate replaces the current value of its key if its value is
+    smaller, or equal with ties_replace. The current value starts at the
+    threshold of the key and is stored as float32 like the reg_l fields.
+    """
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    new_group = np.ones(len(keys), dtype=bool)
+    new_group[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    group = np.cumsum(new_group) - 1
+    starts = np.flatnonzero(new_group)
+    rank = np.arange(len(keys)) - starts[group]
+
+    current = thresholds[order[starts]].astype(np.float32)
+    winner = np.full(len(starts), -1, dtype=np.int64)
+    for r in range(int(rank.max()) + 1 if len(keys) else 0):
+        candidates = order[rank == r]
+        g = group[rank == r]
+        v = values[candidates]
+        update = v <= current[g] if ties_replace else v < current[g]
+        current[g[update]] = v[update]
+        winner[g[update]] = candidates[update]
+    return winner[winner >= 0]
+
+
+def mask_fields(fields, rescaler, metas):
+    """Valid area masking of (batch, field, channel, h, w) targets."""
+    for sample_fields, meta in zip(fields, metas):
+        valid_area = rescaler.valid_area(meta)
+        mask_valid_area(sample_fields[:, 0], valid_area)
+        for c in range(1, sample_fields.shape[1]):
+            mask_valid_area(sample_fields[:, c], valid_area, fill_value=np.nan)
+
+
+class CifBatch:
+    """Batch version of encoder.Cif."""
+
+    def __init__(self, config: encoder.Cif):
+        self.config = config
+        self.meta = config.meta
+
+    def __call__(self, width_height, anns_batch, metas):
+        config = self.config
+        rescaler = config.rescaler or encoder.AnnRescaler(config.meta.stride, config.meta.pose)
+        side = config.side_length
+        s_offset = (side - 1.0) / 2.0
+        n_fields = len(config.meta.keypoints)
+        sigmas = None if config.meta.sigmas is None else np.asarray(config.meta.sigmas)
+
+        fields, thresholds = None, None
+        batch_i, field_i, xy, scales = [], [], [], []
+        for b, anns in enumerate(anns_batch):
+            bg_mask = rescaler.bg_mask(anns, width_height, crowd_margin=(side - 1) / 2)
+            if fields is None:
+                fields = np.full((len(anns_batch), n_fields, 5) + bg_mask.shape, np.nan, dtype=np.float32)
+                fields[:, :, 0] = 0.0
+                thresholds = np.full((len(anns_batch),) + bg_mask.shape, np.inf, dtype=np.float32)
+            thresholds[b][bg_mask == 0] = 1.0
+            fields[b, :, 0][:, bg_mask == 0] = np.nan
+
+            for keypoints in rescaler.keypoint_sets(anns):
+                scale = rescaler.scale(keypoints)
+                visible = np.flatnonzero(keypoints[:, 2] > config.v_threshold)
+                batch_i.append(np.full(len(visible), b))
+                field_i.append(visible)
+                xy.append(keypoints[visible, :2])
+                scales.append(np.broadcast_to(scale if sigmas is None else scale * sigmas[visible],
+                                              (len(visible),)))
+
+        if batch_i:
+            self.fill(fields, thresholds, np.concatenate(batch_i), np.concatenate(field_i),
+                      np.concatenate(xy), np.concatenate(scales), s_offset)
+        mask_fields(fields, rescaler, metas)
+        return torch.from_numpy(fields)
+
+    def fill(self, fields, thresholds, batch_i, field_i, xy, scales, s_offset):
+        side, padding = self.config.side_length, self.config.padding
+        _, n_fields, _, field_h, field_w = fields.shape
+
+        # keypoints whose patch is inside the padded field
+        ij = np.round(xy - s_offset).astype(np.int64) + padding
+        inside = np.all(ij >= 0, axis=1) \
+            & (ij[:, 0] + side <= field_w + 2 * padding) \
+            & (ij[:, 1] + side <= field_h + 2 * padding)
+        batch_i, field_i, xy, scales, ij = batch_i[inside], field_i[inside], xy[inside], scales[inside], ij[inside]
+        assert np.all(np.isnan(scales) | ((scales > 0.0) & (scales < 100.0)))
+
+        offset = xy - (ij + s_offset - padding)
+        sink_reg = create_sink(side)[np.newaxis] + offset[:, :, np.newaxis, np.newaxis]
+        sink_l = np.linalg.norm(sink_reg, axis=1)
+
+        # one candidate per keypoint and patch pixel, in fill order
+        patch = np.arange(side)
+        y = np.broadcast_to(ij[:, 1, None, None] - padding + patch[:, None], sink_l.shape).reshape(-1)
+        x = np.broadcast_to(ij[:, 0, None, None] - padding + patch[None, :], sink_l.shape).reshape(-1)
+        candidate_keypoint = np.repeat(np.arange(len(ij)), side * side)
+        reg_x = sink_reg[:, 0].reshape(-1)
+        reg_y = sink_reg[:, 1].reshape(-1)
+        sink_l = sink_l.reshape(-1)
+
+        in_field = (x >= 0) & (x < field_w) & (y >= 0) & (y < field_h)
+        candidates = np.flatnonzero(in_field)
+        k = candidate_keypoint[candidates]
+        b, f = batch_i[k], field_i[k]
+        yc, xc = y[candidates], x[candidates]
+        keys = ((b * n_fields + f) * field_h + yc) * field_w + xc
+        winners = sequential_fill(keys, sink_l[candidates], thresholds[b, yc, xc], ties_replace=False)
+
+        c = candidates[winners]
+        b, f, yc, xc = b[winners], f[winners], yc[winners], xc[winners]
+        fields[b, f, 0, yc, xc] = 1.0
+        fields[b, f, 1, yc, xc] = reg_x[c]
+        fields[b, f, 2, yc, xc] = reg_y[c]
+        fields[b, f, 3, yc, xc] = self.config.bmin / self.config.meta.stride
+        fields[b, f, 4, yc, xc] = scales[candidate_keypoint[c]]
+
+
+class CafBatch:
+    """Batch version of encoder.Caf."""
+
+    def __init__(self, config: encoder.Caf):
+        assert getattr(config.meta, 'sparse_skeleton', None) is None
+        self.config = config
+        self.meta = config.meta
+
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def association_grid(s):
+        return np.stack(np.meshgrid(
+            np.linspace(-0.5 * (s - 1), 0.5 * (s - 1), s),
+            np.linspace(-0.5 * (s - 1), 0.5 * (s - 1), s),
+        ), axis=-1).reshape(-1, 2)
+
+    def __call__(self, width_height, anns_batch, metas):
+        config = self.config
+        rescaler = config.rescaler
+        n_fields = config.meta.n_fields
+        sigmas = config.meta.sigmas
+
+        fields, thresholds = None, None
+        associations = []
+        for b, anns in enumerate(anns_batch):
+            bg_mask = rescaler.bg_mask(anns, width_height, crowd_margin=(config.min_size - 1) / 2)
+            if fields is None:
+                fields = np.full((len(anns_batch), n_fields, 9) + bg_mask.shape, np.nan, dtype=np.float32)
+                fields[:, :, 0] = 0.0
+                thresholds = np.full((len(anns_batch),) + bg_mask.shape, np.inf, dtype=np.float32)
+            thresholds[b][bg_mask == 0] = 1.0
+            fields[b, :, 0][:, bg_mask == 0] = np.nan
+            field_h, field_w = bg_mask.shape
+
+            for keypoints in rescaler.keypoint_sets(anns):
+                scale = rescaler.scale(keypoints)
+                for field_i, joint1i, joint2i in config.fill_plan:
+                    joint1 = keypoints[joint1i]
+                    joint2 = keypoints[joint2i]
+                    if joint1[2] <= config.v_threshold or joint2[2] <= config.v_threshold:
+                        continue
+
+                    out_field_of_view_1 = (joint1[0] < 0 or joint1[1] < 0
+                                           or joint1[0] > field_w - 1 or joint1[1] > field_h - 1)
+                    out_field_of_view_2 = (joint2[0] < 0 or joint2[1] < 0
+                                           or joint2[0] > field_w - 1 or joint2[1] > field_h - 1)
+                    if out_field_of_view_1 and out_field_of_view_2:
+                        continue
+                    if config.meta.only_in_field_of_view:
+                        if out_field_of_view_1 or out_field_of_view_2:
+                            continue
+
+                    if sigmas is None:
+                        scale1, scale2 = scale, scale
+                    else:
+                        scale1 = scale * sigmas[joint1i]
+                        scale2 = scale * sigmas[joint2i]
+                    assert np.isnan(scale1) or 0.0 < scale1 < 100.0
+                    assert np.isnan(scale2) or 0.0 < scale2 < 100.0
+                    associations.append((b, field_i, joint1, joint2, scale1, scale2))
+
+        if associations:
+            self.fill(fields, thresholds, associations)
+        mask_fields(fields, rescaler, metas)
+        return torch.from_numpy(fields)
+
+    def association_pixels(self, joint1, joint2):
+        """Padded field pixels of one association and its line distance denominator."""
+        config = self.config
+        offset = joint2[:2] - joint1[:2]
+        offset_d = np.linalg.norm(offset)
+
+        s = max(config.min_size, int(offset_d * config.aspect_ratio))
+        num = max(2, int(np.ceil(offset_d)))
+        fmargin = (s / 2) / (offset_d + np.spacing(1))
+        fmargin = np.clip(fmargin, 0.25, 0.4)
+        frange = np.linspace(fmargin, 1.0 - fmargin, num=num)
+        if config.fixed_size:
+            frange = np.array([0.5])
+
+        # same dtype as the scalar products of the per-pixel loop in encoder.Caf
+        frange = frange.astype((frange[0] * offset).dtype)
+        fij = np.round(joint1[:2] + frange[:, np.newaxis, np.newaxis] * offset
+                       + self.association_grid(s)).astype(np.int64) + config.padding
+        return fij.reshape(-1, 2), offset, offset_d + 0.01
+
+    def fill(self, fields, thresholds, associations):
+        padding = self.config.padding
+        _, n_fields, _, field_h, field_w = fields.shape
+        padded_h, padded_w = field_h + 2 * padding, field_w + 2 * padding
+
+        pixels = [self.association_pixels(joint1, joint2) for _, _, joint1, joint2, _, _ in associations]
+        n_pixels = [len(fij) for fij, _, _ in pixels]
+        association_i = np.repeat(np.arange(len(associations)), n_pixels)
+        fij = np.concatenate([fij for fij, _, _ in pixels])
+
+        # every pixel once per association, in fill order
+        in_padded = (fij[:, 0] >= 0) & (fij[:, 0] < padded_w) & (fij[:, 1] >= 0) & (fij[:, 1] < padded_h)
+        unique_keys = np.unique((association_i[in_padded] * padded_h + fij[in_padded, 1]) * padded_w
+                                + fij[in_padded, 0])
+        a = unique_keys // (padded_h * padded_w)
+        fxy = np.stack((unique_keys % padded_w, unique_keys // padded_w % padded_h), axis=1) - padding
+        in_field = (fxy[:, 0] >= 0) & (fxy[:, 0] < field_w) & (fxy[:, 1] >= 0) & (fxy[:, 1] < field_h)
+        a, fxy = a[in_field], fxy[in_field]
+
+        b = np.array([association[0] for association in associations])[a]
+        f = np.array([association[1] for association in associations])[a]
+        joint1 = np.stack([association[2] for association in associations])[a]
+        joint2 = np.stack([association[3] for association in associations])[a]
+        offset = np.stack([offset for _, offset, _ in pixels])[a]
+        denominator = np.array([denominator for _, _, denominator in pixels], dtype=np.float64)[a]
+
+        f_offset = fxy - joint1[:, :2]
+        sink_l = np.fabs(offset[:, 1] * f_offset[:, 0] - offset[:, 0] * f_offset[:, 1]) / denominator
+        x, y = fxy[:, 0], fxy[:, 1]
+        keys = ((b * n_fields + f) * field_h + y) * field_w + x
+        winners = sequential_fill(keys, sink_l, thresholds[b, y, x], ties_replace=True)
+
+        b, f, x, y = b[winners], f[winners], x[winners], y[winners]
+        reg1 = joint1[winners, :2] - fxy[winners]
+        reg2 = joint2[winners, :2] - fxy[winners]
+        fields[b, f, 0, y, x] = 1.0
+        fields[b, f, 1, y, x] = reg1[:, 0]
+        fields[b, f, 2, y, x] = reg1[:, 1]
+        fields[b, f, 3, y, x] = reg2[:, 0]
+        fields[b, f, 4, y, x] = reg2[:, 1]
+        fields[b, f, 5, y, x] = self.config.bmin / self.config.meta.stride
+        fields[b, f, 6, y, x] = self.config.bmin / self.config.meta.stride
+        fields[b, f, 7, y, x] = np.array([association[4] for association in associations])[a[winners]]
+        fields[b, f, 8, y, x] = np.array([association[5] for association in associations])[a[winners]]
+
+
+class BatchEncoding:
+    """DataLoader of (images, anns, metas) batches that yields (images, targets, metas)."""
+
+    def __init__(self, loader: torch.utils.data.DataLoader, encoders):
+        self.loader = loader
+        self.configs = encoders
+        self.encoders = [
+            CifBatch(enc) if isinstance(enc, encoder.Cif) else CafBatch(enc)
+            for enc in encoders
+        ]
+
+    def __getattr__(self, name):
+        # sampler, dataset, batch_size, ... of the wrapped loader
+        return getattr(self.loader, name)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def with_loader(self, loader):
+        return BatchEncoding(loader, self.configs)
+
+    def __iter__(self):
+        for images, anns_batch, metas in self.loader:
+            width_height = (images.shape[-1], images.shape[-2])
+            targets = [enc(width_height, anns_batch, metas) for enc in self.encoders]
+            for meta in metas:
+                meta['head_indices'] = [enc.meta.head_index for enc in self.encoders]
+            yield images, targets, metas
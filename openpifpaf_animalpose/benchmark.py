@@ -0,0 +1,759 @@
+"""
+Benchmarks for the data loading code of the Animal dataset.
+
+annotations: time the annotation filter and the class aware sample weights
+on a synthetic annotation file against the reference implementation based
+on per-image pycocotools lookups.
+
+shards: random access throughput of images read from a directory against
+images read from packed shards. Run it with --dir on the filesystem of the
+training data. Freshly written files may still be in the page cache, drop it
+between writing and reading to measure cold reads.
+
+transforms: per-transform throughput of the PIL based training augmentation
+against the uint8 array augmentation of --animal-array-transforms with the
+same random numbers. Also checks that annotations and meta are identical.
+
+encoders: per-sample CIF/CAF encoders against the batch encoders of
+--animal-batch-encoding on synthetic annotations with overlapping animals,
+crowds and keypoints outside of the image. Also checks that the targets
+are identical.
+
+targets: pickled size and transport time of dense targets against the
+sparse targets of --animal-sparse-targets on the same synthetic
+annotations. Also checks that the densified targets are bitwise identical.
+
+eval-padding: batched evaluation with square padding to eval_long_edge
+against the aspect ratio buckets of --animal-eval-bucketing on synthetic
+images of random aspect ratios. Checks that every bucketed image equals its
+batch size 1 input and times the forward pass of an untrained network.
+
+metric: metric.Coco with pycocotools against the incremental OksCoco of
+--animal-vectorized-metric on synthetic ground truth with crowds, animals
+without visible keypoints, all area ranges and noisy predictions with tied
+scores. Checks that all stats agree within 1e-6.
+
+eval-cache: passes over the eval loader without a cache, while creating the
+cache of --animal-eval-cache-dir and reading from it on synthetic images.
+Checks that images, annotations and metas read from the cache are identical.
+
+eval-shards: the predictions of --animal-eval-shard written per shard and
+merged against a single evaluation of all images, with metric.Coco and
+OksCoco on the synthetic data of the metric benchmark. Checks identical stats.
+"""
+
+import argparse
+from collections import defaultdict
+import contextlib
+import copy
+import io
+import json
+import os
+import pickle
+import tempfile
+import time
+
+import numpy as np
+import openpifpaf
+from PIL import Image
+import torch
+
+from .constants import ANIMAL_KEYPOINTS, ANIMAL_SIGMAS, ANIMAL_SKELETON
+from .dataloader import Animal
+from .image_shards import ImageShards, write_shards
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    annotations_parser = subparsers.add_parser('annotations')
+    annotations_parser.add_argument('--n-annotations', default=1000000, type=int,
+                                    help='number of synthetic annotations')
+    annotations_parser.add_argument('--n-categories', default=5, type=int)
+    annotations_parser.add_argument('--min-kp-anns', default=1, type=int)
+    annotations_parser.add_argument('--seed', default=1, type=int)
+
+    shards_parser = subparsers.add_parser('shards')
+    shards_parser.add_argument('--n-images', default=2000, type=int,
+                               help='number of synthetic images')
+    shards_parser.add_argument('--image-dir', default=None,
+                               help='use the images in this directory instead of synthetic ones')
+    shards_parser.add_argument('--dir', default=None,
+                               help='directory for the files of the benchmark (default: system temp)')
+    shards_parser.add_argument('--n-reads', default=2000, type=int,
+                               help='number of random reads per repeat')
+    shards_parser.add_argument('--repeats', default=2, type=int)
+    shards_parser.add_argument('--decode', default=False, action='store_true',
+                               help='also decode the images')
+    shards_parser.add_argument('--seed', default=1, type=int)
+
+    transforms_parser = subparsers.add_parser('transforms')
+    transforms_parser.add_argument('--n-images', default=50, type=int,
+                                   help='number of synthetic images')
+    transforms_parser.add_argument('--repeats', default=4, type=int)
+    transforms_parser.add_argument('--square-edge', default=513, type=int)
+    transforms_parser.add_argument('--blur', default=0.3, type=float)
+    transforms_parser.add_argument('--orientation-invariant', default=0.3, type=float)
+
+    encoders_parser = subparsers.add_parser('encoders')
+    encoders_parser.add_argument('--n-batches', default=20, type=int)
+    encoders_parser.add_argument('--batch-size', default=8, type=int)
+    encoders_parser.add_argument('--square-edge', default=513, type=int)
+    encoders_parser.add_argument('--seed', default=1, type=int)
+
+    targets_parser = subparsers.add_parser('targets')
+    targets_parser.add_argument('--n-batches', default=20, type=int)
+    targets_parser.add_argument('--batch-size', default=8, type=int)
+    targets_parser.add_argument('--square-edge', default=513, type=int)
+    targets_parser.add_argument('--seed', default=1, type=int)
+
+    eval_padding_parser = subparsers.add_parser('eval-padding')
+    eval_padding_parser.add_argument('--n-images', default=64, type=int)
+    eval_padding_parser.add_argument('--batch-size', default=8, type=int)
+    eval_padding_parser.add_argument('--long-edge', default=385, type=int)
+    eval_padding_parser.add_argument('--basenet', default='shufflenetv2k16')
+    eval_padding_parser.add_argument('--seed', default=1, type=int)
+
+    metric_parser = subparsers.add_parser('metric')
+    metric_parser.add_argument('--n-images', default=500, type=int)
+    metric_parser.add_argument('--seed', default=1, type=int)
+
+    eval_cache_parser = subparsers.add_parser('eval-cache')
+    eval_cache_parser.add_argument('--n-images', default=200, type=int)
+    eval_cache_parser.add_argument('--batch-size', default=8, type=int)
+    eval_cache_parser.add_argument('--long-edge', default=641, type=int)
+    eval_cache_parser.add_argument('--uint8-transport', default=False, action='store_true')
+    eval_cache_parser.add_argument('--seed', default=1, type=int)
+
+    eval_shards_parser = subparsers.add_parser('eval-shards')
+    eval_shards_parser.add_argument('--n-images', default=500, type=int)
+    eval_shards_parser.add_argument('--n-shards', default=4, type=int)
+    eval_shards_parser.add_argument('--seed', default=1, type=int)
+    args = parser.parse_args()
+    return args
+
+
+def synthetic_annotations(file_name, n_annotations, *, n_categories=5, seed=1):
+    """Write a COCO keypoint file with on average 1.5 annotations per image."""
+    rnd = np.random.default_rng(seed)
+    n_images = max(1, int(n_annotations / 1.5))
+    n_keypoints = len(ANIMAL_KEYPOINTS)
+
+    image_ids = rnd.integers(1, n_images + 1, size=n_annotations)
+    category_ids = rnd.integers(1, n_categories + 1, size=n_annotations)
+    iscrowd = rnd.random(n_annotations) < 0.02
+    keypoints = rnd.integers(0, 500, size=(n_annotations, n_keypoints, 3))
+    keypoints[:, :, 2] = 2 * (rnd.random((n_annotations, n_keypoints)) < 0.3)
+
+    with open(file_name, 'w') as f:
+        json.dump({
+            'images': [{'id': i, 'file_name': '{}.jpg'.format(i), 'width': 640, 'height': 480}
+                       for i in range(1, n_images + 1)],
+            'annotations': [{
+                'id': i + 1,
+                'image_id': int(image_ids[i]),
+                'category_id': int(category_ids[i]),
+                'iscrowd': int(iscrowd[i]),
+                'bbox': [0, 0, 100, 100],
+                'keypoints': keypoints[i].reshape(-1).tolist(),
+            } for i in range(n_annotations)],
+            'categories': [{'id': i, 'name': str(i)} for i in range(1, n_categories + 1)],
+        }, f)
+
+
+def reference_filter(coco, ids, category_ids, min_kp_anns):
+    def filter_image(image_id):
+        ann_ids = coco.getAnnIds(imgIds=image_id, catIds=category_ids)
+        anns = coco.loadAnns(ann_ids)
+        anns = [ann for ann in anns if not ann.get('iscrowd')]
+        if not anns:
+            return False
+        kp_anns = [ann for ann in anns
+                   if 'keypoints' in ann and any(v > 0.0 for v in ann['keypoints'][2::3])]
+        return len(kp_anns) >= min_kp_anns
+
+    return [image_id for image_id in ids if filter_image(image_id)]
+
+
+def reference_weights(coco, ids, category_ids, max_multiple=10.0):
+    ann_ids = coco.getAnnIds(imgIds=ids, catIds=category_ids)
+    anns = coco.loadAnns(ann_ids)
+
+    category_image_counts = defaultdict(int)
+    image_categories = defaultdict(set)
+    for ann in anns:
+        if ann['iscrowd']:
+            continue
+        image = ann['image_id']
+        category = ann['category_id']
+        if category in image_categories[image]:
+            continue
+        image_categories[image].add(category)
+        category_image_counts[category] += 1
+
+    weights = [
+        sum(
+            1.0 / category_image_counts[category_id]
+            for category_id in image_categories[image_id]
+        )
+        for image_id in ids
+    ]
+    max_w = min(weights) * max_multiple
+    return [min(w, max_w) for w in weights]
+
+
+def timed(f, *args, **kwargs):
+    start = time.perf_counter()
+    result = f(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def annotations(args):
+    from pycocotools.coco import COCO  # pylint: disable=import-outside-toplevel
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ann_file = os.path.join(tmp_dir, 'annotations.json')
+        synthetic_annotations(ann_file, args.n_annotations,
+                              n_categories=args.n_categories, seed=args.seed)
+
+        coco = COCO(ann_file)
+        all_ids = coco.getImgIds()
+        ref_ids, ref_filter_time = timed(reference_filter, coco, all_ids, [], args.min_kp_anns)
+        ref_weights, ref_weights_time = timed(reference_weights, coco, ref_ids, [])
+        del coco
+
+        data = Animal(tmp_dir, ann_file)
+        _, filter_time = timed(data.filter_for_annotations, min_kp_anns=args.min_kp_anns)
+        weights, weights_time = timed(data.class_aware_sample_weights)
+
+    assert data.ids == ref_ids, 'filtered image ids differ'
+    assert weights == ref_weights, 'sample weights differ'
+
+    print('{} annotations, {} images after filter'.format(args.n_annotations, len(ref_ids)))
+    print('filter_for_annotations:      reference {:.3f}s, vectorized {:.3f}s ({:.0f}x)'
+          ''.format(ref_filter_time, filter_time, ref_filter_time / filter_time))
+    print('class_aware_sample_weights:  reference {:.3f}s, vectorized {:.3f}s ({:.0f}x)'
+          ''.format(ref_weights_time, weights_time, ref_weights_time / weights_time))
+
+
+def synthetic_images(image_dir, n_images, *, seed=1):
+    """Write JPEGs of smoothed noise, 640x480, and return their paths."""
+    rnd = np.random.default_rng(seed)
+    paths = []
+    for i in range(n_images):
+        pixels = rnd.integers(0, 256, size=(60, 80, 3), dtype=np.uint8)
+        image = Image.fromarray(pixels).resize((640, 480), Image.BILINEAR)
+        path = os.path.join(image_dir, '{:06d}.jpg'.format(i))
+        image.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def shards(args):
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        if args.image_dir:
+            paths = sorted(os.path.join(args.image_dir, name) for name in os.listdir(args.image_dir))
+        else:
+            paths = synthetic_images(tmp_dir, args.n_images, seed=args.seed)
+        shard_dir = os.path.join(tmp_dir, 'shards')
+        write_shards(enumerate(paths), shard_dir)
+        image_shards = ImageShards(shard_dir)
+
+        def read_file(image_id):
+            with open(paths[image_id], 'rb') as f:
+                return f.read()
+
+        def read_shard(image_id):
+            return image_shards.read(image_id)
+
+        rnd = np.random.default_rng(args.seed)
+        for repeat in range(args.repeats):
+            order = rnd.integers(0, len(paths), size=args.n_reads).tolist()
+            for name, read in (('directory', read_file), ('shards', read_shard)):
+                start = time.perf_counter()
+                n_bytes = 0
+                for image_id in order:
+                    data = read(image_id)
+                    n_bytes += len(data)
+                    if args.decode:
+                        Image.open(io.BytesIO(data)).convert('RGB')
+                duration = time.perf_counter() - start
+                print('repeat {} {:10s} {:8.0f} images/s {:8.1f} MB/s'
+                      ''.format(repeat, name, len(order) / duration, n_bytes / duration / 1e6))
+
+        sample = order[:100]
+        assert all(read_file(i) == read_shard(i) for i in sample), 'shard content differs'
+
+
+class Timed:
+    """Accumulate the run time of a transform."""
+
+    def __init__(self, transform):
+        self.transform = transform
+        self.duration = 0.0
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        result = self.transform(*args)
+        self.duration += time.perf_counter() - start
+        return result
+
+
+def with_timers(preprocess, timers):
+    """Copy of an augmentation with every step timed, without encoders.
+
+    (name, Timed) pairs are appended to timers.
+    """
+    steps = []
+    for step in preprocess.preprocess_list:
+        if step is None or isinstance(step, openpifpaf.transforms.Encoders):
+            continue
+        if isinstance(step, openpifpaf.transforms.Compose):
+            steps.append(with_timers(step, timers))
+        elif isinstance(step, openpifpaf.transforms.RandomApply):
+            timer = Timed(step.transform)
+            timers.append((type(step.transform).__name__, timer))
+            steps.append(openpifpaf.transforms.RandomApply(timer, step.probability))
+        else:
+            timer = Timed(step)
+            if isinstance(step, openpifpaf.transforms.ImageTransform):
+                timers.append((type(step.image_transform).__name__, timer))
+            else:
+                timers.append((type(step).__name__, timer))
+            steps.append(timer)
+    return openpifpaf.transforms.Compose(steps)
+
+
+def milliseconds(duration):
+    return '-' if duration is None else '{:.1f}'.format(duration * 1000.0)
+
+
+def unfused(preprocess):
+    """The augmentation with the separate RescaleRelative and Crop of openpifpaf."""
+    from .rescale_crop import RescaleRelativeCrop  # pylint: disable=import-outside-toplevel
+
+    steps = []
+    for step in preprocess.preprocess_list:
+        if isinstance(step, RescaleRelativeCrop):
+            steps += [step.rescale, step.crop]
+        else:
+            steps.append(step)
+    return openpifpaf.transforms.Compose(steps)
+
+
+def transforms(args):
+    from .animal_kp import AnimalKp  # pylint: disable=import-outside-toplevel
+
+    rnd = np.random.default_rng(1)
+    samples = []
+    for i in range(args.n_images):
+        pixels = rnd.integers(0, 256, size=(60, 80, 3), dtype=np.uint8)
+        image = Image.fromarray(pixels).resize((640, 480), Image.BILINEAR)
+        anns = [{
+            'keypoints': np.concatenate((rnd.uniform(100, 500, (len(ANIMAL_KEYPOINTS), 2)),
+                                         np.full((len(ANIMAL_KEYPOINTS), 1), 2.0)), axis=1),
+            'bbox': [100.0, 100.0, 400.0, 300.0],
+            'iscrowd': 0,
+        }]
+        samples.append((image, anns, {'image_id': i}))
+
+    AnimalKp.square_edge = args.square_edge
+    AnimalKp.blur = args.blur
+    AnimalKp.orientation_invariant = args.orientation_invariant
+    # the original PIL pipeline of openpifpaf, with the fused rescale and crop, on arrays
+    variants = ('original', 'PIL', 'array')
+    durations, total_durations, outputs = {}, {}, {}
+    for variant in variants:
+        AnimalKp.array_transforms = variant == 'array'
+        preprocess = AnimalKp()._preprocess()
+        if variant == 'original':
+            preprocess = unfused(preprocess)
+        timers = []
+        preprocess = Timed(with_timers(preprocess, timers))
+        outputs[variant] = []
+        torch.manual_seed(1)
+        for _ in range(args.repeats):
+            for image, anns, meta in samples:
+                outputs[variant].append(preprocess(image, copy.deepcopy(anns), copy.deepcopy(meta)))
+
+        durations[variant] = defaultdict(float)
+        for name, timer in timers:
+            durations[variant][name] += timer.duration
+        total_durations[variant] = preprocess.duration
+
+    for variant in variants[1:]:
+        for (_, anns_ref, meta_ref), (_, anns_other, meta_other) in zip(outputs['original'], outputs[variant]):
+            assert len(anns_ref) == len(anns_other), variant + ' annotations differ'
+            for ann_ref, ann_other in zip(anns_ref, anns_other):
+                assert np.array_equal(ann_ref['keypoints'], ann_other['keypoints']), variant + ' keypoints differ'
+                assert np.array_equal(ann_ref['bbox'], ann_other['bbox']), variant + ' bboxes differ'
+            for key in ('offset', 'scale', 'valid_area', 'hflip', 'rotation', 'width_height'):
+                assert str(meta_ref[key]) == str(meta_other[key]), '{} {} differs'.format(variant, key)
+
+    n_samples = len(outputs['original'])
+    print('{} samples, annotations and meta identical'.format(n_samples))
+    print('{:22s} {:>10s} {:>10s} {:>10s}   (ms over all samples)'.format('transform', *variants))
+    names = list(dict.fromkeys(name for variant in variants for name in durations[variant]))
+    for name in names:
+        print('{:22s} {:>10s} {:>10s} {:>10s}'.format(
+            name, *(milliseconds(durations[variant].get(name)) for variant in variants)))
+    print('{:22s} {:>10s} {:>10s} {:>10s}'.format(
+        'total', *(milliseconds(total_durations[variant]) for variant in variants)))
+
+
+def synthetic_batch(rnd, batch_size, edge):
+    """Annotations and metas as they leave the training preprocessing."""
+    anns_batch, metas = [], []
+    for _ in range(batch_size):
+        anns = []
+        for _ in range(rnd.integers(0, 5)):
+            center = rnd.uniform(-50, edge + 50, size=2)
+            keypoints = np.zeros((len(ANIMAL_KEYPOINTS), 3), dtype=np.float32)
+            keypoints[:, :2] = center + rnd.normal(scale=rnd.uniform(5, 120), size=(len(ANIMAL_KEYPOINTS), 2))
+            keypoints[:, 2] = rnd.choice((0.0, 1.0, 2.0), size=len(ANIMAL_KEYPOINTS), p=(0.3, 0.2, 0.5))
+            anns.append({'keypoints': keypoints, 'bbox': np.array((*(center - 60), 120, 120), dtype=np.float32),
+                         'iscrowd': int(rnd.random() < 0.1)})
+        if anns and rnd.random() < 0.3:
+            # a second animal in almost the same pose
+            twin = copy.deepcopy(anns[0])
+            twin['keypoints'][:, :2] += rnd.normal(scale=1.0, size=(len(ANIMAL_KEYPOINTS), 2))
+            anns.append(twin)
+        valid_area = np.array((0.0, 0.0, edge - 1.0, edge - 1.0))
+        if rnd.random() < 0.5:
+            valid_area[rnd.integers(0, 2)] = rnd.uniform(0, edge / 3)
+            valid_area[2:] -= valid_area[:2]
+        anns_batch.append(anns)
+        metas.append({'valid_area': valid_area})
+    return anns_batch, metas
+
+
+def encoders(args):
+    from .animal_kp import AnimalKp  # pylint: disable=import-outside-toplevel
+    from .batch_encoder import BatchEncoding  # pylint: disable=import-outside-toplevel
+
+    datamodule = AnimalKp()
+    for head_index, head_meta in enumerate(datamodule.head_metas):
+        head_meta.base_stride = 16
+        head_meta.head_index = head_index
+    sample_encoders = datamodule._encoders()
+    batch_encoders = BatchEncoding(None, datamodule._encoders()).encoders
+
+    rnd = np.random.default_rng(args.seed)
+    image = torch.zeros((3, args.square_edge, args.square_edge))
+    sample_time, batch_time = 0.0, 0.0
+    for _ in range(args.n_batches):
+        anns_batch, metas = synthetic_batch(rnd, args.batch_size, args.square_edge)
+        for sample_enc, batch_enc in zip(sample_encoders, batch_encoders):
+            start = time.perf_counter()
+            reference = torch.stack([sample_enc(image, anns, meta) for anns, meta in zip(anns_batch, metas)])
+            sample_time += time.perf_counter() - start
+            start = time.perf_counter()
+            targets = batch_enc((args.square_edge, args.square_edge), anns_batch, metas)
+            batch_time += time.perf_counter() - start
+
+            assert torch.equal(torch.isnan(reference), torch.isnan(targets)), 'nan positions differ'
+            assert torch.equal(torch.nan_to_num(reference), torch.nan_to_num(targets)), 'targets differ'
+
+    print('{} batches of {}, targets identical'.format(args.n_batches, args.batch_size))
+    print('per sample {:.3f}s, batch {:.3f}s ({:.1f}x)'.format(sample_time, batch_time, sample_time / batch_time))
+
+
+def targets(args):
+    from .animal_kp import AnimalKp  # pylint: disable=import-outside-toplevel
+    from .sparse_targets import SparseField, dense_batch  # pylint: disable=import-outside-toplevel
+
+    datamodule = AnimalKp()
+    for head_index, head_meta in enumerate(datamodule.head_metas):
+        head_meta.base_stride = 16
+        head_meta.head_index = head_index
+    sample_encoders = datamodule._encoders()
+
+    rnd = np.random.default_rng(args.seed)
+    image = torch.zeros((3, args.square_edge, args.square_edge))
+    dense_bytes, sparse_bytes, dense_time, sparse_time = 0, 0, 0.0, 0.0
+    for _ in range(args.n_batches):
+        anns_batch, metas = synthetic_batch(rnd, args.batch_size, args.square_edge)
+        dense = [[enc(image, anns, meta) for enc in sample_encoders] for anns, meta in zip(anns_batch, metas)]
+
+        # worker: pickle the samples, main process: unpickle and collate
+        start = time.perf_counter()
+        data = [pickle.dumps([field.numpy() for field in sample]) for sample in dense]
+        reference = [torch.stack([torch.from_numpy(pickle.loads(d)[head_i]) for d in data])
+                     for head_i in range(len(sample_encoders))]
+        dense_time += time.perf_counter() - start
+        dense_bytes += sum(len(d) for d in data)
+
+        start = time.perf_counter()
+        data = [pickle.dumps([SparseField.from_dense(field) for field in sample]) for sample in dense]
+        samples = [pickle.loads(d) for d in data]
+        densified = [dense_batch([sample[head_i] for sample in samples])
+                     for head_i in range(len(sample_encoders))]
+        sparse_time += time.perf_counter() - start
+        sparse_bytes += sum(len(d) for d in data)
+
+        for r, d in zip(reference, densified):
+            assert torch.equal(r.view(torch.int32), d.view(torch.int32)), 'targets differ'
+
+    n_samples = args.n_batches * args.batch_size
+    print('{} batches of {}, densified targets bitwise identical'.format(args.n_batches, args.batch_size))
+    print('dense:  {:.0f} kB per sample, {:.3f}s'.format(dense_bytes / n_samples / 1000, dense_time))
+    print('sparse: {:.0f} kB per sample, {:.3f}s'.format(sparse_bytes / n_samples / 1000, sparse_time))
+
+
+def synthetic_eval_set(tmp_dir, n_images, *, seed=1):
+    """Images of random aspect ratios with one animal each and their annotation file."""
+    rnd = np.random.default_rng(seed)
+    images, anns = [], []
+    for image_id in range(1, n_images + 1):
+        width, height = (int(e) for e in rnd.integers(200, 800, size=2))
+        pixels = rnd.integers(0, 256, size=(height // 8, width // 8, 3), dtype=np.uint8)
+        file_name = '{:06d}.jpg'.format(image_id)
+        Image.fromarray(pixels).resize((width, height), Image.BILINEAR).save(os.path.join(tmp_dir, file_name))
+        images.append({'id': image_id, 'file_name': file_name, 'width': width, 'height': height})
+        keypoints = np.concatenate((rnd.uniform(0.2, 0.8, (len(ANIMAL_KEYPOINTS), 2)) * (width, height),
+                                    np.full((len(ANIMAL_KEYPOINTS), 1), 2.0)), axis=1)
+        anns.append({'id': image_id, 'image_id': image_id, 'category_id': 1, 'iscrowd': 0,
+                     'bbox': [0.2 * width, 0.2 * height, 0.6 * width, 0.6 * height],
+                     'area': 0.36 * width * height, 'num_keypoints': len(ANIMAL_KEYPOINTS),
+                     'keypoints': keypoints.reshape(-1).tolist()})
+    ann_file = os.path.join(tmp_dir, 'annotations.json')
+    with open(ann_file, 'w') as f:
+        json.dump({'images': images, 'annotations': anns,
+                   'categories': [{'id': 1, 'name': 'animal', 'keypoints': ANIMAL_KEYPOINTS}]}, f)
+    return ann_file
+
+
+def eval_padding(args):
+    from .animal_kp import AnimalKp  # pylint: disable=import-outside-toplevel
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        AnimalKp.eval_annotations = synthetic_eval_set(tmp_dir, args.n_images, seed=args.seed)
+        AnimalKp.eval_image_dir = tmp_dir
+        AnimalKp.eval_image_shards = None
+        AnimalKp.eval_long_edge = args.long_edge
+        AnimalKp.annotation_cache = False
+        AnimalKp.loader_workers = 0
+        AnimalKp.pin_memory = False
+
+        def batches(batch_size, bucketing):
+            AnimalKp.batch_size = batch_size
+            AnimalKp.eval_bucketing = bucketing
+            return list(AnimalKp().eval_loader())
+
+        reference = {meta['image_id']: (image, meta) for images, _, metas in batches(1, False)
+                     for image, meta in zip(images, metas)}
+        square = batches(args.batch_size, False)
+        bucketed = batches(args.batch_size, True)
+
+    for images, _, metas in bucketed:
+        for image, meta in zip(images, metas):
+            reference_image, reference_meta = reference[meta['image_id']]
+            _, h, w = reference_image.shape
+            assert torch.equal(image[:, :h, :w], reference_image), 'images differ'
+            assert not image[:, h:].any() and not image[:, :, w:].any(), 'padding is not zero'
+            for key in ('offset', 'scale', 'valid_area'):
+                assert np.array_equal(meta[key], reference_meta[key]), key + ' differs'
+    print('{} images, bucketed inputs identical to batch size 1'.format(len(reference)))
+
+    net, _ = openpifpaf.network.Factory(base_name=args.basenet).factory(head_metas=AnimalKp().head_metas)
+    net.eval()
+    for name, loader_batches in (('square', square), ('bucketed', bucketed)):
+        n_pixels = sum(images.shape[0] * images.shape[2] * images.shape[3] for images, _, _ in loader_batches)
+        start = time.perf_counter()
+        with torch.no_grad():
+            for images, _, _ in loader_batches:
+                net(images)
+        print('{:10s} {:6.1f} Mpixels, forward {:.2f}s'.format(
+            name, n_pixels / 1e6, time.perf_counter() - start))
+
+
+def synthetic_keypoint_eval(file_name, n_images, *, seed=1):
+    """Write ground truth and return openpifpaf predictions per image id."""
+    rnd = np.random.default_rng(seed)
+    n_keypoints = len(ANIMAL_KEYPOINTS)
+    images, anns, predictions = [], [], {}
+    for image_id in range(1, n_images + 1):
+        images.append({'id': image_id, 'file_name': '{:06d}.jpg'.format(image_id), 'width': 1000, 'height': 1000})
+        predictions[image_id] = []
+        for _ in range(rnd.integers(0, 7)):
+            w, h = np.exp(rnd.uniform(np.log(10), np.log(500), 2))
+            x, y = rnd.uniform(0, 500, 2)
+            xy = rnd.uniform((x, y), (x + w, y + h), (n_keypoints, 2))
+            v = rnd.choice([0, 1, 2], n_keypoints, p=[0.3, 0.2, 0.5]) * (rnd.random() > 0.1)
+            ann = {
+                'id': len(anns) + 1, 'image_id': image_id, 'category_id': 1 if rnd.random() > 0.05 else 2,
+                'iscrowd': int(rnd.random() < 0.05), 'bbox': [x, y, w, h],
+                'keypoints': np.concatenate((np.round(xy), v[:, None]), axis=1).reshape(-1).tolist(),
+                'num_keypoints': int(np.count_nonzero(v)),
+            }
+            if rnd.random() > 0.1:
+                ann['area'] = 0.8 * w * h
+            anns.append(ann)
+
+            # noisy and duplicate detections
+            for _ in range(rnd.choice([0, 1, 1, 1, 2, 4])):
+                noise = rnd.normal(0.0, rnd.uniform(0.01, 0.15) * np.sqrt(w * h), (n_keypoints, 2))
+                predictions[image_id].append((xy + noise, rnd.uniform(0.05, 1.0, n_keypoints)))
+        for _ in range(rnd.choice([0, 1, 3, 25], p=[0.5, 0.3, 0.15, 0.05])):
+            xy = rnd.uniform(0, 600, 2) + rnd.uniform(0, 200, (n_keypoints, 2))
+            predictions[image_id].append((xy, rnd.uniform(0.05, 1.0, n_keypoints)))
+
+    with open(file_name, 'w') as f:
+        json.dump({'images': images, 'annotations': anns,
+                   'categories': [{'id': 1, 'name': 'animal'}, {'id': 2, 'name': 'other'}]}, f)
+
+    def annotation(xy, confidences):
+        data = np.concatenate((xy, confidences[:, None]), axis=1).astype(np.float32)
+        # coarse scores for ties between detections
+        return openpifpaf.Annotation(ANIMAL_KEYPOINTS, ANIMAL_SKELETON).set(
+            data, fixed_score=round(float(rnd.choice([0.2, 0.5, rnd.random()])), 2))
+
+    return {image_id: [annotation(*p) for p in image_predictions]
+            for image_id, image_predictions in predictions.items()}
+
+
+def metric(args):
+    from .annotation_store import load_coco  # pylint: disable=import-outside-toplevel
+    from .oks_metric import OksCoco  # pylint: disable=import-outside-toplevel
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ann_file = os.path.join(tmp_dir, 'annotations.json')
+        predictions = synthetic_keypoint_eval(ann_file, args.n_images, seed=args.seed)
+        image_ids = list(predictions)
+        np.random.default_rng(args.seed).shuffle(image_ids)
+
+        stats = {}
+        for name, metric_class, kwargs in (
+                ('pycocotools', openpifpaf.metric.Coco, {'iou_type': 'keypoints'}),
+                ('vectorized', OksCoco, {})):
+            evaluator = metric_class(load_coco(ann_file), max_per_image=20, category_ids=[1],
+                                     keypoint_oks_sigmas=ANIMAL_SIGMAS, **kwargs)
+            start = time.perf_counter()
+            for image_id in image_ids:
+                evaluator.accumulate(predictions[image_id], {'image_id': image_id})
+            accumulate_time = time.perf_counter() - start
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                stats[name] = np.array(evaluator.stats()['stats'])
+            print('{:12s} accumulate {:.2f}s, stats {:.2f}s'.format(
+                name, accumulate_time, time.perf_counter() - start))
+
+    max_difference = np.max(np.abs(stats['pycocotools'] - stats['vectorized']))
+    print('AP, AR: {}'.format(np.round(stats['vectorized'], 4).tolist()))
+    print('largest difference to pycocotools: {:.1e}'.format(max_difference))
+    assert max_difference <= 1e-6, 'stats differ'
+
+
+def eval_cache(args):
+    from .animal_kp import AnimalKp  # pylint: disable=import-outside-toplevel
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        AnimalKp.eval_annotations = synthetic_eval_set(tmp_dir, args.n_images, seed=args.seed)
+        AnimalKp.eval_image_dir = tmp_dir
+        AnimalKp.eval_image_shards = None
+        AnimalKp.eval_long_edge = args.long_edge
+        # tight padding, square padding fills with random values
+        AnimalKp.eval_bucketing = True
+        AnimalKp.batch_size = args.batch_size
+        AnimalKp.uint8_transport = args.uint8_transport
+        AnimalKp.device = torch.device('cpu')
+        AnimalKp.annotation_cache = False
+        AnimalKp.loader_workers = 0
+        AnimalKp.pin_memory = False
+
+        passes = {}
+        for name, cache_dir in (('no cache', None),
+                                ('create cache', os.path.join(tmp_dir, 'cache')),
+                                ('read cache', os.path.join(tmp_dir, 'cache'))):
+            AnimalKp.eval_cache_dir = cache_dir
+            start = time.perf_counter()
+            passes[name] = list(AnimalKp().eval_loader())
+            print('{:12s} {:.2f}s'.format(name, time.perf_counter() - start))
+
+    reference = passes['no cache']
+    for name in ('create cache', 'read cache'):
+        assert len(passes[name]) == len(reference)
+        for (images, anns, metas), (ref_images, ref_anns, ref_metas) in zip(passes[name], reference):
+            assert torch.equal(images, ref_images), 'images differ'
+            for image_anns, ref_image_anns in zip(anns, ref_anns):
+                assert len(image_anns) == len(ref_image_anns), 'annotations differ'
+                for ann, ref_ann in zip(image_anns, ref_image_anns):
+                    assert vars(ann).keys() == vars(ref_ann).keys()
+                    for key, value in vars(ann).items():
+                        assert np.array_equal(value, vars(ref_ann)[key]), 'annotation ' + key + ' differs'
+            for meta, ref_meta in zip(metas, ref_metas):
+                assert meta.keys() == ref_meta.keys()
+                for key, value in meta.items():
+                    assert np.array_equal(value, ref_meta[key]), key + ' differs'
+    print('{} images, cached samples identical'.format(args.n_images))
+
+
+def eval_shards(args):
+    from . import eval_shards as shards_module  # pylint: disable=import-outside-toplevel
+    from .annotation_store import load_coco  # pylint: disable=import-outside-toplevel
+    from .oks_metric import OksCoco  # pylint: disable=import-outside-toplevel
+
+    def coco_metric(metric_class, coco, **kwargs):
+        return metric_class(coco, max_per_image=20, category_ids=[1], keypoint_oks_sigmas=ANIMAL_SIGMAS, **kwargs)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ann_file = os.path.join(tmp_dir, 'annotations.json')
+        predictions = synthetic_keypoint_eval(ann_file, args.n_images, seed=args.seed)
+        coco = load_coco(ann_file)
+        image_ids = list(predictions)
+        np.random.default_rng(args.seed).shuffle(image_ids)
+
+        shard_files = []
+        for shard_index in range(args.n_shards):
+            shard = (shard_index, args.n_shards)
+            shard_metric = shards_module.ShardPredictions(
+                coco_metric(openpifpaf.metric.Coco, coco, iou_type='keypoints'), shard)
+            for image_id in shards_module.shard_ids(image_ids, shard):
+                shard_metric.accumulate(predictions[image_id], {'image_id': image_id})
+            shard_metric.write_predictions(shards_module.shard_output(os.path.join(tmp_dir, 'eval'), shard),
+                                           additional_data={'n_images': 0})
+            shard_files.append(shards_module.shard_file_name(os.path.join(tmp_dir, 'eval'), shard))
+        start = time.perf_counter()
+        shards = shards_module.load_shards(shard_files[::-1])
+        print('{} shards loaded in {:.2f}s'.format(args.n_shards, time.perf_counter() - start))
+
+        for name, metric_class, kwargs in (
+                ('pycocotools', openpifpaf.metric.Coco, {'iou_type': 'keypoints'}),
+                ('vectorized', OksCoco, {})):
+            single = coco_metric(metric_class, coco, **kwargs)
+            for image_id in image_ids:
+                single.accumulate(predictions[image_id], {'image_id': image_id})
+            merged = coco_metric(metric_class, coco, **kwargs)
+            shards_module.merge(merged, shards)
+            with contextlib.redirect_stdout(io.StringIO()):
+                single_stats = np.array(single.stats()['stats'])
+                merged_stats = np.array(merged.stats()['stats'])
+            assert np.array_equal(single_stats, merged_stats), name + ' stats differ'
+            print('{:12s} merged stats identical: {}'.format(name, np.round(merged_stats, 4).tolist()))
+
+
+def main():
+    args = cli()
+    if args.benchmark == 'annotations':
+        annotations(args)
+    elif args.benchmark == 'shards':
+        shards(args)
+    elif args.benchmark == 'transforms':
+        transforms(args)
+    elif args.benchmark == 'encoders':
+        encoders(args)
+    elif args.benchmark == 'targets':
+        targets(args)
+    elif args.benchmark == 'eval-padding':
+        eval_padding(args)
+    elif args.benchmark == 'metric':
+        metric(args)
+    elif args.benchmark == 'eval-cache':
+        eval_cache(args)
+    elif args.benchmark == 'eval-shards':
+        eval_shards(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,17 @@
 
-from collections import defaultdict
-import copy
 import logging
 import os
 
+import numpy as np
 import torch.utils.data
 from PIL import Image
 
 from openpifpaf import transforms, utils
 
+from .annotation_store import AnnotationStore, cache_file_name, load_coco
+from .image_cache import ImageCache
+from .image_shards import ImageShards
+
 
 LOG = logging.getLogger(__name__)
 STAT_LOG = logging.getLogger(__name__.replace('openpifpaf.', 'openpifpaf.stats.'))
@@ -20,98 +23,255 @@ class Animal(torch.utils.data.Dataset):
     Args:
         image_dir (string): Root directory where images are downloaded to.
         ann_file (string): Path to json annotation file.
+        annotation_cache (bool): Store the parsed and filtered annotations
+            in a binary file next to ann_file and reuse it on later runs.
+        image_cache_bytes (int): Budget of a shared-memory LRU cache of
+            decoded images. Zero deactivates the cache.
+        decode_long_edge (int): Long edge the preprocessing rescales to.
+            JPEGs are decoded at the smallest power-of-two reduction that
+            still covers it.
+        decode_scale_fn (callable): Called once per sample before decoding
+            to draw the random scale of its preprocessing ahead of time, like
+            RescaleRelativeCrop.draw_factors. Returns the largest scale
+            relative to the original image. Not used with the image cache,
+            which keeps one decoded image for all epochs.
+        image_shards (string): Shard directory written by image_shards.
+            Images are read from the memory mapped shards instead of
+            image_dir.
+        image_pyramid (bool): Load the smallest pre-resized copy written
+            by voc_to_coco --pyramid that still covers the resolution
+            given by decode_long_edge and decode_scale_fn.
+        reduced_decode (bool): Decode JPEGs at a reduced resolution
+            according to decode_long_edge and decode_scale_fn.
+        coco_index (CocoIndex): Shared parser of ann_file, only called when
+            the annotations are not read from the annotation cache.
     """
 
     def __init__(self, image_dir, ann_file, *,
                  n_images=None, preprocess=None, min_kp_anns=0,
                  category_ids=None,
-                 annotation_filter=False):
+                 annotation_filter=False,
+                 annotation_cache=False,
+                 image_cache_bytes=0,
+                 decode_long_edge=None,
+                 decode_scale_fn=None,
+                 image_shards=None,
+                 image_pyramid=False,
+                 reduced_decode=False,
+                 coco_index=None):
         if category_ids is None:
             category_ids = []
+        if min_kp_anns and not annotation_filter:
+            raise Exception('only set min_kp_anns with annotation_filter')
 
-        from pycocotools.coco import COCO  # pylint: disable=import-outside-toplevel
         self.image_dir = image_dir
-        self.coco = COCO(ann_file)
-
         self.category_ids = category_ids
 
-        self.ids = self.coco.getImgIds(catIds=self.category_ids)
-        if annotation_filter:
-            self.filter_for_annotations(min_kp_anns=min_kp_anns)
-        elif min_kp_anns:
-            raise Exception('only set min_kp_anns with annotation_filter')
+        cache_file = None
+        if annotation_cache:
+            cache_file = cache_file_name(
+                ann_file,
+                category_ids=category_ids,
+                min_kp_anns=min_kp_anns,
+                annotation_filter=annotation_filter,
+            )
+        if cache_file is not None and os.path.exists(cache_file):
+            LOG.info('loading annotation cache %s', cache_file)
+            self.store, (ids,) = AnnotationStore.load(cache_file, extra_keys=('ids',))
+            self.ids = ids.tolist()
+        else:
+            coco = coco_index(ann_file) if coco_index is not None else load_coco(ann_file)
+            self.ids = coco.getImgIds(catIds=self.category_ids)
+            self.store = AnnotationStore.from_coco(coco, self.category_ids)
+            del coco
+
+            if annotation_filter:
+                self.filter_for_annotations(min_kp_anns=min_kp_anns)
+
+            if cache_file is not None:
+                try:
+                    self.store.save(cache_file, ids=np.array(self.ids, dtype=np.int64))
+                    LOG.info('wrote annotation cache %s', cache_file)
+                except OSError as e:
+                    LOG.warning('cannot write annotation cache %s: %s', cache_file, e)
 
         if n_images:
             self.ids = self.ids[:n_images]
         LOG.info('Images: %d', len(self.ids))
 
+        self.decode_long_edge = decode_long_edge
+        self.decode_scale_fn = decode_scale_fn
+        self.image_pyramid = image_pyramid
+        self.reduced_decode = reduced_decode
+
+        self.image_shards = None
+        if image_shards:
+            self.image_shards = ImageShards(image_shards)
+
+        self.image_cache = None
+        if image_cache_bytes:
+            self.image_cache = ImageCache(len(self.store.image_ids), image_cache_bytes)
+
         self.preprocess = preprocess or transforms.EVAL_TRANSFORM
 
     def filter_for_annotations(self, *, min_kp_anns=0):
         LOG.info('filter for annotations (min kp=%d) ...', min_kp_anns)
-        def filter_image(image_id):
-            ann_ids = self.coco.getAnnIds(imgIds=image_id, catIds=self.category_ids)
-            anns = self.coco.loadAnns(ann_ids)
-            anns = [ann for ann in anns if not ann.get('iscrowd')]
-            if not anns:
-                return False
-            kp_anns = [ann for ann in anns
-                       if 'keypoints' in ann and any(v > 0.0 for v in ann['keypoints'][2::3])]
-            return len(kp_anns) >= min_kp_anns
-
-        self.ids = [image_id for image_id in self.ids if filter_image(image_id)]
+        store = self.store
+        n_store_images = len(store.image_ids)
+        image_rows = store.annotation_image_rows()
+
+        not_crowd = store.iscrowd == 0
+        visible = store.keypoints.reshape(len(store), -1)[:, 2::3] > 0.0
+        with_keypoints = not_crowd & store.has_keypoints & np.any(visible, axis=1)
+        n_anns = np.bincount(image_rows[not_crowd], minlength=n_store_images)
+        n_kp_anns = np.bincount(image_rows[with_keypoints], minlength=n_store_images)
+
+        rows = store.rows(self.ids)
+        keep = (n_anns[rows] > 0) & (n_kp_anns[rows] >= min_kp_anns)
+        self.ids = [image_id for image_id, k in zip(self.ids, keep) if k]
         LOG.info('... done.')
 
-    def class_aware_sample_weights(self, max_multiple=10.0):
+    def class_aware_sample_weights(self, max_multiple=10.0, *, by_species=False):
         """Class aware sampling.
 
         To be used with PyTorch's WeightedRandomSampler.
+        With by_species, the classes are the animal species of the original
+        dataset instead of the COCO categories.
 
         Reference: Solution for Large-Scale Hierarchical Object Detection
         Datasets with Incomplete Annotation and Data Imbalance
         Yuan Gao, Xingyuan Bu, Yang Hu, Hui Shen, Ti Bai, Xubin Li and Shilei Wen
         """
-        ann_ids = self.coco.getAnnIds(imgIds=self.ids, catIds=self.category_ids)
-        anns = self.coco.loadAnns(ann_ids)
+        store = self.store
+        n_store_images = len(store.image_ids)
+        rows = store.rows(self.ids)
+        image_rows = store.annotation_image_rows()
 
-        category_image_counts = defaultdict(int)
-        image_categories = defaultdict(set)
-        for ann in anns:
-            if ann['iscrowd']:
-                continue
-            image = ann['image_id']
-            category = ann['category_id']
-            if category in image_categories[image]:
-                continue
-            image_categories[image].add(category)
-            category_image_counts[category] += 1
-
-        weights = [
-            sum(
-                1.0 / category_image_counts[category_id]
-                for category_id in image_categories[image_id]
-            )
-            for image_id in self.ids
-        ]
-        min_w = min(weights)
-        LOG.debug('Class Aware Sampling: minW = %f, maxW = %f', min_w, max(weights))
+        in_ids = np.zeros((n_store_images,), dtype=bool)
+        in_ids[rows] = True
+        selected = in_ids[image_rows] & (store.iscrowd == 0)
+
+        # unique (image, category) pairs as a sparse co-occurrence matrix
+        classes = store.species_ids if by_species else store.category_ids
+        if by_species and np.array_equal(store.species_ids, store.category_ids):
+            LOG.warning('species ids equal the category ids, so class aware sampling by species '
+                        'weights all images alike, convert the file again with voc_to_coco')
+        categories, category_index = np.unique(classes[selected], return_inverse=True)
+        n_categories = max(1, len(categories))
+        pairs = np.unique(image_rows[selected] * n_categories + category_index)
+        pair_images, pair_categories = np.divmod(pairs, n_categories)
+
+        category_image_counts = np.bincount(pair_categories, minlength=n_categories)
+        row_weights = np.bincount(
+            pair_images,
+            weights=1.0 / category_image_counts[pair_categories],
+            minlength=n_store_images,
+        )
+
+        weights = row_weights[rows]
+        min_w = np.min(weights)
+        LOG.debug('Class Aware Sampling: minW = %f, maxW = %f', min_w, np.max(weights))
         max_w = min_w * max_multiple
-        weights = [min(w, max_w) for w in weights]
-        LOG.debug('Class Aware Sampling: minW = %f, maxW = %f', min_w, max(weights))
+        weights = np.minimum(weights, max_w)
+        LOG.debug('Class Aware Sampling: minW = %f, maxW = %f', min_w, np.max(weights))
+
+        return weights.tolist()
+
+    def max_decode_scale(self, image_info):
+        """Largest scale relative to the original image that preprocessing needs."""
+        width, height = image_info['width'], image_info['height']
+        if not width or not height:
+            return 1.0
+
+        max_scale = 1.0
+        if self.decode_long_edge:
+            max_scale = min(max_scale, self.decode_long_edge / max(width, height))
+        return max_scale
+
+    @staticmethod
+    def pyramid_level(image_info, max_scale):
+        """Smallest pre-resized level that still covers max_scale or None."""
+        width, height = image_info['width'], image_info['height']
+        covering = [level for level in image_info.get('pyramid', [])
+                    if level['width'] >= max_scale * width and level['height'] >= max_scale * height]
+        return min(covering, key=lambda level: level['width'], default=None)
+
+    @staticmethod
+    def decode_reduction(max_scale):
+        """Power-of-two factor by which the image can be decoded smaller."""
+        # libjpeg can scale by 1/2, 1/4 and 1/8 during decoding
+        reduction = 1
+        while reduction < 8 and max_scale * reduction * 2 <= 1.0:
+            reduction *= 2
+        return reduction
+
+    def load_image(self, image_id, local_file_path, reduction=1, *, pyramid_level=None):
+        cache_key = None
+        if self.image_cache is not None:
+            cache_key = self.store.row(image_id)
+            pixels = self.image_cache.get(cache_key)
+            if pixels is not None:
+                return Image.fromarray(pixels)
+
+        if pyramid_level is not None:
+            f = open(os.path.join(self.image_dir, pyramid_level['file_name']), 'rb')
+        elif self.image_shards is not None:
+            f = self.image_shards.open(image_id)
+        else:
+            f = open(local_file_path, 'rb')
+        with f:
+            image = Image.open(f)
+            if reduction > 1:
+                width, height = image.size
+                image.draft('RGB', (width // reduction, height // reduction))
+            image = image.convert('RGB')
 
-        return weights
+        if cache_key is not None:
+            self.image_cache.put(cache_key, np.asarray(image))
+        return image
+
+    @staticmethod
+    def rescale_annotations(anns, meta, scale, width_height):
+        """Map annotations from the original image to a smaller copy of it.
+
+        scale is the (x, y) size ratio of the copy. Every pixel of the copy
+        covers a block of 1 / scale original pixels. The mapping is recorded
+        in meta so that predictions are transformed back to the original image.
+        """
+        scale = np.asarray(scale, dtype=np.float64)
+        offset = 0.5 - 0.5 * scale
+        for ann in anns:
+            if 'keypoints' in ann:
+                xy = ann['keypoints'].reshape(-1, 3)[:, :2]
+                xy *= scale
+                xy -= offset
+            if 'bbox' in ann:
+                ann['bbox'][:2] = ann['bbox'][:2] * scale - offset
+                ann['bbox'][2:] *= scale
+
+        meta['offset'] = offset
+        meta['scale'] = scale
+        meta['width_height'] = np.array(width_height)
 
     def __getitem__(self, index):
         image_id = self.ids[index]
-        ann_ids = self.coco.getAnnIds(imgIds=image_id, catIds=self.category_ids)
-        anns = self.coco.loadAnns(ann_ids)
-        anns = copy.deepcopy(anns)
+        anns = self.store.annotations(image_id)
 
-        image_info = self.coco.loadImgs(image_id)[0]
+        image_info = self.store.image_info(image_id)
         LOG.debug(image_info)
         local_file_path = os.path.join(self.image_dir, image_info['file_name'])
-        with open(local_file_path, 'rb') as f:
-            image = Image.open(f).convert('RGB')
+        width, height = image_info['width'], image_info['height']
+
+        max_scale = self.max_decode_scale(image_info)
+        if self.decode_scale_fn is not None and self.image_cache is None:
+            max_scale = min(max_scale, self.decode_scale_fn())
+        level = self.pyramid_level(image_info, max_scale) if self.image_pyramid else None
+        source_width, source_height = width, height
+        if level is not None:
+            source_width, source_height = level['width'], level['height']
+            max_scale = max_scale * max(width / source_width, height / source_height)
+        reduction = self.decode_reduction(max_scale) if self.reduced_decode else 1
+        image = self.load_image(image_id, local_file_path, reduction, pyramid_level=level)
 
         meta = {
             'dataset_index': index,
@@ -125,6 +285,14 @@ class Animal(torch.utils.data.Dataset):
             flickr_id, _ = flickr_file_name.split('_', maxsplit=1)
             meta['flickr_full_page'] = 'http://flickr.com/photo.gne?id={}'.format(flickr_id)
 
+        if reduction > 1:
+            # the actual reduction is smaller for images that are not JPEGs
+            reduction = round(source_width / image.size[0])
+        if level is not None or reduction > 1:
+            self.rescale_annotations(anns, meta,
+                                     (source_width / width / reduction, source_height / height / reduction),
+                                     (width, height))
+
         # preprocess image and annotations
         image, anns, meta = self.preprocess(image, anns, meta)
 
@@ -0,0 +1,87 @@
+"""
+Images travel from the loader workers to the model device as uint8.
+
+ToUint8Tensor replaces ToTensor and Normalize at the end of the
+preprocessing. It emits a CHW uint8 tensor with a fourth channel that is
+255 inside the valid area. The masking in Animal.__getitem__ zeroes all
+channels outside of the valid area, so the mask travels with the batch.
+DeviceNormalize wraps a DataLoader, moves every image batch to the device
+and normalizes it there with the arithmetic of ToTensor and Normalize,
+including the zeros outside of the valid area.
+"""
+
+import logging
+
+import numpy as np
+import torch
+
+from openpifpaf import transforms
+
+LOG = logging.getLogger(__name__)
+
+MEAN = (0.485, 0.456, 0.406)
+STD = (0.229, 0.224, 0.225)
+
+
+class ToUint8Tensor(transforms.Preprocess):
+    """HWC image, PIL or uint8 array, to a uint8 RGB + valid area CHW tensor."""
+
+    def __call__(self, image, anns, meta):
+        pixels = np.asarray(image)
+        h, w = pixels.shape[:2]
+        chw = np.empty((4, h, w), dtype=np.uint8)
+        chw[:3] = pixels.transpose(2, 0, 1)
+        chw[3] = 255
+        return torch.from_numpy(chw), anns, meta
+
+
+def eval_transform(t=transforms):
+    """EVAL_TRANSFORM of the transform module t with uint8 output."""
+    return transforms.Compose([
+        t.NormalizeAnnotations(),
+        ToUint8Tensor(),
+    ])
+
+
+def train_transform(t=transforms):
+    """TRAIN_TRANSFORM of the transform module t with uint8 output."""
+    *augmentation, final_t = t.TRAIN_TRANSFORM.preprocess_list
+    assert final_t is t.EVAL_TRANSFORM
+    return transforms.Compose([
+        *augmentation,
+        eval_transform(t),
+    ])
+
+
+def normalize(images):
+    """Normalized float images of a uint8 batch of ToUint8Tensor."""
+    valid = images[:, 3:] > 0
+    images = images[:, :3].to(dtype=torch.get_default_dtype()).div_(255)
+    mean = torch.as_tensor(MEAN, dtype=images.dtype, device=images.device)
+    std = torch.as_tensor(STD, dtype=images.dtype, device=images.device)
+    images.sub_(mean[:, None, None]).div_(std[:, None, None])
+    return images.masked_fill_(~valid, 0.0)
+
+
+class DeviceNormalize:
+    """DataLoader whose uint8 image batches are normalized on device."""
+
+    def __init__(self, loader: torch.utils.data.DataLoader, device=None):
+        self.loader = loader
+        self.device = device
+
+    def __getattr__(self, name):
+        # sampler, dataset, batch_size, ... of the wrapped loader
+        return getattr(self.loader, name)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def with_loader(self, loader):
+        return DeviceNormalize(loader, self.device)
+
+    def __iter__(self):
+        for images, *rest in self.loader:
+            if self.device is not None:
+                images = images.to(self.device, non_blocking=True)
+            yield (normalize(images), *rest)
@@ -0,0 +1,61 @@
+"""
+Distributed training with a custom sampler.
+
+The DistributedSampler of PyTorch shuffles the dataset uniformly, so the
+sampler of a DataLoader that draws weighted samples or a fixed number of
+samples per epoch cannot just be replaced by it. DistributedSamplerWrapper
+draws the indices of the wrapped sampler with a generator that is seeded
+with the epoch, so that every process draws the same indices, and gives
+every process a disjoint part of them.
+"""
+
+import logging
+
+import torch
+
+LOG = logging.getLogger(__name__)
+
+
+class DistributedSamplerWrapper(torch.utils.data.Sampler):
+    """Every num_replicas-th index of a sampler drawn identically by all processes.
+
+    Args:
+        sampler: sampler with a generator attribute like
+            WeightedRandomSampler or RandomSampler.
+        num_replicas: number of processes, default is the world size.
+        rank: rank of this process, default is the rank in the process group.
+        seed: random seed shared by all processes.
+    """
+
+    def __init__(self, sampler, num_replicas=None, rank=None, seed=0):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size()
+        if rank is None:
+            rank = torch.distributed.get_rank()
+        assert 0 <= rank < num_replicas
+        super().__init__()
+        self.sampler = sampler
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        # drop the last indices that do not divide among the processes
+        return len(self.sampler) // self.num_replicas
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        original_generator = self.sampler.generator
+        self.sampler.generator = generator
+        try:
+            indices = list(self.sampler)
+        finally:
+            self.sampler.generator = original_generator
+
+        indices = indices[:len(self) * self.num_replicas]
+        return iter(indices[self.rank::self.num_replicas])
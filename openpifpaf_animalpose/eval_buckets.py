@@ -0,0 +1,65 @@
+"""
+Aspect ratio buckets for batched evaluation.
+
+With --animal-eval-bucketing every eval image is padded tightly to a
+multiple of the stride, as for batch size 1, instead of to the square
+eval_long_edge. AspectRatioBatchSampler batches images of similar
+preprocessed size and aspect ratio and collate_padded_images_anns_meta
+pads the images of a batch at the bottom and right to the largest of
+them. The offsets in the metas stay valid.
+"""
+
+import logging
+import math
+
+import numpy as np
+import torch
+
+LOG = logging.getLogger(__name__)
+
+
+class AspectRatioBatchSampler(torch.utils.data.Sampler):
+    """Batches of dataset indices sorted by long edge and aspect ratio.
+
+    Args:
+        widths, heights: preprocessed image sizes per dataset index.
+        multiple: long edges are compared in units of the stride.
+    """
+
+    def __init__(self, widths, heights, batch_size, *, multiple=16):
+        widths = np.maximum(np.asarray(widths, dtype=np.float64), 1.0)
+        heights = np.maximum(np.asarray(heights, dtype=np.float64), 1.0)
+        long_edges = np.ceil(np.maximum(widths, heights) / multiple)
+        order = np.lexsort((widths / heights, long_edges))
+        self.batches = [order[i:i + batch_size].tolist() for i in range(0, len(order), batch_size)]
+
+        padded = sum(len(batch) * widths[batch].max() * heights[batch].max() for batch in self.batches)
+        LOG.info('%d eval batches of similar aspect ratio, %.0f%% padding',
+                 len(self.batches), 100.0 * (1.0 - np.sum(widths * heights) / max(padded, 1.0)))
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def collate_padded_images_anns_meta(batch, multiple=16):
+    """Pad images to the largest of the batch, rounded like CenterPadTight.
+
+    The padding is zero, the value of the masked area outside of the valid
+    area of float and uint8 images.
+    """
+    n_channels = batch[0][0].shape[0]
+    height = max(image.shape[1] for image, _, _ in batch)
+    width = max(image.shape[2] for image, _, _ in batch)
+    height = math.ceil((height - 1) / multiple) * multiple + 1
+    width = math.ceil((width - 1) / multiple) * multiple + 1
+
+    images = batch[0][0].new_zeros((len(batch), n_channels, height, width))
+    for image, padded in zip((b[0] for b in batch), images):
+        padded[:, :image.shape[1], :image.shape[2]] = image
+
+    anns = [b[1] for b in batch]
+    metas = [b[2] for b in batch]
+    return images, anns, metas
@@ -0,0 +1,133 @@
+"""
+Disk cache of preprocessed eval samples.
+
+The eval preprocessing is deterministic for a given configuration, so its
+images, annotations and metas are computed once into a cache directory and
+every later evaluation with the same key reads them back from memmaps. The
+images of all samples are stored back to back in one flat file in their
+transport dtype, so images of different sizes need no padding. The pickled
+annotations and metas of all samples go to a second flat file. The
+directory name is a hash of the dataset and the preprocessing
+configuration, and it only appears once all samples are written.
+"""
+
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+LOG = logging.getLogger(__name__)
+
+# image offset, channels, height, width, sample offset, sample size
+INDEX_COLUMNS = 6
+
+
+def _sample(sample):
+    # without batching, only skip the default conversion of numpy arrays in metas
+    return sample
+
+
+class EvalCache(torch.utils.data.Dataset):
+    """Dataset of (image, anns, meta) preprocessed once into cache_root/key.
+
+    Every sample is computed with a torch seed of its index, so random fill
+    values of padding are reproducible.
+    """
+
+    def __init__(self, dataset, cache_root, key, *, num_workers=0):
+        self.dataset = dataset
+        self.cache_dir = os.path.join(cache_root, key)
+        if not os.path.isdir(self.cache_dir):
+            self.create(cache_root, num_workers)
+        self._images = None
+        self._samples = None
+        self._index = None
+        self.open()
+        LOG.info('eval cache %s: %d samples, %.0f MB of images',
+                 self.cache_dir, len(self), self._images.nbytes / 1e6)
+
+    def __getstate__(self):
+        state = dict(vars(self))
+        state['_images'] = None
+        state['_samples'] = None
+        state['_index'] = None
+        return state
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def compute(self, index):
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(index)
+            return self.dataset[index]
+
+    def create(self, cache_root, num_workers):
+        """Preprocess all samples in order and write them to a new cache directory."""
+        start = time.perf_counter()
+        os.makedirs(cache_root, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=cache_root)
+        index = np.zeros((len(self), INDEX_COLUMNS), dtype=np.int64)
+        dtype = None
+        loader = torch.utils.data.DataLoader(
+            _Computed(self), batch_size=None, num_workers=num_workers, collate_fn=_sample)
+        with open(os.path.join(tmp_dir, 'images.bin'), 'wb') as images_file, \
+                open(os.path.join(tmp_dir, 'samples.bin'), 'wb') as samples_file:
+            image_offset = sample_offset = 0
+            for i, (image, anns, meta) in enumerate(loader):
+                image = image.numpy()
+                if dtype is None:
+                    dtype = image.dtype
+                assert image.dtype == dtype
+                sample_bytes = pickle.dumps((anns, meta))
+                index[i] = (image_offset, *image.shape, sample_offset, len(sample_bytes))
+                images_file.write(np.ascontiguousarray(image).tobytes())
+                samples_file.write(sample_bytes)
+                image_offset += image.size
+                sample_offset += len(sample_bytes)
+        np.save(os.path.join(tmp_dir, 'index.npy'), index)
+        with open(os.path.join(tmp_dir, 'info.json'), 'w') as f:
+            json.dump({'dtype': np.dtype(dtype).str}, f)
+        try:
+            os.rename(tmp_dir, self.cache_dir)
+            LOG.info('created eval cache %s in %.1fs', self.cache_dir, time.perf_counter() - start)
+        except OSError:
+            # created concurrently by another process
+            shutil.rmtree(tmp_dir)
+
+    def open(self):
+        with open(os.path.join(self.cache_dir, 'info.json')) as f:
+            info = json.load(f)
+        self._index = np.load(os.path.join(self.cache_dir, 'index.npy'))
+        assert len(self._index) == len(self)
+        self._images = np.memmap(os.path.join(self.cache_dir, 'images.bin'),
+                                 dtype=np.dtype(info['dtype']), mode='r')
+        self._samples = np.memmap(os.path.join(self.cache_dir, 'samples.bin'), dtype=np.uint8, mode='r')
+
+    def __getitem__(self, index):
+        if self._index is None:
+            self.open()
+
+        image_offset, channels, height, width, sample_offset, sample_size = self._index[index]
+        image = np.array(self._images[image_offset:image_offset + channels * height * width])
+        image = torch.from_numpy(image.reshape(channels, height, width))
+        anns, meta = pickle.loads(self._samples[sample_offset:sample_offset + sample_size].tobytes())
+        return image, anns, meta
+
+
+class _Computed(torch.utils.data.Dataset):
+    """Samples of the dataset of an EvalCache computed in loader workers."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __getitem__(self, index):
+        return self.cache.compute(index)
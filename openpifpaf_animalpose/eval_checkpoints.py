@@ -0,0 +1,226 @@
+"""
+Evaluate many checkpoints on the animal eval set in one process.
+
+The eval dataset, its preprocessed batches and the ground truth index are
+built once. Every checkpoint then only runs the network, the decoder and
+the metric. A stats file per checkpoint is written like openpifpaf.eval
+writes it, and a table with one row per checkpoint goes to --results.
+
+    python -m openpifpaf_animalpose.eval_checkpoints --dataset animal \\
+        --checkpoints 'outputs/*.epoch1[0-5]0' --animal-eval-long-edge 0
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+
+import torch
+
+from openpifpaf import datasets, decoder, logger, network, show, visualizer, __version__
+from openpifpaf.predictor import Predictor
+
+from . import eval_shards
+
+LOG = logging.getLogger(__name__)
+
+
+class MaterializedBatches:
+    """Batches of a DataLoader kept in memory to iterate them many times."""
+
+    def __init__(self, loader):
+        self.dataset = loader.dataset
+        self.batch_size = loader.batch_size
+        self.sampler = loader.sampler
+
+        start = time.perf_counter()
+        self.batches = []
+        for images, *rest in loader:
+            # copy out of the shared memory of the loader workers
+            self.batches.append((images.clone(), *rest))
+        LOG.info('preprocessed %d eval batches once in %.1fs, %.0f MB of images',
+                 len(self.batches), time.perf_counter() - start,
+                 sum(b[0].element_size() * b[0].numel() for b in self.batches) / 1e6)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def materialize(loader):
+    """Materialize the DataLoader inside the loader wrappers of AnimalKp."""
+    if hasattr(loader, 'with_loader'):
+        return loader.with_loader(materialize(loader.loader))
+    return MaterializedBatches(loader)
+
+
+def checkpoint_paths(patterns, *, skip_epoch0=True):
+    """Sorted checkpoints of glob patterns, other names are kept as given."""
+    checkpoints = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            checkpoints += sorted(glob.glob(pattern, recursive=True))
+        else:
+            checkpoints.append(pattern)
+    if skip_epoch0:
+        checkpoints = [c for c in checkpoints if not c.endswith('.epoch000')]
+    return list(dict.fromkeys(checkpoints))
+
+
+def output_name(args, checkpoint):
+    """Output name of a checkpoint with the shard suffix of --animal-eval-shard."""
+    output = eval_shards.output_name(args, checkpoint)
+    shard = getattr(args, 'animal_eval_shard', None)
+    if shard is not None:
+        return eval_shards.shard_output(output, shard)
+    return output
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        prog='python3 -m openpifpaf_animalpose.eval_checkpoints',
+        usage='%(prog)s [options]',
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--version', action='version',
+                        version='OpenPifPaf {version}'.format(version=__version__))
+
+    datasets.cli(parser)
+    decoder.cli(parser)
+    logger.cli(parser)
+    network.Factory.cli(parser)
+    Predictor.cli(parser, skip_batch_size=True, skip_loader_workers=True)
+    show.cli(parser)
+    visualizer.cli(parser)
+
+    parser.add_argument('--checkpoints', nargs='+', required=True,
+                        help='checkpoint files or glob patterns, quoted to expand them here')
+    parser.add_argument('--results', default=None,
+                        help='table of all checkpoints, default checkpoints.eval-<dataset>.tsv')
+    parser.add_argument('--skip-existing', default=False, action='store_true',
+                        help='skip checkpoints whose eval stats file, of this shard with --animal-eval-shard, '
+                             'exists already')
+    parser.add_argument('--no-skip-epoch0', dest='skip_epoch0',
+                        default=True, action='store_false',
+                        help='do not skip eval for epoch 0')
+    parser.add_argument('--disable-cuda', action='store_true',
+                        help='disable CUDA')
+    parser.add_argument('--write-predictions', default=False, action='store_true',
+                        help='write a json and a zip file of the predictions')
+    parser.add_argument('--n-images', default=None, type=int)
+    args = parser.parse_args()
+
+    logger.configure(args, LOG)
+
+    args.device = torch.device('cpu')
+    args.pin_memory = False
+    if not args.disable_cuda and torch.cuda.is_available():
+        args.device = torch.device('cuda')
+        args.pin_memory = True
+    LOG.debug('neural network device: %s', args.device)
+
+    datasets.configure(args)
+    decoder.configure(args)
+    network.Factory.configure(args)
+    Predictor.configure(args)
+    show.configure(args)
+    visualizer.configure(args)
+
+    if args.results is None:
+        args.results = 'checkpoints.eval-{}.tsv'.format(args.dataset)
+    return args
+
+
+def evaluate(args, datamodule, loader, checkpoint):
+    """Stats of one checkpoint on the materialized eval batches."""
+    network.Factory.checkpoint = checkpoint
+    predictor = Predictor(head_metas=datamodule.head_metas)
+    metrics = datamodule.metrics()
+
+    total_start = time.perf_counter()
+    for image_i, (pred, gt_anns, image_meta) in enumerate(predictor.dataloader(loader)):
+        if args.n_images is not None and image_i > args.n_images:
+            break
+        for metric in metrics:
+            metric.accumulate(pred, image_meta, ground_truth=gt_anns)
+    total_time = time.perf_counter() - total_start
+
+    local_checkpoint = network.local_checkpoint_path(checkpoint)
+    additional_data = {
+        'args': sys.argv,
+        'version': __version__,
+        'dataset': args.dataset,
+        'total_time': total_time,
+        'checkpoint': checkpoint,
+        'file_size': os.path.getsize(local_checkpoint) if local_checkpoint else -1.0,
+        'n_images': predictor.total_images,
+        'decoder_time': predictor.total_decoder_time,
+        'nn_time': predictor.total_nn_time,
+    }
+
+    output = output_name(args, checkpoint)
+    stats = {'stats': [], 'text_labels': []}
+    for metric in metrics:
+        if args.write_predictions or isinstance(metric, eval_shards.ShardPredictions):
+            metric.write_predictions(output, additional_data=additional_data)
+        this_metric_stats = metric.stats()
+        stats['stats'] += this_metric_stats['stats']
+        stats['text_labels'] += this_metric_stats['text_labels']
+    stats.update(additional_data)
+
+    # of a shard only the partial stats, openpifpaf_animalpose.eval_shards merges the predictions
+    with open(output + '.stats.json', 'w') as f:
+        json.dump(stats, f)
+    LOG.info('%s: %s', checkpoint, dict(zip(stats['text_labels'], stats['stats'])))
+
+    del predictor
+    if args.device.type == 'cuda':
+        torch.cuda.empty_cache()
+    return stats
+
+
+def write_results(file_name, all_stats):
+    text_labels = all_stats[0]['text_labels']
+    with open(file_name, 'w') as f:
+        f.write('\t'.join(['checkpoint'] + text_labels + ['n_images', 'nn_time', 'decoder_time', 'total_time']))
+        f.write('\n')
+        for stats in all_stats:
+            f.write('\t'.join(
+                [stats['checkpoint']]
+                + ['{:.4f}'.format(v) for v in stats['stats']]
+                + ['{}'.format(stats['n_images'])]
+                + ['{:.1f}'.format(stats[k]) for k in ('nn_time', 'decoder_time', 'total_time')]
+            ))
+            f.write('\n')
+    LOG.info('wrote %s', file_name)
+
+
+def main():
+    args = cli()
+    checkpoints = checkpoint_paths(args.checkpoints, skip_epoch0=args.skip_epoch0)
+    if args.skip_existing:
+        checkpoints = [c for c in checkpoints
+                       if not os.path.exists(output_name(args, c) + '.stats.json')]
+    LOG.info('%d checkpoints to evaluate: %s', len(checkpoints), checkpoints)
+    if not checkpoints:
+        return
+
+    datamodule = datasets.factory(args.dataset)
+    loader = materialize(datamodule.eval_loader())
+
+    all_stats = []
+    for checkpoint_i, checkpoint in enumerate(checkpoints):
+        LOG.info('checkpoint %d / %d: %s', checkpoint_i + 1, len(checkpoints), checkpoint)
+        all_stats.append(evaluate(args, datamodule, loader, checkpoint))
+        # rewritten after every checkpoint to keep partial results
+        write_results(args.results, all_stats)
+
+
+if __name__ == '__main__':
+    main()
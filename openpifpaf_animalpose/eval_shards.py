@@ -0,0 +1,231 @@
+"""
+Sharded evaluation with a single metric run over the merged predictions.
+
+With --animal-eval-shard i/N the eval loader keeps every N-th image of the
+eval set starting at image i, so N processes on one or more nodes evaluate
+disjoint parts that cover the whole set. Every output of a shard has the
+shard suffix: the metric of a shard only collects predictions in the json
+format of metric.Coco, --write-predictions writes them to
+<output>.shard<i>-of-<N>.json and the partial stats go to
+<output>.shard<i>-of-<N>.stats.json. This command checks that the
+prediction files cover all shards, accumulates them into the keypoint
+metric of the data module and writes the merged <output>.stats.json:
+
+    python -m openpifpaf_animalpose.eval_shards --dataset animal \\
+        outputs/model.epoch150.eval-animal.shard*-of-8.json
+"""
+
+import argparse
+from collections import defaultdict
+import json
+import logging
+import re
+import sys
+
+import torch
+
+from openpifpaf import datasets, logger, metric, __version__
+
+from .oks_metric import OksCoco
+
+LOG = logging.getLogger(__name__)
+
+SHARD_SUFFIX = re.compile(r'\.shard\d+-of-\d+\.json$')
+SHARD_OUTPUT = re.compile(r'\.shard\d+-of-\d+$')
+
+
+def parse_shard(text):
+    """Shard index and count of i/N with 0 <= i < N."""
+    try:
+        index, count = (int(v) for v in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected i/N, got {}'.format(text)) from None
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError('shard index must be in [0, {}), got {}'.format(count, index))
+    return index, count
+
+
+def shard_ids(ids, shard):
+    """Every count-th image id starting at index, in the order of ids."""
+    index, count = shard
+    return ids[index::count]
+
+
+def shard_output(output, shard):
+    """Output name of a shard, its stats and predictions files get the shard suffix."""
+    return '{}.shard{}-of-{}'.format(output, *shard)
+
+
+def shard_file_name(output, shard):
+    return shard_output(output, shard) + '.json'
+
+
+def output_name(args, checkpoint):
+    """Output name of openpifpaf.eval for this checkpoint."""
+    output = '{}.eval-{}'.format(checkpoint, args.dataset)
+    if args.coco_eval_orientation_invariant or args.coco_eval_extended_scale:
+        output += '-coco'
+        if args.coco_eval_orientation_invariant:
+            output += 'o'
+        if args.coco_eval_extended_scale:
+            output += 's'
+    if args.coco_eval_long_edge is not None and args.coco_eval_long_edge != 641:
+        output += '-cocoedge{}'.format(args.coco_eval_long_edge)
+    if args.dense_connections:
+        output += '-dense'
+        if args.dense_connections != 1.0:
+            output += '{}'.format(args.dense_connections)
+    return output
+
+
+def configure_eval_output(args, shard):
+    """Give the --output of openpifpaf.eval the shard suffix.
+
+    The stats file and the --skip-existing check of openpifpaf.eval then
+    belong to the shard and <output>.stats.json is left to the merge.
+    """
+    if args.watch:
+        raise Exception('--animal-eval-shard does not support --watch')
+    if args.output is None:
+        args.output = output_name(args, args.checkpoint)
+    if SHARD_OUTPUT.search(args.output) is None:
+        args.output = shard_output(args.output, shard)
+
+
+class ShardPredictions(metric.Base):
+    """Collects the predictions of one shard with a metric.Coco."""
+
+    text_labels = ['images', 'predictions']
+
+    def __init__(self, coco_metric, shard):
+        self.metric = coco_metric
+        self.shard = shard
+        self.written = False
+
+    def accumulate(self, predictions, image_meta, *, ground_truth=None):
+        self.metric.accumulate(predictions, image_meta, ground_truth=ground_truth)
+
+    def write_predictions(self, filename, *, additional_data=None):
+        """Write the predictions to <filename>.json, filename is the shard_output()."""
+        file_name = filename + '.json'
+        with open(file_name, 'w') as f:
+            json.dump({
+                'shard': list(self.shard),
+                'image_ids': self.metric.image_ids,
+                'predictions': self.metric.predictions,
+                'additional_data': additional_data or {},
+            }, f)
+        self.written = True
+        LOG.info('wrote %s', file_name)
+
+    def stats(self):
+        if not self.written:
+            LOG.warning('predictions of shard %d/%d are not written, use --write-predictions', *self.shard)
+        return {
+            'stats': [len(self.metric.image_ids), len(self.metric.predictions)],
+            'text_labels': self.text_labels,
+        }
+
+
+def load_shards(file_names):
+    """Shard files sorted by shard index, checked to cover all shards once."""
+    shards = []
+    for file_name in file_names:
+        with open(file_name) as f:
+            shards.append(json.load(f))
+    shards.sort(key=lambda shard: shard['shard'][0])
+
+    count = shards[0]['shard'][1]
+    indices = [shard['shard'][0] for shard in shards]
+    if any(shard['shard'][1] != count for shard in shards) or indices != list(range(count)):
+        raise ValueError('expected one file for each of {} shards, got shards {}'.format(
+            count, [tuple(shard['shard']) for shard in shards]))
+    checkpoints = {shard['additional_data'].get('checkpoint') for shard in shards}
+    if len(checkpoints) > 1:
+        raise ValueError('shards of different checkpoints: {}'.format(sorted(checkpoints)))
+    image_ids = [image_id for shard in shards for image_id in shard['image_ids']]
+    if len(set(image_ids)) != len(image_ids):
+        raise ValueError('shards have images in common')
+    LOG.info('%d shards with %d images', count, len(image_ids))
+    return shards
+
+
+def merge(coco_metric, shards):
+    """Accumulate the predictions of all shards into a metric.Coco."""
+    for shard in shards:
+        coco_metric.image_ids += shard['image_ids']
+        coco_metric.predictions += shard['predictions']
+        if isinstance(coco_metric, OksCoco) and not coco_metric.cross_image_ids:
+            image_predictions = defaultdict(list)
+            for prediction in shard['predictions']:
+                image_predictions[prediction['image_id']].append(prediction)
+            for image_id in shard['image_ids']:
+                coco_metric.accumulate_json(image_id, image_predictions[image_id])
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        prog='python3 -m openpifpaf_animalpose.eval_shards',
+        usage='%(prog)s [options] shard_files',
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    datasets.cli(parser)
+    logger.cli(parser)
+    parser.add_argument('shard_files', nargs='+',
+                        help='prediction files of all shards')
+    parser.add_argument('--output', default=None,
+                        help='output name, default is the name of the shard files without the shard suffix')
+    parser.add_argument('--write-predictions', default=False, action='store_true',
+                        help='write a json and a zip file of the merged predictions')
+    args = parser.parse_args()
+
+    logger.configure(args, LOG)
+    args.device = torch.device('cpu')
+    args.pin_memory = False
+    datasets.configure(args)
+
+    if args.output is None:
+        outputs = {SHARD_SUFFIX.sub('', file_name) for file_name in args.shard_files}
+        if len(outputs) != 1:
+            parser.error('shard files of different outputs {}, use --output'.format(sorted(outputs)))
+        args.output = outputs.pop()
+    return args
+
+
+def main():
+    args = cli()
+    shards = load_shards(args.shard_files)
+    datamodule = datasets.factory(args.dataset)
+
+    shard_data = [shard['additional_data'] for shard in shards]
+    additional_data = {
+        'args': sys.argv,
+        'version': __version__,
+        'dataset': args.dataset,
+        'checkpoint': shard_data[0].get('checkpoint'),
+        # the shards run in parallel
+        'total_time': max(data.get('total_time', 0.0) for data in shard_data),
+        'n_images': sum(data.get('n_images', 0) for data in shard_data),
+        'decoder_time': sum(data.get('decoder_time', 0.0) for data in shard_data),
+        'nn_time': sum(data.get('nn_time', 0.0) for data in shard_data),
+        'shards': shard_data,
+    }
+
+    stats = {'stats': [], 'text_labels': []}
+    for coco_metric in datamodule.metrics():
+        merge(coco_metric, shards)
+        if args.write_predictions:
+            coco_metric.write_predictions(args.output, additional_data=additional_data)
+        this_metric_stats = coco_metric.stats()
+        stats['stats'] += list(this_metric_stats['stats'])
+        stats['text_labels'] += this_metric_stats['text_labels']
+    stats.update(additional_data)
+
+    with open(args.output + '.stats.json', 'w') as f:
+        json.dump(stats, f)
+    LOG.info('%s: %s', args.output, dict(zip(stats['text_labels'], stats['stats'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import logging
+import multiprocessing
+
+import numpy as np
+import torch
+
+LOG = logging.getLogger(__name__)
+
+
+class ImageCache:
+    """LRU cache of decoded uint8 images shared by all DataLoader workers.
+
+    Pixels live in a single shared-memory buffer of max_bytes. Images are
+    placed in the first free gap that is large enough; when there is none,
+    least recently used images are evicted until the new image fits.
+    The buffer and the index are torch shared-memory tensors that are
+    created in the main process, so they survive worker restarts between
+    epochs.
+
+    Args:
+        n_keys: number of distinct images (keys are 0 ... n_keys - 1).
+        max_bytes: size of the pixel buffer.
+    """
+    # columns of the index
+    OFFSET, HEIGHT, WIDTH, LAST_USED = range(4)
+    # entries of the counters
+    TICK, HITS, MISSES, EVICTIONS, USED_BYTES = range(5)
+
+    log_interval = 1000
+
+    def __init__(self, n_keys, max_bytes):
+        self.max_bytes = max_bytes
+        self.buffer = torch.empty((max_bytes,), dtype=torch.uint8).share_memory_()
+        self.index = torch.full((n_keys, 4), -1, dtype=torch.int64).share_memory_()
+        self.counters = torch.zeros((5,), dtype=torch.int64).share_memory_()
+        self.lock = multiprocessing.Lock()
+        LOG.info('image cache for %d images with %.0f MB', n_keys, max_bytes / 1e6)
+
+    def get(self, key):
+        """Return a copy of the cached image or None."""
+        index = self.index.numpy()
+        counters = self.counters.numpy()
+        with self.lock:
+            offset, height, width, last_used = index[key]
+            if last_used < 0:
+                counters[self.MISSES] += 1
+                image = None
+            else:
+                counters[self.TICK] += 1
+                counters[self.HITS] += 1
+                index[key, self.LAST_USED] = counters[self.TICK]
+                n_bytes = height * width * 3
+                image = self.buffer.numpy()[offset:offset + n_bytes].reshape(height, width, 3).copy()
+
+            if (counters[self.HITS] + counters[self.MISSES]) % self.log_interval == 0:
+                LOG.info('image cache: %s', self._stats(counters))
+
+        return image
+
+    def put(self, key, image):
+        """Insert a HxWx3 uint8 image if it fits into the buffer at all."""
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        assert image.ndim == 3 and image.shape[2] == 3
+        n_bytes = image.nbytes
+        if n_bytes > self.max_bytes:
+            return
+
+        index = self.index.numpy()
+        counters = self.counters.numpy()
+        with self.lock:
+            if index[key, self.LAST_USED] >= 0:
+                # inserted by another worker in the meantime
+                return
+
+            offset = self._find_gap(index, n_bytes)
+            while offset is None:
+                self._evict_lru(index, counters)
+                offset = self._find_gap(index, n_bytes)
+
+            self.buffer.numpy()[offset:offset + n_bytes] = image.reshape(-1)
+            counters[self.TICK] += 1
+            counters[self.USED_BYTES] += n_bytes
+            index[key] = (offset, image.shape[0], image.shape[1], counters[self.TICK])
+
+    def _find_gap(self, index, n_bytes):
+        cached = index[index[:, self.LAST_USED] >= 0]
+        starts = np.sort(cached[:, self.OFFSET])
+        ends = np.sort(cached[:, self.OFFSET] + cached[:, self.HEIGHT] * cached[:, self.WIDTH] * 3)
+        gap_starts = np.concatenate(([0], ends))
+        gap_ends = np.concatenate((starts, [self.max_bytes]))
+        fits = np.nonzero(gap_ends - gap_starts >= n_bytes)[0]
+        if not fits.shape[0]:
+            return None
+        return int(gap_starts[fits[0]])
+
+    def _evict_lru(self, index, counters):
+        last_used = np.where(index[:, self.LAST_USED] >= 0,
+                             index[:, self.LAST_USED], np.iinfo(np.int64).max)
+        key = np.argmin(last_used)
+        counters[self.EVICTIONS] += 1
+        counters[self.USED_BYTES] -= index[key, self.HEIGHT] * index[key, self.WIDTH] * 3
+        index[key, self.LAST_USED] = -1
+
+    def _stats(self, counters):
+        hits, misses = counters[self.HITS], counters[self.MISSES]
+        return {
+            'hits': int(hits),
+            'misses': int(misses),
+            'hit_rate': round(float(hits / max(1, hits + misses)), 3),
+            'evictions': int(counters[self.EVICTIONS]),
+            'used_mb': round(float(counters[self.USED_BYTES]) / 1e6, 1),
+        }
+
+    def stats(self):
+        with self.lock:
+            return self._stats(self.counters.numpy())
@@ -0,0 +1,162 @@
+"""
+Pack the encoded images of a split into a few large shard files.
+
+A shard directory contains shard-00000.bin, shard-00001.bin, ... with the
+concatenated image files and index.npz with the shard, offset and size of
+every image id. Reading a sample is a slice of a memory mapped shard
+instead of opening a small file.
+
+Standalone usage:
+python -m openpifpaf_animalpose.image_shards --ann_file data/animalpose/annotations/animal_keypoints_20_train.json
+    --image_dir data/animalpose/images/train/ --dir_out data/animalpose/images/train_shards
+"""
+
+import argparse
+import gzip
+import io
+import json
+import logging
+import mmap
+import os
+import re
+import shutil
+
+import numpy as np
+
+
+LOG = logging.getLogger(__name__)
+
+INDEX_NAME = 'index.npz'
+SHARD_FILE = re.compile(r'^shard-\d{5}\.bin$')
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ann_file', required=True,
+                        help='json annotation file with the images to pack')
+    parser.add_argument('--image_dir', required=True,
+                        help='directory with the image files')
+    parser.add_argument('--dir_out', required=True,
+                        help='output shard directory')
+    parser.add_argument('--shard_mb', default=1024, type=int,
+                        help='approximate size of a shard file in MB')
+    args = parser.parse_args()
+    return args
+
+
+def shard_name(shard):
+    return 'shard-{:05d}.bin'.format(shard)
+
+
+def write_shards(images, dir_out, shard_bytes=1024 * 1000000):
+    """
+    Pack images, an iterable of (image_id, path), into the shard directory dir_out.
+    Images are stored in the given order, a shard is closed once it exceeds shard_bytes.
+    Repeated image ids are stored once. An existing shard directory is replaced,
+    a directory with other files is not touched.
+    Returns the number of shards.
+    """
+    if os.path.isdir(dir_out):
+        others = [name for name in os.listdir(dir_out)
+                  if name != INDEX_NAME and not SHARD_FILE.match(name)]
+        if others:
+            raise Exception('{} is not a shard directory, it contains {}'.format(
+                dir_out, ', '.join(sorted(others)[:5])))
+    unique_images = {}
+    for image_id, path in images:
+        unique_images.setdefault(image_id, path)
+    if os.path.isdir(dir_out):
+        shutil.rmtree(dir_out)
+    os.makedirs(dir_out)
+
+    image_ids, shards, offsets, sizes = [], [], [], []
+    shard, offset = 0, 0
+    f_out = open(os.path.join(dir_out, shard_name(shard)), 'wb')
+    try:
+        for image_id, path in unique_images.items():
+            if offset >= shard_bytes:
+                f_out.close()
+                shard, offset = shard + 1, 0
+                f_out = open(os.path.join(dir_out, shard_name(shard)), 'wb')
+            with open(path, 'rb') as f_in:
+                size = f_out.write(f_in.read())
+            image_ids.append(image_id)
+            shards.append(shard)
+            offsets.append(offset)
+            sizes.append(size)
+            offset += size
+    finally:
+        f_out.close()
+
+    image_ids = np.array(image_ids, dtype=np.int64)
+    order = np.argsort(image_ids)
+    np.savez(os.path.join(dir_out, INDEX_NAME),
+             image_ids=image_ids[order],
+             shards=np.array(shards, dtype=np.int32)[order],
+             offsets=np.array(offsets, dtype=np.int64)[order],
+             sizes=np.array(sizes, dtype=np.int64)[order],
+             n_shards=np.array(shard + 1))
+    LOG.info('packed %d images into %d shards in %s', len(image_ids), shard + 1, dir_out)
+    return shard + 1
+
+
+class ImageShards:
+    """Read access to the images of a shard directory by image id.
+
+    Shards are memory mapped on first access in every process, so the object
+    can be passed to DataLoader workers before any shard is opened.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with np.load(os.path.join(shard_dir, INDEX_NAME)) as index:
+            self.image_ids = index['image_ids']
+            self.shards = index['shards']
+            self.offsets = index['offsets']
+            self.sizes = index['sizes']
+            self.n_shards = int(index['n_shards'])
+        self._maps = None
+        LOG.info('image shards: %d images in %d shards of %s',
+                 len(self.image_ids), self.n_shards, shard_dir)
+
+    def __getstate__(self):
+        state = dict(vars(self))
+        state['_maps'] = None
+        return state
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def _map(self, shard):
+        if self._maps is None:
+            self._maps = [None] * self.n_shards
+        if self._maps[shard] is None:
+            with open(os.path.join(self.shard_dir, shard_name(shard)), 'rb') as f:
+                self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[shard]
+
+    def read(self, image_id):
+        """Encoded bytes of an image."""
+        row = int(np.searchsorted(self.image_ids, image_id))
+        if row >= len(self.image_ids) or self.image_ids[row] != image_id:
+            raise KeyError(image_id)
+        offset = int(self.offsets[row])
+        return self._map(int(self.shards[row]))[offset:offset + int(self.sizes[row])]
+
+    def open(self, image_id):
+        """File-like object of an image for PIL."""
+        return io.BytesIO(self.read(image_id))
+
+
+def main():
+    args = cli()
+    opener = gzip.open if args.ann_file.endswith('.gz') else open
+    with opener(args.ann_file, 'rt') as f:
+        images = json.load(f)['images']
+    n_shards = write_shards(((image['id'], os.path.join(args.image_dir, image['file_name'])) for image in images),
+                            args.dir_out, args.shard_mb * 1000000)
+    print(f'Packed the images into {n_shards} shards in {args.dir_out}')
+
+
+if __name__ == '__main__':
+    main()
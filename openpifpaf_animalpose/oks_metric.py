@@ -0,0 +1,251 @@
+"""
+Incremental keypoint OKS evaluation with the results of pycocotools.
+
+OksCoco is a metric.Coco for keypoints that matches the predictions of
+every image to its ground truth when they arrive, with OKS matrices and
+greedy matching vectorized over area ranges and OKS thresholds. stats()
+only sorts the detections of all images and accumulates precision and
+recall. It follows COCOeval step by step: ground truth resolved by
+annotation id, detection areas from the predicted bounding boxes as in
+COCO.loadRes, the same sort orders and tie breaking and the same floating
+point operations.
+"""
+
+from collections import defaultdict, namedtuple
+import logging
+
+import numpy as np
+
+from openpifpaf import metric
+
+LOG = logging.getLogger(__name__)
+
+# parameters of pycocotools.cocoeval.Params.setKpParams
+IOU_THRESHOLDS = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+RECALL_THRESHOLDS = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+MAX_DETS = 20
+AREA_RANGES = np.array([[0 ** 2, 1e5 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]])
+AREA_LABELS = ['all', 'medium', 'large']
+
+# detections of one image and category in score order, matches of shape
+# (area ranges, thresholds, detections) and non-ignored ground truth per area range
+ImageEval = namedtuple('ImageEval', ['scores', 'matched', 'ignored', 'n_regular'])
+
+
+def prediction_area(prediction):
+    """Area of a prediction as assigned by COCO.loadRes."""
+    bbox = prediction.get('bbox')
+    if bbox:
+        return bbox[2] * bbox[3]
+    x, y = prediction['keypoints'][0::3], prediction['keypoints'][1::3]
+    return (np.max(x) - np.min(x)) * (np.max(y) - np.min(y))
+
+
+class OksCoco(metric.Coco):
+    """Keypoint metric.Coco with an incremental NumPy evaluation."""
+
+    def __init__(self, coco, *, max_per_image=20, category_ids=None, keypoint_oks_sigmas=None):
+        super().__init__(coco, max_per_image=max_per_image, category_ids=category_ids,
+                         iou_type='keypoints', keypoint_oks_sigmas=keypoint_oks_sigmas)
+        self.evaluated_category_ids = sorted(set(self.category_ids or coco.getCatIds()))
+        self.variances = (np.asarray(keypoint_oks_sigmas) * 2)**2
+        self.image_predictions = defaultdict(list)
+        self.image_evals = {}
+        self.precision = None
+        self.recall = None
+
+        # COCOeval resolves ground truth by annotation id, an id that
+        # annotations of different images share assigns one of them to
+        # another image
+        self.cross_image_ids = any(coco.anns[ann['id']]['image_id'] != ann['image_id']
+                                   for ann in coco.dataset.get('annotations', []))
+        if self.cross_image_ids:
+            LOG.warning('annotation ids are shared between images, evaluating with pycocotools')
+
+    def accumulate(self, predictions, image_meta, *, ground_truth=None):
+        n_previous = len(self.predictions)
+        super().accumulate(predictions, image_meta, ground_truth=ground_truth)
+        if self.cross_image_ids:
+            return
+        self.accumulate_json(int(image_meta['image_id']), self.predictions[n_previous:])
+
+    def accumulate_json(self, image_id, image_predictions):
+        """Match predictions of one image that are already in self.predictions."""
+        self.image_predictions[image_id] += image_predictions
+        self.image_evals[image_id] = [self.evaluate_image(image_id, category_id)
+                                      for category_id in self.evaluated_category_ids]
+
+    def ground_truth(self, image_id, category_id):
+        """Ground truth as COCOeval loads it with loadAnns(getAnnIds(...)).
+
+        Annotations of an image that share an id are all the last
+        annotation with that id.
+        """
+        anns = [self.coco.anns[ann['id']] for ann in self.coco.imgToAnns.get(image_id, [])
+                if ann['category_id'] in self.evaluated_category_ids]
+        return [ann for ann in anns if ann['category_id'] == category_id]
+
+    def oks(self, dt_keypoints, gt_keypoints, gt_bboxes, gt_areas):
+        """OKS of shape (detections, ground truth) as in COCOeval.computeOks."""
+        n_keypoints = len(self.variances)
+        visible = gt_keypoints[:, :, 2] > 0
+        n_visible = np.count_nonzero(visible, axis=1)
+
+        xd, yd = dt_keypoints[:, None, :, 0], dt_keypoints[:, None, :, 1]
+        xg, yg = gt_keypoints[None, :, :, 0], gt_keypoints[None, :, :, 1]
+        # without visible keypoints, distances to the doubled bounding box
+        x0 = (gt_bboxes[:, 0] - gt_bboxes[:, 2])[None, :, None]
+        x1 = (gt_bboxes[:, 0] + gt_bboxes[:, 2] * 2)[None, :, None]
+        y0 = (gt_bboxes[:, 1] - gt_bboxes[:, 3])[None, :, None]
+        y1 = (gt_bboxes[:, 1] + gt_bboxes[:, 3] * 2)[None, :, None]
+        with_keypoints = (n_visible > 0)[None, :, None]
+        dx = np.where(with_keypoints, xd - xg, np.maximum(0.0, x0 - xd) + np.maximum(0.0, xd - x1))
+        dy = np.where(with_keypoints, yd - yg, np.maximum(0.0, y0 - yd) + np.maximum(0.0, yd - y1))
+        e = (dx**2 + dy**2) / self.variances / (gt_areas[None, :, None] + np.spacing(1)) / 2
+
+        # sum over the same compressed keypoints as pycocotools, so the
+        # summation order and the result are identical
+        ious = np.zeros((len(dt_keypoints), len(gt_keypoints)))
+        n_used = np.where(n_visible > 0, n_visible, n_keypoints)
+        for n in np.unique(n_used):
+            gt_i = np.flatnonzero(n_used == n)
+            used = np.where(n_visible[gt_i, None] > 0, visible[gt_i], True)
+            keypoint_i = np.argsort(~used, axis=1, kind='stable')[:, :n]
+            e_used = np.take_along_axis(e[:, gt_i], keypoint_i[None], axis=2)
+            ious[:, gt_i] = np.sum(np.exp(-e_used), axis=2) / n
+        return ious
+
+    def evaluate_image(self, image_id, category_id):
+        """Matches of COCOeval.evaluateImg for all area ranges."""
+        gts = self.ground_truth(image_id, category_id)
+        dts = [pred for pred in self.image_predictions[image_id] if pred['category_id'] == category_id]
+        if not gts and not dts:
+            return None
+        dts = [dts[i] for i in np.argsort([-d['score'] for d in dts], kind='mergesort')[:MAX_DETS]]
+        n_gts, n_dts = len(gts), len(dts)
+
+        gt_areas = np.array([gt['area'] if 'area' in gt else gt['bbox'][2] * gt['bbox'][3] for gt in gts],
+                            dtype=np.float64)
+        gt_ids = np.array([gt['id'] for gt in gts], dtype=np.int64)
+        crowd = np.array([bool(gt.get('iscrowd', 0)) for gt in gts], dtype=bool)
+        gt_ignore = crowd | np.array([gt['num_keypoints'] == 0 for gt in gts], dtype=bool)
+        # (area ranges, ground truth)
+        gt_ignore = gt_ignore[None] | (gt_areas[None] < AREA_RANGES[:, :1]) | (gt_areas[None] > AREA_RANGES[:, 1:])
+        dt_areas = np.array([prediction_area(dt) for dt in dts], dtype=np.float64)
+        dt_outside = (dt_areas[None] < AREA_RANGES[:, :1]) | (dt_areas[None] > AREA_RANGES[:, 1:])
+
+        shape = (len(AREA_RANGES), len(IOU_THRESHOLDS))
+        gt_matched = np.zeros(shape + (n_gts,), dtype=bool)
+        dt_matched = np.zeros(shape + (n_dts,), dtype=bool)
+        dt_ignored = np.zeros(shape + (n_dts,), dtype=bool)
+        if n_gts and n_dts:
+            ious = self.oks(
+                np.array([dt['keypoints'] for dt in dts], dtype=np.float64).reshape(n_dts, -1, 3),
+                np.array([gt['keypoints'] for gt in gts], dtype=np.float64).reshape(n_gts, -1, 3),
+                np.array([gt['bbox'] for gt in gts], dtype=np.float64).reshape(n_gts, 4),
+                gt_areas,
+            )
+            thresholds = np.minimum(IOU_THRESHOLDS, 1 - 1e-10)[None, :, None]
+            for dt_i in range(n_dts):
+                if ious[dt_i].max() < thresholds[0, 0, 0]:
+                    continue
+                # best match in ground truth that is not ignored, then in
+                # ignored ground truth, the last one among equal OKS
+                eligible = (ious[dt_i] >= thresholds) & ~(gt_matched & ~crowd)
+                regular = eligible & ~gt_ignore[:, None]
+                candidates = np.where(regular.any(axis=2, keepdims=True),
+                                      regular, eligible & gt_ignore[:, None])
+                found = candidates.any(axis=2)
+                area_i, threshold_i = np.nonzero(found)
+                last_best = np.argmax(np.where(candidates, ious[dt_i], -np.inf)[:, :, ::-1], axis=2)
+                gt_i = n_gts - 1 - last_best[found]
+
+                gt_matched[area_i, threshold_i, gt_i] = True
+                # COCOeval stores the ground truth id, an id of zero counts as no match
+                dt_matched[area_i, threshold_i, dt_i] = gt_ids[gt_i] != 0
+                dt_ignored[area_i, threshold_i, dt_i] = gt_ignore[area_i, gt_i]
+        dt_ignored |= ~dt_matched & dt_outside[:, None]
+
+        return ImageEval(
+            scores=np.array([dt['score'] for dt in dts], dtype=np.float64),
+            matched=dt_matched,
+            ignored=dt_ignored,
+            n_regular=np.count_nonzero(~gt_ignore, axis=1),
+        )
+
+    def accumulate_precision_recall(self):
+        """Precision and recall arrays of COCOeval.accumulate."""
+        n_thresholds, n_recalls = len(IOU_THRESHOLDS), len(RECALL_THRESHOLDS)
+        n_categories, n_areas = len(self.evaluated_category_ids), len(AREA_RANGES)
+        precision = -np.ones((n_thresholds, n_recalls, n_categories, n_areas, 1))
+        recall = -np.ones((n_thresholds, n_categories, n_areas, 1))
+
+        image_ids = sorted(self.image_evals)
+        for category_i in range(n_categories):
+            evals = [self.image_evals[image_id][category_i] for image_id in image_ids]
+            evals = [e for e in evals if e is not None]
+            if not evals:
+                continue
+            scores = np.concatenate([e.scores for e in evals])
+            order = np.argsort(-scores, kind='mergesort')
+            matched = np.concatenate([e.matched for e in evals], axis=2)[:, :, order]
+            ignored = np.concatenate([e.ignored for e in evals], axis=2)[:, :, order]
+            n_regular = np.sum([e.n_regular for e in evals], axis=0)
+
+            tp_sums = np.cumsum(matched & ~ignored, axis=2).astype(dtype=float)
+            fp_sums = np.cumsum(~matched & ~ignored, axis=2).astype(dtype=float)
+            n_dts = len(scores)
+            for area_i in range(n_areas):
+                if n_regular[area_i] == 0:
+                    continue
+                rc = tp_sums[area_i] / n_regular[area_i]
+                pr = tp_sums[area_i] / (fp_sums[area_i] + tp_sums[area_i] + np.spacing(1))
+                recall[:, category_i, area_i, 0] = rc[:, -1] if n_dts else 0
+                # precision envelope
+                pr = np.flip(np.maximum.accumulate(np.flip(pr, axis=1), axis=1), axis=1)
+                for threshold_i in range(n_thresholds):
+                    inds = np.searchsorted(rc[threshold_i], RECALL_THRESHOLDS, side='left')
+                    valid = inds < n_dts
+                    q = np.zeros((n_recalls,))
+                    q[valid] = pr[threshold_i, inds[valid]]
+                    precision[threshold_i, :, category_i, area_i, 0] = q
+        return precision, recall
+
+    def summarize(self, ap=1, iou_threshold=None, area_range='all'):
+        """Mean precision or recall as in COCOeval.summarize."""
+        area_i = [i for i, label in enumerate(AREA_LABELS) if label == area_range]
+        if ap == 1:
+            s = self.precision
+            if iou_threshold is not None:
+                s = s[np.where(iou_threshold == IOU_THRESHOLDS)[0]]
+            s = s[:, :, :, area_i, [0]]
+        else:
+            s = self.recall
+            if iou_threshold is not None:
+                s = s[np.where(iou_threshold == IOU_THRESHOLDS)[0]]
+            s = s[:, :, area_i, [0]]
+        mean_s = -1 if len(s[s > -1]) == 0 else np.mean(s[s > -1])
+        LOG.info(' %-18s %s @[ IoU=%-9s | area=%6s | maxDets=%3d ] = %.3f',
+                 'Average Precision' if ap == 1 else 'Average Recall', '(AP)' if ap == 1 else '(AR)',
+                 '0.50:0.95' if iou_threshold is None else '{:0.2f}'.format(iou_threshold),
+                 area_range, MAX_DETS, mean_s)
+        return mean_s
+
+    def _stats(self, predictions=None, image_ids=None):
+        if predictions is not None or image_ids is not None or self.cross_image_ids:
+            # pycocotools for a subset, used for debugging, and for ids shared between images
+            return super()._stats(predictions, image_ids)
+
+        self.precision, self.recall = self.accumulate_precision_recall()
+        return np.array([
+            self.summarize(1),
+            self.summarize(1, iou_threshold=.5),
+            self.summarize(1, iou_threshold=.75),
+            self.summarize(1, area_range='medium'),
+            self.summarize(1, area_range='large'),
+            self.summarize(0),
+            self.summarize(0, iou_threshold=.5),
+            self.summarize(0, iou_threshold=.75),
+            self.summarize(0, area_range='medium'),
+            self.summarize(0, area_range='large'),
+        ])
@@ -0,0 +1,156 @@
+"""
+Reusable pinned memory for the batches of a DataLoader.
+
+The pin_memory option of the DataLoader page-locks a new copy of every
+batch tensor. PinnedBatches instead copies the images and targets of each
+batch into one of a small ring of flat pinned buffers and yields views of
+them. A buffer is reused n_buffers batches later, after the copies that
+the consumer queued on the current CUDA stream are done. Consumers must not
+keep references to batch tensors across that many batches. A background
+thread fills the free buffers with the next batches while the consumer
+works on the current one.
+
+Buffers are sized from the capacities given by the data module and only
+grow when a larger batch arrives, so the allocation count stays constant
+after the first batches.
+"""
+
+import itertools
+import logging
+import queue
+import threading
+import time
+
+import torch
+
+LOG = logging.getLogger(__name__)
+
+
+class FillError:
+    """Exception of the fill thread, re-raised by the consumer."""
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class PinnedBatches:
+    """DataLoader whose batch tensors live in a ring of reusable pinned buffers.
+
+    Args:
+        loader: DataLoader with pin_memory=False.
+        n_buffers: number of batches in the ring.
+        capacities: dict of (dtype, number of elements) per tensor key
+            'images' and ('targets', head index).
+        log_interval: seconds between log messages of the buffer stats.
+    """
+
+    def __init__(self, loader: torch.utils.data.DataLoader, n_buffers=3, capacities=None, log_interval=60.0):
+        self.loader = loader
+        self.n_buffers = n_buffers
+        self.capacities = capacities or {}
+        self.log_interval = log_interval
+        self.pin = torch.cuda.is_available()
+
+        self.buffers = [{} for _ in range(n_buffers)]
+        self.events = [None] * n_buffers
+        self.n_allocations = 0
+        for buffers in self.buffers:
+            for key, (dtype, numel) in self.capacities.items():
+                self.allocate(buffers, key, dtype, numel)
+
+    def __getattr__(self, name):
+        # sampler, dataset, batch_size, ... of the wrapped loader
+        return getattr(self.loader, name)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def with_loader(self, loader):
+        return PinnedBatches(loader, self.n_buffers, self.capacities, self.log_interval)
+
+    @property
+    def nbytes(self):
+        return sum(buffer.element_size() * buffer.numel()
+                   for buffers in self.buffers for buffer in buffers.values())
+
+    def allocate(self, buffers, key, dtype, numel):
+        buffers[key] = torch.empty(numel, dtype=dtype, pin_memory=self.pin)
+        self.n_allocations += 1
+
+    def fill(self, buffers, key, tensor):
+        buffer = buffers.get(key)
+        if buffer is None or buffer.dtype != tensor.dtype or buffer.numel() < tensor.numel():
+            LOG.debug('allocating pinned buffer %s for %s %s', key, tensor.dtype, tuple(tensor.shape))
+            self.allocate(buffers, key, tensor.dtype, tensor.numel())
+            buffer = buffers[key]
+        pinned = buffer[:tensor.numel()].view(tensor.shape)
+        pinned.copy_(tensor)
+        return pinned
+
+    def __iter__(self):
+        # a thread copies the next batches into free buffers while the
+        # consumer works on the current one, like the pin_memory thread of
+        # the DataLoader
+        free_buffers = threading.Semaphore(self.n_buffers)
+        filled = queue.Queue()
+        done = threading.Event()
+        thread = threading.Thread(target=self._fill_loop, args=(iter(self.loader), free_buffers, filled, done),
+                                  daemon=True)
+        thread.start()
+
+        stats = {'batches': 0, 'allocations': self.n_allocations, 'wait': 0.0}
+        last_log = time.perf_counter()
+        try:
+            for batch_i in itertools.count():
+                start = time.perf_counter()
+                batch = filled.get()
+                stats['wait'] += time.perf_counter() - start
+                if batch is None:
+                    break
+                if isinstance(batch, FillError):
+                    # keeps the traceback of the fill thread
+                    raise batch.exception
+                yield batch
+                stats['batches'] += 1
+
+                # the consumer has queued its copies of this batch
+                ring_i = batch_i % self.n_buffers
+                if self.pin:
+                    if self.events[ring_i] is None:
+                        self.events[ring_i] = torch.cuda.Event()
+                    self.events[ring_i].record()
+                free_buffers.release()
+
+                if time.perf_counter() - last_log > self.log_interval:
+                    self.log_stats(stats)
+                    last_log = time.perf_counter()
+        finally:
+            done.set()
+            free_buffers.release()
+            thread.join()
+        self.log_stats(stats)
+
+    def _fill_loop(self, batches, free_buffers, filled, done):
+        try:
+            for batch_i, (images, targets, *rest) in enumerate(batches):
+                free_buffers.acquire()
+                if done.is_set():
+                    return
+                ring_i = batch_i % self.n_buffers
+                if self.events[ring_i] is not None:
+                    self.events[ring_i].synchronize()
+                buffers = self.buffers[ring_i]
+
+                images = self.fill(buffers, 'images', images)
+                if targets and isinstance(targets[0], torch.Tensor):
+                    targets = [self.fill(buffers, ('targets', head_i), t) for head_i, t in enumerate(targets)]
+                filled.put((images, targets, *rest))
+            filled.put(None)
+        except Exception as e:  # pylint: disable=broad-except
+            filled.put(FillError(e))
+
+    def log_stats(self, stats):
+        LOG.info('pinned batch buffers: %d batches, %.1fs waited for batches, %d new allocations, '
+                 '%d total (%.0f MB)',
+                 stats['batches'], stats['wait'], self.n_allocations - stats['allocations'],
+                 self.n_allocations, self.nbytes / 1e6)
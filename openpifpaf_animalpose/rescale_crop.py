@@ -0,0 +1,128 @@
+import copy
+import logging
+
+import numpy as np
+import PIL
+import torch
+
+from openpifpaf import transforms
+
+LOG = logging.getLogger(__name__)
+
+
+class ScaledImage:
+    """Image rescaled to (target_w, target_h) on demand by crop().
+
+    Output pixel i maps to input coordinate i * (w - 1) / (target_w - 1)
+    which is the mapping of scipy.ndimage.zoom.
+    """
+
+    def __init__(self, pixels, target_w, target_h):
+        self.pixels = pixels
+        self.size = (target_w, target_h)
+
+    def crop(self, ltrb):
+        return PIL.Image.fromarray(self.crop_pixels(ltrb))
+
+    def crop_pixels(self, ltrb):
+        im_np = self.pixels
+        h, w = im_np.shape[:2]
+        left, top, right, bottom = (int(v) for v in ltrb)
+        x0, x1, wx = self.interpolation_1d(left, right, w, self.size[0])
+        y0, y1, wy = self.interpolation_1d(top, bottom, h, self.size[1])
+
+        # interpolate rows first, then columns, on the window only
+        wy = wy[:, np.newaxis, np.newaxis]
+        wx = wx[:, np.newaxis]
+        rows = im_np[y0].astype(np.float32) * (1.0 - wy) + im_np[y1].astype(np.float32) * wy
+        cropped = rows[:, x0] * (1.0 - wx) + rows[:, x1] * wx
+        return np.clip(np.rint(cropped), 0, 255).astype(np.uint8)
+
+    @staticmethod
+    def interpolation_1d(start, end, length, target_length):
+        factor = (length - 1) / (target_length - 1) if target_length > 1 else 0.0
+        coords = np.arange(start, end, dtype=np.float64) * factor
+        i0 = np.clip(np.floor(coords).astype(np.int64), 0, length - 1)
+        i1 = np.minimum(i0 + 1, length - 1)
+        return i0, i1, (coords - i0).astype(np.float32)
+
+
+class RescaleRelativeCrop(transforms.Preprocess):
+    """RescaleRelative followed by Crop that only resamples the crop window.
+
+    The scale and the crop window are drawn exactly like in the two separate
+    transforms and annotations and meta are updated in the same way. The
+    crop works on a lazily scaled image that interpolates only the pixels
+    inside the window, with the same bilinear corner-aligned mapping as
+    the separate rescale.
+
+    The scale is relative to the original image: an image that the dataset
+    decoded at a reduced size, as recorded in meta['scale'], is rescaled to
+    the same target size as the original. draw_factors() draws the factors
+    of the next call ahead of time so the dataset can decode accordingly.
+    """
+
+    scaled_image_class = ScaledImage
+
+    def __init__(self, rescale: transforms.RescaleRelative, crop: transforms.Crop):
+        assert rescale.resample == PIL.Image.BILINEAR
+        assert rescale.absolute_reference is None
+        self.rescale = rescale
+        self.crop = crop
+        self.drawn_factors = None
+
+    def scale_factor(self):
+        rescale = self.rescale
+        if not isinstance(rescale.scale_range, tuple):
+            return rescale.scale_range
+        if rescale.power_law:
+            rnd_range = np.log2(rescale.scale_range[0]), np.log2(rescale.scale_range[1])
+            log2_scale_factor = rnd_range[0] + torch.rand(1).item() * (rnd_range[1] - rnd_range[0])
+            return 2 ** log2_scale_factor
+        return (rescale.scale_range[0]
+                + torch.rand(1).item() * (rescale.scale_range[1] - rescale.scale_range[0]))
+
+    def stretch_factor(self):
+        stretch_range = self.rescale.stretch_range
+        if stretch_range is None:
+            return 1.0
+        return stretch_range[0] + torch.rand(1).item() * (stretch_range[1] - stretch_range[0])
+
+    def draw_factors(self):
+        """Draw the factors of the next call, return its largest scale."""
+        self.drawn_factors = self.scale_factor(), self.stretch_factor()
+        scale_factor, stretch_factor = self.drawn_factors
+        return scale_factor * max(stretch_factor, 1.0)
+
+    def __call__(self, image, anns, meta):
+        meta = copy.deepcopy(meta)
+        anns = copy.deepcopy(anns)
+        pixels = np.asarray(image)
+        h, w = pixels.shape[:2]
+
+        if self.drawn_factors is not None:
+            scale_factor, stretch_factor = self.drawn_factors
+            self.drawn_factors = None
+        else:
+            scale_factor = self.scale_factor()
+            stretch_factor = self.stretch_factor()
+        # sizes relative to the original image, meta['scale'] is one unless decoded smaller
+        original_w, original_h = w / meta['scale'][0], h / meta['scale'][1]
+        target_w, target_h = int(original_w * scale_factor * stretch_factor), int(original_h * scale_factor)
+        scaled_image = self.scaled_image_class(pixels, target_w, target_h)
+
+        # rescale keypoints
+        x_scale = (target_w - 1) / (w - 1)
+        y_scale = (target_h - 1) / (h - 1)
+        scale_factors = np.array((x_scale, y_scale))
+        for ann in anns:
+            ann['keypoints'][:, [0, 1]] *= np.expand_dims(scale_factors, 0)
+            ann['bbox'][:2] *= scale_factors
+            ann['bbox'][2:] *= scale_factors
+
+        meta['offset'] *= scale_factors
+        meta['scale'] *= scale_factors
+        meta['valid_area'][:2] *= scale_factors
+        meta['valid_area'][2:] *= scale_factors
+
+        return self.crop(scaled_image, anns, meta)
@@ -0,0 +1,88 @@
+"""
+Sparse transport of the CIF/CAF targets from the loader workers.
+
+Encoded fields of shape (fields, channels, h, w) are mostly background:
+intensity 0 or NaN and NaN in all other channels. SparseField keeps a
+packed NaN bitmap of the intensity channel and the exact float32 values
+of all channels at the other pixels. DenseTargets wraps the DataLoader
+and restores the dense batch targets in the main process.
+"""
+
+import logging
+
+import numpy as np
+import torch
+
+from openpifpaf import transforms
+
+LOG = logging.getLogger(__name__)
+
+
+class SparseField:
+    """Compact encoded field that densifies to the exact same values."""
+
+    def __init__(self, shape, nan_bits, indices, values):
+        self.shape = shape
+        self.nan_bits = nan_bits
+        self.indices = indices
+        self.values = values
+
+    @classmethod
+    def from_dense(cls, field: torch.Tensor):
+        n_fields, n_channels, h, w = field.shape
+        pixels = field.numpy().reshape(n_fields, n_channels, h * w)
+        intensities = pixels[:, 0]
+        background = (((intensities == 0.0) & ~np.signbit(intensities)) | np.isnan(intensities)) \
+            & np.all(np.isnan(pixels[:, 1:]), axis=1)
+        indices = np.flatnonzero(~background).astype(np.int32)
+        values = pixels.transpose(0, 2, 1).reshape(-1, n_channels)[indices]
+        return cls(tuple(field.shape), np.packbits(np.isnan(intensities)), indices, values)
+
+    @property
+    def nbytes(self):
+        return self.nan_bits.nbytes + self.indices.nbytes + self.values.nbytes
+
+
+def dense_batch(sparse_fields):
+    """Tensor of shape (batch, fields, channels, h, w) of SparseFields of one head."""
+    n_fields, n_channels, h, w = sparse_fields[0].shape
+    n_pixels = n_fields * h * w
+    dense = np.full((len(sparse_fields), n_fields, n_channels, h * w), np.nan, dtype=np.float32)
+
+    nan = np.stack([np.unpackbits(f.nan_bits, count=n_pixels) for f in sparse_fields]).astype(bool)
+    dense[:, :, 0] = np.where(nan.reshape(len(sparse_fields), n_fields, h * w), np.nan, 0.0)
+
+    batch_i = np.repeat(np.arange(len(sparse_fields)), [len(f.indices) for f in sparse_fields])
+    indices = np.concatenate([f.indices for f in sparse_fields])
+    dense[batch_i, indices // (h * w), :, indices % (h * w)] = np.concatenate([f.values for f in sparse_fields])
+    return torch.from_numpy(dense.reshape(len(sparse_fields), n_fields, n_channels, h, w))
+
+
+class SparseTargets(transforms.Preprocess):
+    """Convert the encoded targets of Encoders to SparseFields."""
+
+    def __call__(self, image, anns, meta):
+        return image, [SparseField.from_dense(field) for field in anns], meta
+
+
+class DenseTargets:
+    """DataLoader of (images, sparse targets, metas) that yields dense targets."""
+
+    def __init__(self, loader: torch.utils.data.DataLoader):
+        self.loader = loader
+
+    def __getattr__(self, name):
+        # sampler, dataset, batch_size, ... of the wrapped loader
+        return getattr(self.loader, name)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def with_loader(self, loader):
+        return DenseTargets(loader)
+
+    def __iter__(self):
+        for images, targets_batch, metas in self.loader:
+            targets = [dense_batch([sample_targets[head_i] for sample_targets in targets_batch])
+                       for head_i in range(len(targets_batch[0]))]
+            yield images, targets, metas
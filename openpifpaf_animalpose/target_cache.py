@@ -0,0 +1,140 @@
+"""
+Disk cache of deterministically preprocessed samples with encoded targets.
+
+A cache directory holds one .npy memmap per image and target field with a
+row per dataset index, float32 stored as float16, and a slot of pickled
+meta per index. Rows are filled by whichever loader worker first needs
+them and are read back on later epochs and runs. The directory name is a
+hash of the dataset, the head metas and the preprocessing configuration.
+"""
+
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+
+LOG = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+META_BYTES = 4096
+
+
+def cache_key(**parts):
+    """Hash of json serializable parts, dataclasses and arrays."""
+    def default(obj):
+        if dataclasses.is_dataclass(obj):
+            return {'type': type(obj).__name__, **dataclasses.asdict(obj)}
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        return str(obj)
+
+    serialized = json.dumps(dict(parts, version=CACHE_VERSION), sort_keys=True, default=default)
+    return hashlib.sha1(serialized.encode()).hexdigest()[:16]
+
+
+def storage_dtype(tensor):
+    return np.float16 if tensor.is_floating_point() else tensor.numpy().dtype
+
+
+class TargetCache(torch.utils.data.Dataset):
+    """Dataset of (image, targets, meta) cached in cache_root/key.
+
+    The preprocessing of the wrapped dataset must produce the same shapes
+    for all samples. Every sample is computed with a torch seed of its
+    index, so random fill values of padding are reproducible.
+    """
+
+    def __init__(self, dataset, cache_root, key):
+        self.dataset = dataset
+        self.cache_dir = os.path.join(cache_root, key)
+        if not os.path.isdir(self.cache_dir):
+            self.create(cache_root)
+        self._arrays = None
+        self._meta_sizes = None
+        self._metas = None
+        self.open()
+        LOG.info('target cache %s: %d of %d samples cached',
+                 self.cache_dir, np.count_nonzero(self._meta_sizes), len(self))
+
+    def __getstate__(self):
+        state = dict(vars(self))
+        state['_arrays'] = None
+        state['_meta_sizes'] = None
+        state['_metas'] = None
+        return state
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def compute(self, index):
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(index)
+            return self.dataset[index]
+
+    def create(self, cache_root):
+        """Allocate the arrays from the shapes of the first sample."""
+        image, targets, _ = self.compute(0)
+        os.makedirs(cache_root, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=cache_root)
+        for name, tensor in (('image', image), *(('target-{}'.format(i), t) for i, t in enumerate(targets))):
+            np.lib.format.open_memmap(os.path.join(tmp_dir, name + '.npy'), mode='w+',
+                                      dtype=storage_dtype(tensor), shape=(len(self),) + tuple(tensor.shape))
+        np.lib.format.open_memmap(os.path.join(tmp_dir, 'meta_sizes.npy'), mode='w+',
+                                  dtype=np.int32, shape=(len(self),))
+        np.lib.format.open_memmap(os.path.join(tmp_dir, 'metas.npy'), mode='w+',
+                                  dtype=np.uint8, shape=(len(self), META_BYTES))
+        with open(os.path.join(tmp_dir, 'n_targets.json'), 'w') as f:
+            json.dump(len(targets), f)
+        try:
+            os.rename(tmp_dir, self.cache_dir)
+            LOG.info('created target cache %s', self.cache_dir)
+        except OSError:
+            # created concurrently by another process
+            shutil.rmtree(tmp_dir)
+
+    def open(self):
+        with open(os.path.join(self.cache_dir, 'n_targets.json')) as f:
+            n_targets = json.load(f)
+        names = ['image'] + ['target-{}'.format(i) for i in range(n_targets)]
+        self._arrays = [np.load(os.path.join(self.cache_dir, name + '.npy'), mmap_mode='r+')
+                        for name in names]
+        self._meta_sizes = np.load(os.path.join(self.cache_dir, 'meta_sizes.npy'), mmap_mode='r+')
+        self._metas = np.load(os.path.join(self.cache_dir, 'metas.npy'), mmap_mode='r+')
+        assert len(self._meta_sizes) == len(self)
+
+    def load(self, index):
+        image, *targets = (torch.from_numpy(np.asarray(array[index], dtype=np.float32)
+                                            if array.dtype == np.float16 else np.array(array[index]))
+                           for array in self._arrays)
+        meta = pickle.loads(self._metas[index, :self._meta_sizes[index]].tobytes())
+        return image, targets, meta
+
+    def store(self, index, image, targets, meta):
+        meta_bytes = pickle.dumps(meta)
+        if len(meta_bytes) > META_BYTES:
+            LOG.warning('meta of index %d is too large for the target cache', index)
+            return False
+        for array, tensor in zip(self._arrays, (image, *targets)):
+            array[index] = tensor.numpy()
+        self._metas[index, :len(meta_bytes)] = np.frombuffer(meta_bytes, dtype=np.uint8)
+        # the size marks the row as complete, so it is written last
+        self._meta_sizes[index] = len(meta_bytes)
+        return True
+
+    def __getitem__(self, index):
+        if self._arrays is None:
+            self.open()
+
+        if not self._meta_sizes[index]:
+            sample = self.compute(index)
+            if not self.store(index, *sample):
+                return sample
+        # also the first epoch returns the stored precision
+        return self.load(index)
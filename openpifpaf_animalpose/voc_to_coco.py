@@ -9,14 +9,18 @@ The original datasets include images and annotations divided in 2 parts.
 """
 
 import os
-import glob
 import argparse
 import time
 import json
 import random
+import gzip
+import itertools
+import tempfile
+import sqlite3
 from collections import defaultdict
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import shutil
-from shutil import copyfile
 import xml.etree.ElementTree as ET
 
 import numpy as np
@@ -24,6 +28,13 @@ from PIL import Image
 import matplotlib.pyplot as plt
 
 from .constants import _CATEGORIES, ANIMAL_KEYPOINTS, ALTERNATIVE_NAMES, ANIMAL_SKELETON
+from .image_shards import write_shards
+
+MANIFEST_NAME = '.voc_to_coco_manifest.sqlite'
+MANIFEST_VERSION = 2  # increment when the converted records change
+PYRAMID_DIR = 'pyramid'  # in the image directory of a phase
+LINK_MODES = ('copy', 'hardlink', 'symlink', 'reflink')
+FICLONE = 0x40049409  # Linux ioctl to share the extents of two files (btrfs, xfs)
 
 
 def dataset_mappings():
@@ -46,8 +57,22 @@ def cli():
                         help='Whether to only process the first 50 images')
     parser.add_argument('--split_images', action='store_true',
                         help='Whether to copy images into train val split folder')
+    parser.add_argument('--link_mode', default='copy', choices=LINK_MODES,
+                        help='how to place images in the split folders, falls back to copy if not supported')
+    parser.add_argument('--copy_threads', default=8, type=int,
+                        help='number of threads to place images in the split folders')
+    parser.add_argument('--shards', action='store_true',
+                        help='Whether to also pack the images of each split into indexed shard files')
+    parser.add_argument('--shard_mb', default=1024, type=int,
+                        help='approximate size of a shard file in MB')
+    parser.add_argument('--pyramid', default=[], nargs='*', type=int,
+                        help='long edges of pre-resized copies of every image, e.g. --pyramid 640 320')
     parser.add_argument('--histogram', action='store_true',
                         help='Whether to show keypoints histogram')
+    parser.add_argument('--jobs', default=1, type=int,
+                        help='number of processes to parse annotations and image headers')
+    parser.add_argument('--gzip', action='store_true',
+                        help='Whether to write gzip compressed json files')
     args = parser.parse_args()
     return args
 
@@ -72,72 +97,182 @@ class VocToCoco:
         assert os.path.isdir(self.dir_out_ann), "Annotations directory not found"
         self.sample = args.sample
         self.split_images = args.split_images
+        self.link_mode = args.link_mode
+        self.copy_threads = args.copy_threads
+        self.shards = args.shards
+        self.shard_mb = args.shard_mb
+        self.pyramid = args.pyramid
         self.histogram = args.histogram
+        self.jobs = args.jobs
+        self.gzip = args.gzip
 
     def process(self):
         splits = self._split_train_val()
-        all_xml_paths = []
-        for phase in ('train', 'val'):
-            metadata = splits[phase]
-            if self.sample:
-                metadata = metadata[:50]
-            if self.split_images:
-                make_new_directory(os.path.join(self.dir_out_im, phase))
-            cnt_images = 0
-            cnt_instances = 0
-            self.cnt_kps = [0] * len(ANIMAL_KEYPOINTS)
-            self.initiate_json()  # Initiate json file at each phase
-
-            for im_meta in metadata:
-                self._process_image(im_meta[0], im_meta[1])
+        manifest = Manifest(os.path.join(self.dir_out_ann, MANIFEST_NAME))
+        executor = ProcessPoolExecutor(self.jobs) if self.jobs > 1 else None
+        try:
+            for phase in ('train', 'val'):
+                self._process_phase(phase, splits[phase], manifest, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            manifest.close()
+
+    def _process_phase(self, phase, metadata, manifest, executor):
+        if self.sample:
+            metadata = metadata[:50]
+        if self.split_images:
+            place_images([im_meta[0] for im_meta in metadata], os.path.join(self.dir_out_im, phase),
+                         self.link_mode, self.copy_threads)
+        pyramids = {}
+        if self.pyramid:
+            pyramids = self._write_pyramids(metadata, os.path.join(self.dir_out_im, phase), executor)
+        cnt_images = 0
+        cnt_instances = 0
+        self.cnt_kps = [0] * len(ANIMAL_KEYPOINTS)
+        self.initiate_json()  # Initiate json file at each phase
+
+        name = 'animal_keypoints_' + str(self.n_kps) + '_'
+        if self.sample:
+            name = name + 'sample_'
+        path_json = os.path.join(self.dir_out_ann, name + phase + '.json')
+        if self.gzip:
+            path_json += '.gz'
+
+        with CocoJsonWriter(path_json, self.json_file) as writer:
+            for image, annotations in self._convert(metadata, manifest, executor):
+                if pyramids.get(image['id']):
+                    image = dict(image, pyramid=pyramids[image['id']])
+                writer.add_image(image)
                 cnt_images += 1
-                for xml_path in self._find_annotations(im_meta):
-                    self._process_annotation(xml_path, im_meta[1])
+                for annotation in annotations:
+                    # unique ids, the records of the manifest have the image id
+                    annotation = dict(annotation, id=cnt_instances + 1)
+                    writer.add_annotation(annotation)
+                    self._count_keypoints(annotation['keypoints'])
                     cnt_instances += 1
-                    all_xml_paths.append(xml_path)
-
-                # Split the image in a new folder
-                if self.split_images:
-                    dst = os.path.join(self.dir_out_im, phase, os.path.split(im_meta[0])[-1])
-                    copyfile(im_meta[0], dst)
 
                 # Count
                 if (cnt_images % 1000) == 0:
-                    text = ' and copied to new directory' if self.split_images else ''
-                    print(f'Parsed {cnt_images} images' + text)
-
-            # Save
-            name = 'animal_keypoints_' + str(self.n_kps) + '_'
-            if self.sample:
-                name = name + 'sample_'
-
-            path_json = os.path.join(self.dir_out_ann, name + phase + '.json')
-            with open(path_json, 'w') as outfile:
-                json.dump(self.json_file, outfile)
-            print(f'Phase:{phase}')
-            print(f'Average number of keypoints labelled: {sum(self.cnt_kps) / cnt_instances:.1f} / {self.n_kps}')
-            print(f'Saved {cnt_instances} instances over {cnt_images} images ')
-            print(f'JSON PATH:  {path_json}')
-            if self.histogram:
-                histogram(self.cnt_kps)
-
-    def _process_image(self, im_path, im_id):
-        """Update image field in json file"""
+                    print(f'Parsed {cnt_images} images')
+
+        print(f'Phase:{phase}')
+        print(f'Average number of keypoints labelled: {sum(self.cnt_kps) / cnt_instances:.1f} / {self.n_kps}')
+        print(f'Saved {cnt_instances} instances over {cnt_images} images ')
+        print(f'JSON PATH:  {path_json}')
+        if self.shards:
+            dir_shards = os.path.join(self.dir_out_im, phase + '_shards')
+            n_shards = write_shards(((im_meta[1], im_meta[0]) for im_meta in metadata),
+                                    dir_shards, self.shard_mb * 1000000)
+            print(f'Packed the images into {n_shards} shards in {dir_shards}')
+        if self.histogram:
+            histogram(self.cnt_kps)
+
+    def _write_pyramids(self, metadata, dir_phase, executor):
+        """Write the pre-resized images of a phase, return their levels by image id"""
+        dir_pyramid = os.path.join(dir_phase, PYRAMID_DIR)
+        dir_levels = [os.path.join(dir_pyramid, str(long_edge)) for long_edge in self.pyramid]
+        for dir_level in dir_levels:
+            os.makedirs(dir_level, exist_ok=True)
+
+        images = {im_meta[1]: im_meta[0] for im_meta in metadata}
+        args = (images.values(), itertools.repeat(dir_phase), itertools.repeat(self.pyramid))
+        if executor is not None:
+            levels = executor.map(write_pyramid, *args, chunksize=max(1, len(images) // (4 * self.jobs)))
+        else:
+            levels = map(write_pyramid, *args)
+        pyramids = dict(zip(images, levels))
+
+        remove_residuals(dir_pyramid, set(dir_levels))
+        expected = {os.path.join(dir_phase, level['file_name'])
+                    for image_levels in pyramids.values() for level in image_levels}
+        for dir_level in dir_levels:
+            remove_residuals(dir_level, expected)
+        print(f'Pyramid with long edges {self.pyramid} of {len(images)} images in {dir_pyramid}')
+        return pyramids
+
+    def _convert(self, metadata, manifest, executor):
+        """
+        Yield the image record and the annotation records of every image in metadata order.
+        Files unchanged since the last run are taken from the manifest, the others are
+        parsed by the executor if there is one.
+        """
+        jobs = (job for im_meta in metadata for job in self._jobs(im_meta))
+        image, annotations = None, []
+        for job, record in self._records(jobs, manifest, executor):
+            if job[0] == 'image':
+                if image is not None:
+                    yield image, annotations
+                image, annotations = record, []
+            else:
+                annotations.append(record)
+        if image is not None:
+            yield image, annotations
+
+    def _jobs(self, im_meta):
+        yield 'image', im_meta[0], im_meta[1], im_meta[2]
+        for xml_path in self._find_annotations(im_meta):
+            yield 'annotation', xml_path, im_meta[1], im_meta[2]
+
+    def _records(self, jobs, manifest, executor, batch_size=4096):
+        """Yield (job, record) in job order, converting batch_size files at a time"""
+        cnt_reused = 0
+        cnt_parsed = 0
+        while True:
+            batch = list(itertools.islice(jobs, batch_size))
+            if not batch:
+                break
+            lookups = [manifest.lookup(job[1]) for job in batch]
+            records = [record for _, record in lookups]
+            todo = [i for i, record in enumerate(records) if record is None]
+
+            todo_jobs = [batch[i] for i in todo]
+            if executor is not None and len(todo) > 1:
+                chunksize = max(1, len(todo) // (4 * self.jobs))
+                parsed = executor.map(self._convert_file, todo_jobs, chunksize=chunksize)
+            else:
+                parsed = map(self._convert_file, todo_jobs)
+            for i, record in zip(todo, parsed):
+                records[i] = record
+                manifest.put(batch[i][1], lookups[i][0], record)
+            manifest.commit()
+
+            cnt_reused += len(batch) - len(todo)
+            cnt_parsed += len(todo)
+            yield from zip(batch, records)
+        print(f'Reused {cnt_reused} converted files, parsed {cnt_parsed} files')
+
+    @classmethod
+    def _convert_file(cls, job):
+        kind, path, im_id, cat = job
+        if kind == 'image':
+            return cls._process_image(path, im_id)
+        return cls._process_annotation(path, im_id, cat)
+
+    def _count_keypoints(self, kps):
+        for n, visible in enumerate(kps[2::3]):
+            if visible:
+                self.cnt_kps[n] += 1
+
+    @staticmethod
+    def _process_image(im_path, im_id):
+        """Image record for the json file"""
         file_name = os.path.split(im_path)[1]
-        im = Image.open(im_path)
-        width, height = im.size
+        with Image.open(im_path) as im:
+            width, height = im.size
 
-        self.json_file["images"].append({
+        return {
             'coco_url': "unknown",
             'file_name': file_name,
             'id': im_id,
             'license': 1,
             'date_captured': "unknown",
             'width': width,
-            'height': height})
+            'height': height}
 
-    def _process_annotation(self, xml_path, im_id):
-        """Process single instance"""
+    @classmethod
+    def _process_annotation(cls, xml_path, im_id, cat):
+        """Annotation record of a single instance"""
         tree = ET.parse(xml_path)
         root = tree.getroot()
         box_obj = root.findall('visible_bounds')
@@ -157,33 +292,34 @@ class VocToCoco:
         assert len(kp_obj) <= 1, "multiple elements in a single annotation file not supported"
         kps_list = kp_obj[0].findall('keypoint')
 
-        kps, num = self._process_keypoint(kps_list)
+        kps, num = cls._process_keypoint(kps_list)
 
-        self.json_file["annotations"].append({
+        return {
             'image_id': im_id,
             'category_id': 1,
+            'species_id': cls.map_cat[cat],
             'iscrowd': 0,
             'id': im_id,
             'area': box[2] * box[3],
             'bbox': box,
             'num_keypoints': num,
             'keypoints': kps,
-            'segmentation': []})
-        return None
+            'segmentation': []}
 
-    def _process_keypoint(self, kps_list):
+    @classmethod
+    def _process_keypoint(cls, kps_list):
         """Extract single keypoint from XML"""
         cnt = 0
-        kps_out = np.zeros((self.n_kps, 3))
+        kps_out = np.zeros((cls.n_kps, 3))
         for kp in kps_list:
-            n = self.map_names[kp.attrib['name']]
+            n = cls.map_names[kp.attrib['name']]
             if n < 100 and kp.attrib['visible'] == '1':
                 kps_out[n, 0] = float(kp.attrib['x'])
                 kps_out[n, 1] = float(kp.attrib['y'])
                 kps_out[n, 2] = 2
                 cnt += 1
-                self.cnt_kps[n] += 1
-        kps_out = list(kps_out.reshape((-1,)))
+        # Plain numbers, integral ones without a trailing .0
+        kps_out = [int(v) if v.is_integer() else v for v in kps_out.reshape((-1,)).tolist()]
         return kps_out, cnt
 
     def _split_train_val(self, train_n=4000):
@@ -195,17 +331,14 @@ class VocToCoco:
         folder
         """
         random.seed(1)
+        xml_files, self.xml_index = self._index_annotations()
         im_data = []
-        for folder in glob.glob(os.path.join(self.dir_dataset, 'part*')):
-            folder_name = os.path.basename(folder)
-            dir_ann = os.path.join(folder, 'annotations')
-            for cat in _CATEGORIES:
-                xml_paths = glob.glob(os.path.join(dir_ann, cat + os.sep + '*.xml'))
-                for xml_path in xml_paths:
-                    im_path, im_id = self._extract_filename(xml_path)
-                    im_data.append((im_path, im_id, cat, folder_name))
+        for (folder_name, cat), xml_paths in xml_files.items():
+            for xml_path in xml_paths:
+                im_path, im_id = self._extract_filename(xml_path)
+                im_data.append((im_path, im_id, cat, folder_name))
         cnt_ann = len(im_data)
-        im_data = list(set(im_data))  # Remove duplicates
+        im_data = sorted(set(im_data))  # Remove duplicates, sorted for a reproducible shuffle
         cnt_im = len(im_data)
         val_n = cnt_im - train_n
         random.shuffle(im_data)
@@ -214,6 +347,38 @@ class VocToCoco:
         print(f'Read {cnt_ann}  annotations')
         return splits
 
+    def _index_annotations(self):
+        """
+        Scan every part*/annotations/<cat> directory once.
+        Return the xml files of every (folder, cat) and an index from (folder, cat, basename)
+        to the xml files of an image: <basename>.xml, <basename>_*xml and <basename>,*xml
+        """
+        xml_files = {}
+        index = defaultdict(list)
+        with os.scandir(self.dir_dataset) as folders:
+            folders = [entry for entry in folders if entry.name.startswith('part') and entry.is_dir()]
+        for folder in folders:
+            dir_ann = os.path.join(self.dir_dataset, folder.name, 'annotations')
+            for cat in _CATEGORIES:
+                dir_cat = os.path.join(dir_ann, cat)
+                if not os.path.isdir(dir_cat):
+                    continue
+                xml_paths = []
+                with os.scandir(dir_cat) as entries:
+                    for entry in entries:
+                        if not entry.name.endswith('xml'):
+                            continue
+                        path = os.path.join(dir_cat, entry.name)
+                        if entry.name.endswith('.xml') and not entry.name.startswith('.'):
+                            xml_paths.append(path)
+                        # Every prefix followed by one of _,. is a candidate basename
+                        # (avoids duplicates of the form cow13 cow130)
+                        for i, char in enumerate(entry.name):
+                            if char in '_,.':
+                                index[(folder.name, cat, entry.name[:i])].append(path)
+                xml_files[(folder.name, cat)] = xml_paths
+        return xml_files, index
+
     def _extract_filename(self, xml_path):
         """
         Manage all the differences between the 2 annotated parts and all the exceptions of Part 2
@@ -246,9 +411,8 @@ class VocToCoco:
         return im_path, im_id
 
     def _find_annotations(self, meta):
-        root = os.path.join(self.dir_dataset, meta[3], 'annotations', meta[2],
-                            os.path.splitext(os.path.basename(meta[0]))[0])
-        xml_paths = glob.glob(root + '[_,.]*xml')  # Avoid duplicates of the form cow13 cow130
+        basename = os.path.splitext(os.path.basename(meta[0]))[0]
+        xml_paths = self.xml_index.get((meta[3], meta[2], basename))
         assert xml_paths, "No annotations, expected at least one"
         return xml_paths
 
@@ -265,8 +429,99 @@ class VocToCoco:
                                              skeleton=ANIMAL_SKELETON,
                                              supercategory='animal',
                                              keypoints=[])]
-        self.json_file["images"] = []
-        self.json_file["annotations"] = []
+
+
+class CocoJsonWriter:
+    """
+    Write a COCO json file while the records are produced.
+    Images are written to the output directly, annotations are spooled to a temporary
+    file and appended on close, so memory does not grow with the size of the dataset.
+    The output is written to a temporary name and renamed on success.
+    """
+
+    def __init__(self, path, header):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        opener = gzip.open if path.endswith('.gz') else open
+        self.file = opener(self.tmp_path, 'wt', encoding='utf-8')
+        self.annotations = tempfile.TemporaryFile('w+t', encoding='utf-8', dir=os.path.dirname(path))
+        self.cnt_images = 0
+        self.cnt_annotations = 0
+
+        self.file.write('{')
+        for key, value in header.items():
+            self.file.write(compact_json(key) + ':' + compact_json(value) + ',')
+        self.file.write('"images":[')
+
+    def add_image(self, image):
+        if self.cnt_images:
+            self.file.write(',')
+        self.file.write(compact_json(image))
+        self.cnt_images += 1
+
+    def add_annotation(self, annotation):
+        if self.cnt_annotations:
+            self.annotations.write(',')
+        self.annotations.write(compact_json(annotation))
+        self.cnt_annotations += 1
+
+    def close(self):
+        self.file.write('],"annotations":[')
+        self.annotations.seek(0)
+        shutil.copyfileobj(self.annotations, self.file)
+        self.file.write(']}')
+        self.file.close()
+        self.annotations.close()
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        self.file.close()
+        self.annotations.close()
+        os.remove(self.tmp_path)
+
+
+def compact_json(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+class Manifest:
+    """
+    Converted record of every input file together with the mtime and size of the file
+    at conversion time. Records are reused while both are unchanged.
+    Stored in SQLite so that lookups do not need the whole manifest in memory.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS records '
+                        '(path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, version INTEGER, record TEXT)')
+
+    def lookup(self, path):
+        """Return the key (mtime_ns, size, version) of the file and its record if still valid"""
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size, MANIFEST_VERSION)
+        row = self.db.execute('SELECT mtime_ns, size, version, record FROM records WHERE path = ?',
+                              (path,)).fetchone()
+        if row is None or tuple(row[:3]) != key:
+            return key, None
+        return key, json.loads(row[3])
+
+    def put(self, path, key, record):
+        self.db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)',
+                        (path, *key, json.dumps(record)))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
 
 
 def histogram(cnt_kps):
@@ -279,12 +534,110 @@ def histogram(cnt_kps):
     plt.close()
 
 
-def make_new_directory(dir_out):
-    """Remove the output directory if already exists (avoid residual txt files)"""
-    if os.path.exists(dir_out):
-        shutil.rmtree(dir_out)
-    os.makedirs(dir_out)
-    print("!Created empty output directory!".format(dir_out))
+def place_images(im_paths, dir_out, link_mode, threads):
+    """
+    Place the images in dir_out with the given link mode.
+    Files that are already present and identical are skipped, residual files of a
+    previous split are removed.
+    """
+    os.makedirs(dir_out, exist_ok=True)
+    destinations = {os.path.join(dir_out, os.path.basename(im_path)): im_path for im_path in im_paths}
+    remove_residuals(dir_out, set(destinations) | {os.path.join(dir_out, PYRAMID_DIR)})
+
+    with ThreadPoolExecutor(threads) as executor:
+        modes = Counter(executor.map(lambda dst: place_file(destinations[dst], dst, link_mode), destinations))
+    print(f'Placed {len(destinations)} images in {dir_out}: ' +
+          ', '.join(f'{mode} {cnt}' for mode, cnt in sorted(modes.items())))
+
+
+def remove_residuals(dir_out, keep):
+    """Remove all files and directories in dir_out whose path is not in keep"""
+    with os.scandir(dir_out) as entries:
+        for entry in entries:
+            if entry.path in keep:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+
+
+def write_pyramid(im_path, dir_phase, long_edges):
+    """
+    Write copies of an image resized to the long edges that are smaller than the image.
+    Copies that are newer than the image are kept. Return the levels for the image record
+    with file names relative to dir_phase.
+    """
+    levels = []
+    with Image.open(im_path) as im:
+        width, height = im.size
+        im_format = im.format
+        resized = None
+        for long_edge in sorted(long_edges, reverse=True):
+            scale = long_edge / max(width, height)
+            if scale >= 1.0:
+                continue
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            file_name = os.path.join(PYRAMID_DIR, str(long_edge), os.path.basename(im_path))
+            levels.append({'file_name': file_name, 'width': size[0], 'height': size[1]})
+
+            path = os.path.join(dir_phase, file_name)
+            if os.path.exists(path) and os.stat(path).st_mtime_ns >= os.stat(im_path).st_mtime_ns:
+                continue
+            # resize from the previous, larger level
+            resized = (resized or im.convert('RGB')).resize(size, Image.LANCZOS)
+            tmp_path = path + '.tmp'
+            resized.save(tmp_path, format=im_format, quality=95)
+            os.replace(tmp_path, path)
+    return levels
+
+
+def place_file(src, dst, link_mode):
+    """Place a single file, return the mode that was used or 'skipped'"""
+    if is_identical(src, dst, link_mode):
+        return 'skipped'
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    try:
+        if link_mode == 'hardlink':
+            os.link(src, dst)
+            return link_mode
+        if link_mode == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+            return link_mode
+        if link_mode == 'reflink':
+            reflink(src, dst)
+            return link_mode
+    except (OSError, ImportError):
+        if os.path.lexists(dst):
+            os.remove(dst)
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+def is_identical(src, dst, link_mode):
+    try:
+        dst_stat = os.lstat(dst)
+    except FileNotFoundError:
+        return False
+    if link_mode == 'symlink':
+        return os.path.islink(dst) and os.path.samefile(src, dst)
+    if os.path.islink(dst):
+        return False
+    src_stat = os.stat(src)
+    if os.path.samestat(src_stat, dst_stat):
+        return True
+    # copies keep the modification time of the source
+    return src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+
+def reflink(src, dst):
+    """Copy-on-write copy, raises OSError where not supported"""
+    import fcntl  # pylint: disable=import-outside-toplevel
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+        fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+    shutil.copystat(src, dst)
 
 
 def main():
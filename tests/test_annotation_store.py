@@ -0,0 +1,49 @@
+import json
+
+import numpy as np
+import pytest
+
+from openpifpaf_animalpose.annotation_store import AnnotationStore, load_coco
+
+STORE_KEYS = ('id', 'image_id', 'category_id', 'iscrowd', 'keypoints', 'bbox', 'area', 'num_keypoints')
+
+
+def write_annotations(file_name, *, unique_ids):
+    rnd = np.random.default_rng(1)
+    images, anns = [], []
+    for image_id in (3, 1, 2):
+        images.append({'id': image_id, 'file_name': '{}.jpg'.format(image_id), 'width': 640, 'height': 480})
+        for _ in range(image_id):
+            keypoints = np.concatenate((rnd.uniform(0, 400, (20, 2)), rnd.choice([0, 2], (20, 1))), axis=1)
+            anns.append({
+                # voc_to_coco used to write the image id as annotation id
+                'id': len(anns) + 1 if unique_ids else image_id,
+                'image_id': image_id,
+                'category_id': 1 if len(anns) % 4 else 2,
+                'species_id': int(rnd.integers(1, 6)),
+                'iscrowd': 0,
+                'bbox': rnd.uniform(0, 200, 4).tolist(),
+                'area': float(rnd.uniform(100, 1000)),
+                'num_keypoints': int(np.count_nonzero(keypoints[:, 2])),
+                'keypoints': keypoints.reshape(-1).tolist(),
+            })
+    with open(file_name, 'w') as f:
+        json.dump({'images': images, 'annotations': anns, 'categories': [{'id': 1}, {'id': 2}]}, f)
+
+
+@pytest.mark.parametrize('unique_ids', [True, False])
+@pytest.mark.parametrize('category_ids', [[], [1]])
+def test_annotations_equal_load_anns(tmp_path, unique_ids, category_ids):
+    ann_file = str(tmp_path / 'annotations.json')
+    write_annotations(ann_file, unique_ids=unique_ids)
+    coco = load_coco(ann_file)
+    store = AnnotationStore.from_coco(coco, category_ids)
+
+    for image_id in coco.getImgIds():
+        expected = coco.loadAnns(coco.getAnnIds(imgIds=image_id, catIds=category_ids))
+        anns = store.annotations(image_id)
+        assert len(anns) == len(expected)
+        for ann, expected_ann in zip(anns, expected):
+            assert ann.keys() == {k for k in STORE_KEYS if k in expected_ann}
+            for key, value in ann.items():
+                np.testing.assert_allclose(value, expected_ann[key], rtol=1e-6, err_msg=key)
@@ -0,0 +1,52 @@
+import numpy as np
+import PIL.Image
+import pytest
+import torch
+import torchvision
+
+from openpifpaf import transforms
+
+from openpifpaf_animalpose import array_transforms
+
+
+def synthetic_image(rnd, height, width):
+    pixels = rnd.integers(0, 256, size=(height // 8, width // 8, 3), dtype=np.uint8)
+    image = np.array(PIL.Image.fromarray(pixels).resize((width, height), PIL.Image.BILINEAR))
+    # saturated and bright pixels
+    image[:height // 4] = (250, 255, 10)
+    return image
+
+
+def test_color_jitter():
+    rnd = np.random.default_rng(1)
+    kwargs = {'brightness': 0.4, 'contrast': 0.1, 'saturation': 0.4, 'hue': 0.1}
+    for seed in range(20):
+        image = synthetic_image(rnd, 48, 64)
+        torch.manual_seed(seed)
+        expected = torchvision.transforms.ColorJitter(**kwargs)(PIL.Image.fromarray(image))
+        torch.manual_seed(seed)
+        jittered = array_transforms.ColorJitter(**kwargs)(image)
+        np.testing.assert_array_equal(jittered, np.asarray(expected))
+
+    expected = torchvision.transforms.RandomGrayscale(p=1.0)(PIL.Image.fromarray(image))
+    grayscale = array_transforms.RandomGrayscale(p=1.0)(image)
+    np.testing.assert_array_equal(grayscale, np.asarray(expected))
+
+
+@pytest.mark.parametrize('height,width,angle_perturbation', [(40, 40, 0.0), (40, 56, 3.0)])
+def test_rotate(height, width, angle_perturbation):
+    image = synthetic_image(np.random.default_rng(2), height, width)
+    anns = [{'keypoints': np.array([[10.0, 20.0, 2.0], [30.0, 5.0, 2.0]]),
+             'bbox': np.array([5.0, 5.0, 25.0, 20.0])}]
+    meta = {'rotation': {'angle': 0.0, 'width': None, 'height': None},
+            'valid_area': np.array([0.0, 0.0, width - 1.0, height - 1.0])}
+    for seed in range(8):
+        torch.manual_seed(seed)
+        expected = transforms.RotateBy90(angle_perturbation)(PIL.Image.fromarray(image), anns, meta)
+        torch.manual_seed(seed)
+        rotated = array_transforms.RotateBy90(angle_perturbation)(image, anns, meta)
+        np.testing.assert_array_equal(rotated[0], np.asarray(expected[0]))
+        np.testing.assert_array_equal(rotated[1][0]['keypoints'], expected[1][0]['keypoints'])
+        np.testing.assert_array_equal(rotated[1][0]['bbox'], expected[1][0]['bbox'])
+        assert rotated[2]['rotation'] == expected[2]['rotation']
+        np.testing.assert_array_equal(rotated[2]['valid_area'], expected[2]['valid_area'])
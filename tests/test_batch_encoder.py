@@ -0,0 +1,76 @@
+import copy
+
+import numpy as np
+import pytest
+import torch
+
+from openpifpaf import encoder
+
+from openpifpaf_animalpose.animal_kp import AnimalKp
+from openpifpaf_animalpose.batch_encoder import BatchEncoding
+from openpifpaf_animalpose.constants import ANIMAL_KEYPOINTS
+
+# the encoders of openpifpaf 0.12 cast with np.int
+pytestmark = pytest.mark.skipif(not hasattr(np, 'int'), reason='openpifpaf encoders need numpy < 1.24')
+
+
+def synthetic_batch(rnd, batch_size, edge):
+    """Annotations and metas as they leave the training preprocessing."""
+    anns_batch, metas = [], []
+    for _ in range(batch_size):
+        anns = []
+        for _ in range(rnd.integers(0, 5)):
+            center = rnd.uniform(-50, edge + 50, size=2)
+            keypoints = np.zeros((len(ANIMAL_KEYPOINTS), 3), dtype=np.float32)
+            keypoints[:, :2] = center + rnd.normal(scale=rnd.uniform(5, 120), size=(len(ANIMAL_KEYPOINTS), 2))
+            keypoints[:, 2] = rnd.choice((0.0, 1.0, 2.0), size=len(ANIMAL_KEYPOINTS), p=(0.3, 0.2, 0.5))
+            anns.append({'keypoints': keypoints, 'bbox': np.array((*(center - 60), 120, 120), dtype=np.float32),
+                         'iscrowd': int(rnd.random() < 0.1)})
+        if anns and rnd.random() < 0.3:
+            # a second animal in almost the same pose
+            twin = copy.deepcopy(anns[0])
+            twin['keypoints'][:, :2] += rnd.normal(scale=1.0, size=(len(ANIMAL_KEYPOINTS), 2))
+            anns.append(twin)
+        valid_area = np.array((0.0, 0.0, edge - 1.0, edge - 1.0))
+        if rnd.random() < 0.5:
+            valid_area[rnd.integers(0, 2)] = rnd.uniform(0, edge / 3)
+            valid_area[2:] -= valid_area[:2]
+        anns_batch.append(anns)
+        metas.append({'valid_area': valid_area})
+    return anns_batch, metas
+
+
+def assert_bitwise_equal(expected, actual):
+    assert expected.shape == actual.shape
+    nan = torch.isnan(expected)
+    assert torch.equal(nan, torch.isnan(actual))
+    assert torch.equal(expected[~nan].view(torch.int32), actual[~nan].view(torch.int32))
+
+
+def test_batch_targets_equal_sample_encoders():
+    datamodule = AnimalKp()
+    for head_index, head_meta in enumerate(datamodule.head_metas):
+        head_meta.base_stride = 16
+        head_meta.head_index = head_index
+    encoders = datamodule._encoders()  # pylint: disable=protected-access
+    assert isinstance(encoders[0], encoder.Cif) and isinstance(encoders[1], encoder.Caf)
+
+    rnd = np.random.default_rng(3)
+    edge = 161
+    batches = []
+    for _ in range(4):
+        anns_batch, metas = synthetic_batch(rnd, 6, edge)
+        batches.append((torch.zeros((6, 3, edge, edge)), anns_batch, metas))
+    image = torch.zeros((3, edge, edge))
+    expected = [
+        [torch.stack([enc(image, copy.deepcopy(anns), meta) for anns, meta in zip(anns_batch, metas)])
+         for enc in encoders]
+        for _, anns_batch, metas in batches
+    ]
+
+    loader = BatchEncoding(copy.deepcopy(batches), encoders)
+    for (_, targets, metas), expected_targets in zip(loader, expected):
+        assert len(targets) == 2
+        for head_targets, expected_head_targets in zip(targets, expected_targets):
+            assert_bitwise_equal(expected_head_targets, head_targets)
+        assert all(meta['head_indices'] == [0, 1] for meta in metas)
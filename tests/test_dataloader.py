@@ -0,0 +1,98 @@
+import json
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+from openpifpaf_animalpose.annotation_store import load_coco
+from openpifpaf_animalpose.constants import ANIMAL_KEYPOINTS
+from openpifpaf_animalpose.dataloader import Animal
+
+
+def write_annotations(file_name, n_annotations, *, n_categories=5, seed=1):
+    """COCO keypoint file with on average 1.5 annotations per image."""
+    rnd = np.random.default_rng(seed)
+    n_images = max(1, int(n_annotations / 1.5))
+    n_keypoints = len(ANIMAL_KEYPOINTS)
+
+    image_ids = rnd.integers(1, n_images + 1, size=n_annotations)
+    category_ids = rnd.integers(1, n_categories + 1, size=n_annotations)
+    iscrowd = rnd.random(n_annotations) < 0.02
+    keypoints = rnd.integers(0, 500, size=(n_annotations, n_keypoints, 3))
+    keypoints[:, :, 2] = 2 * (rnd.random((n_annotations, n_keypoints)) < 0.3)
+
+    with open(file_name, 'w') as f:
+        json.dump({
+            'images': [{'id': i, 'file_name': '{}.jpg'.format(i), 'width': 640, 'height': 480}
+                       for i in range(1, n_images + 1)],
+            'annotations': [{
+                'id': i + 1,
+                'image_id': int(image_ids[i]),
+                'category_id': int(category_ids[i]),
+                'iscrowd': int(iscrowd[i]),
+                'bbox': [0, 0, 100, 100],
+                'keypoints': keypoints[i].reshape(-1).tolist(),
+            } for i in range(n_annotations)],
+            'categories': [{'id': i, 'name': str(i)} for i in range(1, n_categories + 1)],
+        }, f)
+
+
+def reference_filter(coco, ids, category_ids, min_kp_anns):
+    """Per-image pycocotools lookups of the former filter_for_annotations."""
+    def filter_image(image_id):
+        ann_ids = coco.getAnnIds(imgIds=image_id, catIds=category_ids)
+        anns = coco.loadAnns(ann_ids)
+        anns = [ann for ann in anns if not ann.get('iscrowd')]
+        if not anns:
+            return False
+        kp_anns = [ann for ann in anns
+                   if 'keypoints' in ann and any(v > 0.0 for v in ann['keypoints'][2::3])]
+        return len(kp_anns) >= min_kp_anns
+
+    return [image_id for image_id in ids if filter_image(image_id)]
+
+
+def reference_weights(coco, ids, category_ids, max_multiple=10.0):
+    """Loop of the former class_aware_sample_weights."""
+    ann_ids = coco.getAnnIds(imgIds=ids, catIds=category_ids)
+    anns = coco.loadAnns(ann_ids)
+
+    category_image_counts = defaultdict(int)
+    image_categories = defaultdict(set)
+    for ann in anns:
+        if ann['iscrowd']:
+            continue
+        image = ann['image_id']
+        category = ann['category_id']
+        if category in image_categories[image]:
+            continue
+        image_categories[image].add(category)
+        category_image_counts[category] += 1
+
+    weights = [
+        sum(
+            1.0 / category_image_counts[category_id]
+            for category_id in image_categories[image_id]
+        )
+        for image_id in ids
+    ]
+    max_w = min(weights) * max_multiple
+    return [min(w, max_w) for w in weights]
+
+
+@pytest.mark.parametrize('category_ids', [[], [2, 4]])
+@pytest.mark.parametrize('min_kp_anns', [0, 1, 2])
+def test_annotation_filter_and_weights_equal_loops(tmp_path, category_ids, min_kp_anns):
+    ann_file = str(tmp_path / 'annotations.json')
+    write_annotations(ann_file, 2000)
+
+    coco = load_coco(ann_file)
+    ids = coco.getImgIds(catIds=category_ids)
+    expected_ids = reference_filter(coco, ids, category_ids, min_kp_anns)
+    assert expected_ids
+    expected_weights = reference_weights(coco, expected_ids, category_ids)
+
+    data = Animal(str(tmp_path), ann_file, category_ids=category_ids,
+                  annotation_filter=True, min_kp_anns=min_kp_anns)
+    assert data.ids == expected_ids
+    assert data.class_aware_sample_weights() == expected_weights
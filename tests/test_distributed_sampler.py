@@ -0,0 +1,37 @@
+import torch
+
+from openpifpaf_animalpose.distributed_sampler import DistributedSamplerWrapper
+
+
+def rank_indices(sampler, num_replicas, epoch):
+    ranks = [DistributedSamplerWrapper(sampler, num_replicas, rank) for rank in range(num_replicas)]
+    for rank_sampler in ranks:
+        rank_sampler.set_epoch(epoch)
+    return [list(rank_sampler) for rank_sampler in ranks]
+
+
+def test_weighted_split():
+    weights = torch.tensor([0.0, 1.0, 2.0, 0.0, 4.0])
+    sampler = torch.utils.data.WeightedRandomSampler(weights, 101, replacement=True)
+
+    indices = rank_indices(sampler, 4, epoch=3)
+    assert [len(rank) for rank in indices] == [25] * 4
+    assert not {0, 3} & {i for rank in indices for i in rank}
+
+    # the processes split one draw of the wrapped sampler
+    generator = torch.Generator()
+    generator.manual_seed(3)
+    expected = list(torch.utils.data.WeightedRandomSampler(weights, 101, generator=generator))[:100]
+    merged = [indices[i % 4][i // 4] for i in range(100)]
+    assert merged == expected
+
+    assert rank_indices(sampler, 4, epoch=3) == indices
+    assert rank_indices(sampler, 4, epoch=4) != indices
+    assert sampler.generator is None
+
+
+def test_epoch_size():
+    sampler = torch.utils.data.RandomSampler(range(10), num_samples=30)
+    indices = rank_indices(sampler, 2, epoch=0)
+    assert [len(rank) for rank in indices] == [15, 15]
+    assert sorted(indices[0] + indices[1]) == sorted(list(range(10)) * 3)
@@ -0,0 +1,34 @@
+import argparse
+
+import pytest
+
+from openpifpaf_animalpose import eval_shards
+
+
+def eval_args(**kwargs):
+    args = dict(dataset='animal', checkpoint='outputs/model.epoch150', output=None, watch=False,
+                coco_eval_orientation_invariant=0.0, coco_eval_extended_scale=False,
+                coco_eval_long_edge=0, dense_connections=0.0)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def test_shard_output():
+    args = eval_args()
+    eval_shards.configure_eval_output(args, (2, 8))
+    assert args.output == 'outputs/model.epoch150.eval-animal-cocoedge0.shard2-of-8'
+
+    # configured again, e.g. by a second data module
+    eval_shards.configure_eval_output(args, (2, 8))
+    assert args.output == 'outputs/model.epoch150.eval-animal-cocoedge0.shard2-of-8'
+
+    # the prediction files map back to the output of the merged stats
+    assert eval_shards.SHARD_SUFFIX.sub('', args.output + '.json') == \
+        'outputs/model.epoch150.eval-animal-cocoedge0'
+
+    args = eval_args(output='eval')
+    eval_shards.configure_eval_output(args, (0, 2))
+    assert args.output == 'eval.shard0-of-2'
+
+    with pytest.raises(Exception):
+        eval_shards.configure_eval_output(eval_args(watch=60), (0, 2))
@@ -0,0 +1,30 @@
+import pytest
+
+from openpifpaf_animalpose.image_shards import ImageShards, write_shards
+
+
+def write_images(tmp_path, n_images):
+    paths = []
+    for i in range(n_images):
+        path = tmp_path / '{}.jpg'.format(i)
+        path.write_bytes(bytes([i]) * (i + 1))
+        paths.append(str(path))
+    return paths
+
+
+def test_rewrite_shards(tmp_path):
+    paths = write_images(tmp_path, 5)
+    dir_out = tmp_path / 'shards'
+    assert write_shards(enumerate(paths), str(dir_out), shard_bytes=4) == 3
+    assert write_shards(enumerate(paths[:2]), str(dir_out)) == 1
+
+    shards = ImageShards(str(dir_out))
+    assert len(shards) == 2
+    assert bytes(shards.read(1)) == b'\x01\x01'
+
+
+def test_refuse_other_directory(tmp_path):
+    paths = write_images(tmp_path, 2)
+    with pytest.raises(Exception, match='not a shard directory'):
+        write_shards(enumerate(paths), str(tmp_path))
+    assert (tmp_path / '0.jpg').exists()
@@ -0,0 +1,88 @@
+import contextlib
+import io
+import json
+
+import numpy as np
+import openpifpaf
+import pytest
+
+from openpifpaf_animalpose.annotation_store import load_coco
+from openpifpaf_animalpose.constants import ANIMAL_KEYPOINTS, ANIMAL_SIGMAS, ANIMAL_SKELETON
+from openpifpaf_animalpose.oks_metric import OksCoco
+
+
+def synthetic_keypoint_eval(file_name, n_images, *, seed=1):
+    """Write ground truth and return openpifpaf predictions per image id."""
+    rnd = np.random.default_rng(seed)
+    n_keypoints = len(ANIMAL_KEYPOINTS)
+    images, anns, predictions = [], [], {}
+    for image_id in range(1, n_images + 1):
+        images.append({'id': image_id, 'file_name': '{:06d}.jpg'.format(image_id), 'width': 1000, 'height': 1000})
+        predictions[image_id] = []
+        for _ in range(rnd.integers(0, 7)):
+            w, h = np.exp(rnd.uniform(np.log(10), np.log(500), 2))
+            x, y = rnd.uniform(0, 500, 2)
+            xy = rnd.uniform((x, y), (x + w, y + h), (n_keypoints, 2))
+            v = rnd.choice([0, 1, 2], n_keypoints, p=[0.3, 0.2, 0.5]) * (rnd.random() > 0.1)
+            ann = {
+                'id': len(anns) + 1, 'image_id': image_id, 'category_id': 1 if rnd.random() > 0.05 else 2,
+                'iscrowd': int(rnd.random() < 0.05), 'bbox': [x, y, w, h],
+                'keypoints': np.concatenate((np.round(xy), v[:, None]), axis=1).reshape(-1).tolist(),
+                'num_keypoints': int(np.count_nonzero(v)),
+            }
+            if rnd.random() > 0.1:
+                ann['area'] = 0.8 * w * h
+            anns.append(ann)
+
+            # noisy and duplicate detections
+            for _ in range(rnd.choice([0, 1, 1, 1, 2, 4])):
+                noise = rnd.normal(0.0, rnd.uniform(0.01, 0.15) * np.sqrt(w * h), (n_keypoints, 2))
+                predictions[image_id].append((xy + noise, rnd.uniform(0.05, 1.0, n_keypoints)))
+        for _ in range(rnd.choice([0, 1, 3, 25], p=[0.5, 0.3, 0.15, 0.05])):
+            xy = rnd.uniform(0, 600, 2) + rnd.uniform(0, 200, (n_keypoints, 2))
+            predictions[image_id].append((xy, rnd.uniform(0.05, 1.0, n_keypoints)))
+
+    with open(file_name, 'w') as f:
+        json.dump({'images': images, 'annotations': anns,
+                   'categories': [{'id': 1, 'name': 'animal'}, {'id': 2, 'name': 'other'}]}, f)
+
+    def annotation(xy, confidences):
+        data = np.concatenate((xy, confidences[:, None]), axis=1).astype(np.float32)
+        # coarse scores for ties between detections
+        return openpifpaf.Annotation(ANIMAL_KEYPOINTS, ANIMAL_SKELETON).set(
+            data, fixed_score=round(float(rnd.choice([0.2, 0.5, rnd.random()])), 2))
+
+    return {image_id: [annotation(*p) for p in image_predictions]
+            for image_id, image_predictions in predictions.items()}
+
+
+def annotation_ids(ann_file, ids):
+    with open(ann_file) as f:
+        data = json.load(f)
+    for ann in data['annotations']:
+        if ids == 'image':
+            # as written by voc_to_coco before annotation ids were unique
+            ann['id'] = ann['image_id']
+        elif ids == 'shared':
+            ann['id'] = ann['image_id'] % 7 + 1
+    with open(ann_file, 'w') as f:
+        json.dump(data, f)
+
+
+@pytest.mark.parametrize('ids', ['unique', 'image', 'shared'])
+def test_stats_equal_pycocotools(tmp_path, ids):
+    ann_file = str(tmp_path / 'annotations.json')
+    predictions = synthetic_keypoint_eval(ann_file, 300, seed=2)
+    annotation_ids(ann_file, ids)
+    coco = load_coco(ann_file)
+
+    stats = {}
+    for metric_class, kwargs in ((openpifpaf.metric.Coco, {'iou_type': 'keypoints'}), (OksCoco, {})):
+        evaluator = metric_class(coco, max_per_image=20, category_ids=[1],
+                                 keypoint_oks_sigmas=ANIMAL_SIGMAS, **kwargs)
+        for image_id, image_predictions in predictions.items():
+            evaluator.accumulate(image_predictions, {'image_id': image_id})
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats[metric_class] = np.array(evaluator.stats()['stats'])
+
+    assert np.max(np.abs(stats[openpifpaf.metric.Coco] - stats[OksCoco])) <= 1e-6
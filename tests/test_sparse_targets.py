@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import torch
+
+from openpifpaf_animalpose.sparse_targets import DenseTargets, SparseField, SparseTargets, dense_batch
+
+
+def synthetic_field(rnd, n_fields, n_channels, h, w):
+    """Encoder-like field: NaN and zero background with foreground regions."""
+    field = np.full((n_fields, n_channels, h, w), np.nan, dtype=np.float32)
+    field[:, 0] = np.where(rnd.random((n_fields, h, w)) < 0.5, 0.0, np.nan)
+    for _ in range(rnd.integers(0, 4)):
+        f, y, x = rnd.integers(0, n_fields), rnd.integers(0, h - 4), rnd.integers(0, w - 4)
+        field[f, :, y:y + 4, x:x + 4] = rnd.normal(0.0, 3.0, (n_channels, 4, 4))
+        field[f, 0, y:y + 4, x:x + 4] = rnd.choice([0.0, -0.0, 0.3, 1.0], (4, 4))
+        # regressions that are NaN within the foreground
+        field[f, 1:, y, x] = np.nan
+    # zero intensity with regressions is not background
+    field[0, 0, 0, 0] = 0.0
+    field[0, 1:, 0, 0] = 1.5
+    return torch.from_numpy(field)
+
+
+def assert_bitwise_equal(actual, expected):
+    nan = torch.isnan(expected)
+    assert torch.equal(torch.isnan(actual), nan)
+    assert torch.equal(actual[~nan].view(torch.int32), expected[~nan].view(torch.int32))
+
+
+@pytest.mark.parametrize('n_channels', [5, 9], ids=['cif', 'caf'])
+def test_dense_batch_bitwise(n_channels):
+    rnd = np.random.default_rng(n_channels)
+    fields = [synthetic_field(rnd, 20, n_channels, 17, 23) for _ in range(4)]
+    fields.append(torch.full((20, n_channels, 17, 23), np.nan))
+
+    sparse_fields = [SparseField.from_dense(field) for field in fields]
+    assert sum(f.nbytes for f in sparse_fields) < sum(f.numel() * 4 for f in fields)
+    assert_bitwise_equal(dense_batch(sparse_fields), torch.stack(fields))
+
+
+def test_dense_targets_loader():
+    rnd = np.random.default_rng(1)
+    samples = [(torch.zeros(3, 8, 8),
+                [synthetic_field(rnd, 20, 5, 9, 9), synthetic_field(rnd, 19, 9, 9, 9)],
+                {'dataset_index': i}) for i in range(3)]
+    sparse_samples = [SparseTargets()(*sample) for sample in samples]
+    batch = (torch.stack([s[0] for s in sparse_samples]),
+             [s[1] for s in sparse_samples],
+             [s[2] for s in sparse_samples])
+
+    (_, targets, metas), = list(DenseTargets([batch]))
+    assert len(targets) == 2
+    for head_i, head_targets in enumerate(targets):
+        assert_bitwise_equal(head_targets, torch.stack([s[1][head_i] for s in samples]))
+    assert metas == [s[2] for s in samples]